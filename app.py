@@ -1,13 +1,46 @@
-from fastapi import FastAPI, HTTPException, Response, Header
+from fastapi import FastAPI, HTTPException, Response, Header, Path, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from supabase import create_client
-from openai import OpenAI
+from functools import lru_cache
 from typing import Optional
+import asyncio
+import hashlib
+import json
 import os
-
-from mushroom_app import mush_app
+import time
+
+import clients
+import llm
+import metrics
+import router
+from history_cache import HistoryCache, trim_to_budget
+from summarizer import (
+    CHUNK_SUMMARY_PROMPT,
+    DAILY_SUMMARY_PROMPT,
+    EMPTY_DAY_SUMMARY,
+    MERGE_SUMMARY_PROMPT,
+    SUMMARY_PART_SENDER_TYPE,
+    SUMMARY_PERSONA,
+    SUMMARY_SENDER_TYPE,
+    build_transcript,
+    chunk_fingerprint,
+    chunk_rows,
+    conversation_rows,
+    fetch_day_rows,
+    merge_input,
+    part_key,
+    pg_quote,
+    report_key_for,
+)
+from memory_writer import MemoryLogWriter, row_identity
+from prompts import MODE_PREAMBLES, Mode
+from ratelimit import QueueTimeout
+from singleflight import SingleFlight
+from tenants import AuthError, Tenant, TenantResolver, load_tenants
+from mushroom_app import candidate_pool, mush_app
 
 # -----------------------------
 # Constants / Settings
@@ -20,20 +53,215 @@ SENDER_TYPE_BOT = "jarvis"
 PERSONA_BOT = "jarvis-core"
 PERSONA_USER = "tori"
 
-# --- env ---
+CHAT_SYSTEM_PROMPT = "あなたは親しみやすく、簡潔で、相手の気持ちを汲むアシスタントです。"
+
+# モードごとのシステムプロンプト（起動時に組み立て済み）。
+# messages の先頭を毎ターン同じバイト列にして、プロバイダのプロンプト接頭辞キャッシュに当てる
+CHAT_SYSTEM_PROMPTS = {
+    mode: f"{CHAT_SYSTEM_PROMPT}\n\n{preamble}" for mode, preamble in MODE_PREAMBLES.items()
+}
+
+# --- env ---（クライアント自体は clients.py が初回利用時に作るが、設定漏れは起動時に落とす）
 SUPABASE_URL = os.environ["SUPABASE_URL"]
 SUPABASE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-USER_ID = os.environ["SUPABASE_USER_ID"]  # TODO: 将来はJWTから取得
+USER_ID = os.environ["SUPABASE_USER_ID"]  # 既定テナント（JARVIS_API_KEY の持ち主）
 JARVIS_API_KEY = os.environ["JARVIS_API_KEY"]
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-oai = OpenAI(api_key=OPENAI_API_KEY)
+# 追加テナント（tenants.py）: JARVIS_TENANTS / JARVIS_TENANTS_FILE の API キー、または JWT（HS256）
+JARVIS_JWT_SECRET = os.getenv("JARVIS_JWT_SECRET")  # 任意。Supabase の JWT secret をそのまま使える
+JARVIS_JWT_AUDIENCE = os.getenv("JARVIS_JWT_AUDIENCE")  # 任意（Supabase なら "authenticated"）
+
+# memory_log の write-behind（バッチ書き込み）
+MEMORY_LOG_BATCH_SIZE = int(os.getenv("MEMORY_LOG_BATCH_SIZE", "50"))
+MEMORY_LOG_FLUSH_SEC = float(os.getenv("MEMORY_LOG_FLUSH_SEC", "1.0"))
+MEMORY_LOG_MAX_RETRIES = int(os.getenv("MEMORY_LOG_MAX_RETRIES", "5"))
+MEMORY_LOG_SPILL_PATH = os.getenv("MEMORY_LOG_SPILL_PATH", "memory_log.spill.jsonl")
+
+# memory_log のローカル読み取りレプリカ（replica.py）。日単位のログと直近履歴はまずここを読む
+REPLICA_ENABLED = os.getenv("REPLICA_ENABLED", "1") == "1"
+REPLICA_PATH = os.getenv("REPLICA_PATH", "memory_log.replica.sqlite3")
+REPLICA_INTERVAL_SEC = float(os.getenv("REPLICA_INTERVAL_SEC", "5"))
+REPLICA_MAX_STALENESS_SEC = float(os.getenv("REPLICA_MAX_STALENESS_SEC", "30"))  # これより古ければ Supabase を読む
+REPLICA_OVERLAP_SEC = float(os.getenv("REPLICA_OVERLAP_SEC", "120"))
+REPLICA_SINCE_DAYS = float(os.getenv("REPLICA_SINCE_DAYS", "35"))  # 初回に取り込む日数（0 = 全部）
+REPLICA_PAGE_SIZE = int(os.getenv("REPLICA_PAGE_SIZE", "1000"))
+
+# 会話コンテキスト（直近ターンのプロセス内キャッシュ）
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "40"))
+HISTORY_MAX_CONVERSATIONS = int(os.getenv("HISTORY_MAX_CONVERSATIONS", "256"))
+HISTORY_MAX_PER_TENANT = int(os.getenv("HISTORY_MAX_PER_TENANT", "32"))  # 1 テナントがキャッシュに持てる会話数
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+
+# 日次サマリー（階層・差分）
+SUMMARY_CHUNK_SIZE = int(os.getenv("SUMMARY_CHUNK_SIZE", "40"))
+SUMMARY_PAGE_SIZE = int(os.getenv("SUMMARY_PAGE_SIZE", "1000"))
+SUMMARY_RANGE_MAX_DAYS = int(os.getenv("SUMMARY_RANGE_MAX_DAYS", "62"))  # GET /daily_summary の期間の上限
+
+# 過去の会話の想起（埋め込み + ローカル IVF インデックス）。既定はオフ
+RECALL_ENABLED = os.getenv("RECALL_ENABLED", "0") == "1"
+RECALL_INDEX_DIR = os.getenv("RECALL_INDEX_DIR", "recall_index")
+RECALL_EMBED_MODEL = os.getenv("RECALL_EMBED_MODEL", "text-embedding-3-small")
+RECALL_DIM = int(os.getenv("RECALL_DIM", "1536"))
+RECALL_TOP_K = int(os.getenv("RECALL_TOP_K", "3"))
+# 超えたら想起なしで返答。BUDGET はローカルの索引検索だけ、EMBED_TIMEOUT は発言の埋め込み（OpenAI の往復）。
+# 埋め込みは履歴の取得と並行して走るので、ふだん応答が遅れるのは履歴より遅かった分だけ
+RECALL_BUDGET_MS = float(os.getenv("RECALL_BUDGET_MS", "150"))
+RECALL_EMBED_TIMEOUT_MS = float(os.getenv("RECALL_EMBED_TIMEOUT_MS", "1500"))
+RECALL_MIN_SCORE = float(os.getenv("RECALL_MIN_SCORE", "0.3"))
+RECALL_INDEX_INTERVAL_SEC = float(os.getenv("RECALL_INDEX_INTERVAL_SEC", "30"))
+RECALL_BATCH_SIZE = int(os.getenv("RECALL_BATCH_SIZE", "64"))
+RECALL_NLIST = int(os.getenv("RECALL_NLIST", "64"))
+RECALL_NPROBE = int(os.getenv("RECALL_NPROBE", "8"))
+
+# async クライアントは clients.py で遅延生成・共有（mushroom_app.py と同じ OpenAI クライアント）。
+# 1ワーカーで数百の LLM 呼び出しを同時に抱えられる（スレッドプールの上限 ~40 に縛られない）
+
+async def _insert_memory_rows(rows: list[dict]) -> None:
+    sb = await clients.supabase.get()
+    with metrics.stage("supabase_insert"):
+        await sb.table("memory_log").insert(rows).execute()
+
+memory_writer = MemoryLogWriter(
+    _insert_memory_rows,
+    batch_size=MEMORY_LOG_BATCH_SIZE,
+    flush_interval_sec=MEMORY_LOG_FLUSH_SEC,
+    max_retries=MEMORY_LOG_MAX_RETRIES,
+    spill_path=MEMORY_LOG_SPILL_PATH,
+)
+
+# 同じ (日付, 会話) の /daily_summary が同時に来たら 1 回の計算にまとめる
+summary_flight = SingleFlight()
+
+# キーは (user_id, conversation_id)
+history_cache = HistoryCache(
+    max_conversations=HISTORY_MAX_CONVERSATIONS,
+    max_turns=HISTORY_MAX_TURNS,
+    max_per_tenant=HISTORY_MAX_PER_TENANT,
+)
+
+DEFAULT_TENANT = Tenant(id="default", user_id=USER_ID, conversation_id=CONV_ID, is_default=True)
+tenant_resolver = TenantResolver(
+    DEFAULT_TENANT,
+    JARVIS_API_KEY,
+    load_tenants(),
+    jwt_secret=JARVIS_JWT_SECRET,
+    jwt_audience=JARVIS_JWT_AUDIENCE,
+)
+
+replica = None  # REPLICA_ENABLED の時だけ lifespan で生成（replica.Replica）
+
+async def _fetch_replica_page(cursor: Optional[dict], since: Optional[str], limit: int) -> list[dict]:
+    """レプリカの取り込み用: (created_at, id) のカーソルより後を古い順に（全ユーザー分）"""
+    sb = await clients.supabase.get()
+    query = sb.table("memory_log").select(
+        "id,user_id,conversation_id,created_at,speaker,message,sender_type,persona,report_key"
+    )
+    if since:
+        query = query.gte("created_at", since)
+    if cursor:
+        ts = pg_quote(cursor["created_at"])
+        query = query.or_(f"created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{cursor['id']})")
+    res = await query.order("created_at", desc=False).order("id", desc=False).limit(limit).execute()
+    return res.data or []
+
+def _start_replica() -> None:
+    global replica
+    from replica import Replica
+
+    replica = Replica(
+        REPLICA_PATH,
+        _fetch_replica_page,
+        page_size=REPLICA_PAGE_SIZE,
+        interval_sec=REPLICA_INTERVAL_SEC,
+        max_staleness_sec=REPLICA_MAX_STALENESS_SEC,
+        overlap_sec=REPLICA_OVERLAP_SEC,
+        since_days=REPLICA_SINCE_DAYS or None,
+    )
+    replica.start()
+
+def _record_read(query: str, source: str) -> None:
+    from replica import REPLICA_READS
+
+    REPLICA_READS.inc(query=query, source=source)
+
+recall = None  # RECALL_ENABLED の時だけ起動後にバックグラウンドで生成（recall.Recall）。既定テナント専用
+
+async def _fetch_recall_page(after: Optional[str], limit: int) -> list[dict]:
+    """indexer 用: ウォーターマーク以降（同時刻を含む）を古い順に"""
+    sb = await clients.supabase.get()
+    query = (
+        sb.table("memory_log")
+        .select("created_at,conversation_id,speaker,message,report_key")
+        .eq("user_id", USER_ID)
+    )
+    if after:
+        query = query.gte("created_at", after)
+    with metrics.stage("supabase_select"):
+        res = await query.order("created_at", desc=False).limit(limit).execute()
+    return res.data or []
+
+def _build_recall(oai):
+    # numpy を読み込むので、使う時だけ import
+    from recall import Embedder, EmbeddingCache, IVFIndex, Recall
+
+    os.makedirs(RECALL_INDEX_DIR, exist_ok=True)
+    embedder = Embedder(
+        oai,
+        RECALL_EMBED_MODEL,
+        EmbeddingCache(os.path.join(RECALL_INDEX_DIR, "embeddings.sqlite3")),
+        batch_size=RECALL_BATCH_SIZE,
+    )
+    index = IVFIndex(RECALL_INDEX_DIR, RECALL_DIM, nlist=RECALL_NLIST, nprobe=RECALL_NPROBE)
+    return Recall(
+        embedder,
+        index,
+        _fetch_recall_page,
+        interval_sec=RECALL_INDEX_INTERVAL_SEC,
+        min_score=RECALL_MIN_SCORE,
+    )
+
+async def _start_recall() -> None:
+    global recall
+    oai = await clients.openai.get()
+    # インデックスの読み込みはファイル I/O なのでスレッドで
+    r = await asyncio.to_thread(_build_recall, oai)
+    r.start()
+    recall = r
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # クライアント生成は待たずに listen を始める（最初のリクエストまでに裏で暖まる）
+    clients.warm_up()
+    await memory_writer.start()
+    if REPLICA_ENABLED:
+        _start_replica()
+    recall_task = asyncio.create_task(_start_recall()) if RECALL_ENABLED else None
+    if candidate_pool is not None:
+        candidate_pool.start()
+    yield
+    if candidate_pool is not None:
+        await candidate_pool.stop()
+    if recall_task is not None:
+        recall_task.cancel()
+        await asyncio.gather(recall_task, return_exceptions=True)
+    if recall is not None:
+        await recall.stop()
+    if replica is not None:
+        await replica.stop()
+    # キューに残った行を流し切ってから閉じる
+    await memory_writer.stop()
+    await clients.aclose()
 
 # -----------------------------
 # FastAPI app
 # -----------------------------
-app = FastAPI(title="Jarvis Chat API")
+app = FastAPI(title="Jarvis Chat API", lifespan=lifespan)
+
+# 区間計測・Server-Timing ヘッダ・/metrics
+metrics.set_service("app")
+app.add_middleware(metrics.ServerTimingMiddleware)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # 任意。設定すると /metrics に Bearer が必要
 
 # CORS（必要に応じて origin を絞ってOK）
 app.add_middleware(
@@ -42,16 +270,34 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# レート制限の待ち行列で deadline を過ぎた → 429（/mushroom 側は mushroom_app で同様に）
+@app.exception_handler(QueueTimeout)
+async def _queue_timeout(_request, exc: QueueTimeout):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "rate limited"},
+        headers={"Retry-After": str(int(exc.retry_after + 0.999))},
+    )
+
 # ✅ ここで mount（app が存在してから！）
 app.mount("/mushroom", mush_app)
 
 # -----------------------------
 # Schemas
 # -----------------------------
+CONVERSATION_ID_PATTERN = r"^[A-Za-z0-9][A-Za-z0-9.:-]{0,63}$"
+DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+
 class ChatIn(BaseModel):
     text: str
+    # 省略するとテナントの既定の会話（既定テナントなら CONV_ID）
+    conversation_id: Optional[str] = Field(default=None, pattern=CONVERSATION_ID_PATTERN)
+    # ゲートウェイが本文と分けて渡す（直接呼ぶクライアントは省略 = 従来どおり）
+    mode: Optional[Mode] = None
+    system: Optional[str] = None
 
 class ChatOut(BaseModel):
     reply: str
@@ -60,10 +306,12 @@ class ChatOut(BaseModel):
 class DailySummaryIn(BaseModel):
     # "YYYY-MM-DD"（省略するとJSTの今日）
     date: Optional[str] = None
-    # 省略すると現在の CONV_ID を使う
-    conversation_id: Optional[str] = None
-    # 長すぎる日の安全弁
-    max_rows: int = 200
+    # 省略するとテナントの既定の会話（既定テナントなら CONV_ID）
+    conversation_id: Optional[str] = Field(default=None, pattern=CONVERSATION_ID_PATTERN)
+    # 安全弁（省略すると1日分を全部ページングして読む）
+    max_rows: Optional[int] = None
+    # True: チャンクごとの部分要約を保存して差分だけ要約する
+    incremental: bool = True
 
 
 class DailySummaryOut(BaseModel):
@@ -71,27 +319,169 @@ class DailySummaryOut(BaseModel):
     summary: str
     jst_time: str
 
+
+class StoredSummaryOut(BaseModel):
+    date: str
+    conversation_id: str
+    summary: str
+
+
+class StoredSummaryListOut(BaseModel):
+    # 保存済みの日だけ（古い順）。無い日は含めない
+    summaries: list[StoredSummaryOut]
+
 # -----------------------------
 # Helpers
 # -----------------------------
-def log_row(speaker: str, text: str) -> None:
+async def log_row(tenant: Tenant, conversation_id: str, speaker: str, text: str) -> None:
     """
-    memory_log に 1 行書き込む。
+    memory_log に 1 行書き込む（write-behind キューに積むだけ）。
     - speaker: "user" | "bot"
     """
-    supabase.table("memory_log").insert({
-        "user_id": USER_ID,
-        "conversation_id": CONV_ID,
+    history_cache.append((tenant.user_id, conversation_id), "assistant" if speaker == "bot" else "user", text)
+    row = memory_writer.enqueue({
+        "user_id": tenant.user_id,
+        "conversation_id": conversation_id,
         "speaker": speaker,
         "message": text,
         "content": text,  # 旧列互換
         "sender_type": SENDER_TYPE_BOT if speaker == "bot" else "user",
         "persona": PERSONA_BOT if speaker == "bot" else PERSONA_USER,
-    }).execute()
+    })
+    if replica is not None:
+        # Supabase に届く前から読める（SQLite の書き込みはループの外で）
+        await asyncio.to_thread(replica.apply, [row])
+
+def require_tenant(x_api_key: str | None, authorization: str | None = None) -> Tenant:
+    try:
+        return tenant_resolver.resolve(x_api_key, authorization)
+    except AuthError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+def _report_key(tenant: Tenant, conversation_id: str, day: datetime) -> str:
+    # 既定テナントの既定会話だけは従来の summary-YYYYMMDD（cron や過去の行と揃える）
+    if tenant.is_default and conversation_id == CONV_ID:
+        return report_key_for(day)
+    return report_key_for(day, tenant.user_id, conversation_id)
+
+async def _fetch_recent_turns(user_id: str, conversation_id: str, limit: int) -> list[dict]:
+    """履歴キャッシュのミス時だけ呼ばれる。新しい順に取って時系列に戻す"""
+    rows = None
+    if replica is not None and replica.fresh():
+        rows = await asyncio.to_thread(replica.recent_rows, user_id, conversation_id, limit)
+        # 足りない分が保持範囲より前にあるかもしれない時は Supabase で取り直す
+        if len(rows) < limit and not replica.covers(None):
+            rows = None
+    if rows is not None:
+        _record_read("history", "replica")
+    else:
+        _record_read("history", "supabase")
+        sb = await clients.supabase.get()
+        with metrics.stage("supabase_select"):
+            res = await (
+                sb.table("memory_log")
+                .select("created_at,speaker,message,report_key")
+                .eq("user_id", user_id)
+                .eq("conversation_id", conversation_id)
+                .order("created_at", desc=True)
+                .limit(limit)
+                .execute()
+            )
+        rows = list(reversed(res.data or []))
+
+        # read-your-writes（キュー上の行も含める。レプリカには積んだ時点で入っている）
+        seen = {row_identity(r) for r in rows}
+        queued = memory_writer.pending(user_id=user_id, conversation_id=conversation_id)
+        rows += [r for r in queued if row_identity(r) not in seen]
+
+    turns = []
+    for r in rows:
+        msg = (r.get("message") or "").strip()
+        if not msg or r.get("report_key"):  # 日報・要約行は会話ではない
+            continue
+        turns.append({"role": "user" if r.get("speaker") == "user" else "assistant", "content": msg})
+    return turns[-limit:]
 
-def require_api_key(x_api_key: str | None):
-    if x_api_key != JARVIS_API_KEY:
-        raise HTTPException(status_code=401, detail="invalid api key")
+async def _chat_history(tenant: Tenant, conversation_id: str) -> list[dict]:
+    turns = await history_cache.get(
+        (tenant.user_id, conversation_id),
+        lambda: _fetch_recent_turns(tenant.user_id, conversation_id, HISTORY_MAX_TURNS),
+    )
+    return trim_to_budget(turns, HISTORY_TOKEN_BUDGET)
+
+async def _recall_memories(tenant: Tenant, user_text: str) -> list[dict]:
+    """埋め込みが RECALL_EMBED_TIMEOUT_MS、検索が RECALL_BUDGET_MS を超えたら []（想起なしで返答する）"""
+    # インデックスは既定テナント（USER_ID）の行だけで作っている。他テナントには出さない
+    if recall is None or not tenant.is_default:
+        return []
+    # 直近の履歴と重なる分を後で除くので多めに取る
+    return await recall.search(
+        user_text, RECALL_TOP_K * 2, RECALL_BUDGET_MS / 1000, embed_timeout_sec=RECALL_EMBED_TIMEOUT_MS / 1000,
+    )
+
+async def _chat_context(tenant: Tenant, conversation_id: str, user_text: str) -> tuple[list[dict], list[dict]]:
+    # 想起は履歴の取得と並行して走らせる
+    history, memories = await asyncio.gather(
+        _chat_history(tenant, conversation_id),
+        _recall_memories(tenant, user_text),
+    )
+    seen = {t["content"] for t in history}
+    return history, [m for m in memories if m["message"] not in seen][:RECALL_TOP_K]
+
+@lru_cache(maxsize=32)
+def _custom_system_prompt(system: str) -> str:
+    return f"{CHAT_SYSTEM_PROMPT}\n\n{system}"
+
+def _chat_input(payload: ChatIn) -> tuple[str, str]:
+    """(user_text, system_prompt)。本文に前置きを混ぜず、前置きはシステムプロンプト側へ"""
+    user_text = payload.text.strip()
+    if not user_text:
+        raise HTTPException(status_code=400, detail="text is empty")
+
+    mode, system = payload.mode, (payload.system or "").strip()
+    if not system:
+        return user_text, CHAT_SYSTEM_PROMPTS[mode] if mode else CHAT_SYSTEM_PROMPT
+    if system == MODE_PREAMBLES.get(mode):
+        return user_text, CHAT_SYSTEM_PROMPTS[mode]
+    # ゲートウェイ側と前置きの版がずれていても、同じ文面なら同じ文字列を返す
+    return user_text, _custom_system_prompt(system)
+
+def _chat_messages(
+    user_text: str,
+    history: list[dict],
+    memories: list[dict] = (),
+    system_prompt: str = CHAT_SYSTEM_PROMPT,
+) -> list[dict]:
+    # 固定部分（システムプロンプト → 追記だけの履歴）を先に、毎回変わる想起は末尾近くに置く
+    messages = [{"role": "system", "content": system_prompt}, *history]
+    if memories:
+        from recall import format_memories
+
+        messages.append({"role": "system", "content": format_memories(memories)})
+    messages.append({"role": "user", "content": user_text})
+    return messages
+
+def _sse(data: dict, event: str | None = None) -> str:
+    """Server-Sent Events の 1 フレームを組み立てる"""
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class _ReleasingStreamingResponse(StreamingResponse):
+    """
+    送信が終わったら必ず on_close を呼ぶ StreamingResponse。
+    ヘッダ送信前の切断などでジェネレータが一度も回らないと、その finally は実行されないので、
+    レート制限の枠やストリームの後始末はここでも行う（on_close は何度呼ばれてもよいこと）
+    """
+
+    def __init__(self, content, *, on_close, **kwargs) -> None:
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._on_close()
 
 def _jst_day_range(date_yyyy_mm_dd: str | None):
     """JST基準で、その日の [00:00, 翌日00:00) を返す"""
@@ -103,140 +493,391 @@ def _jst_day_range(date_yyyy_mm_dd: str | None):
     next_day = day + timedelta(days=1)
     return day, next_day
 
-def _fetch_day_logs(day_start: datetime, day_end: datetime, conversation_id: str, max_rows: int):
+async def _fetch_day_logs(
+    day_start: datetime,
+    day_end: datetime,
+    user_id: str,
+    conversation_id: str,
+    max_rows: Optional[int] = None,
+):
+    # レプリカが新しく、その日を保持範囲に含んでいれば 1 クエリで済む（キュー上の行も入っている）
+    if replica is not None and replica.fresh() and replica.covers(day_start):
+        _record_read("day", "replica")
+        return await asyncio.to_thread(replica.day_rows, user_id, conversation_id, day_start, day_end, max_rows)
+    _record_read("day", "supabase")
+
     # Supabaseの created_at は ISO文字列で比較できる前提
-    res = (
-        supabase.table("memory_log")
-        .select("created_at,speaker,message,sender_type,persona")
-        .eq("user_id", USER_ID)
-        .eq("conversation_id", conversation_id)
-        .gte("created_at", day_start.isoformat())
-        .lt("created_at", day_end.isoformat())
-        .order("created_at", desc=False)
-        .limit(max_rows)
-        .execute()
+    # 1日分を (created_at, id) の keyset ページングで全部読む（max_rows は任意の上限）。
+    # offset だと同時刻の行がページ境界で重複・欠落し、チャンクの指紋と部分要約がずれる
+    sb = await clients.supabase.get()
+    with metrics.stage("supabase_select"):
+        rows = await fetch_day_rows(
+            sb, user_id, conversation_id, day_start, day_end, page_size=SUMMARY_PAGE_SIZE, max_rows=max_rows,
+        )
+
+    # read-your-writes: まだキューにいる行も足す（送信中の重複は除く）
+    seen = {row_identity(r) for r in rows}
+    queued = memory_writer.pending(
+        user_id=user_id, conversation_id=conversation_id, start=day_start, end=day_end,
     )
-    return res.data or []
+    extra = [r for r in queued if row_identity(r) not in seen]
+    if extra:
+        rows = sorted(rows + extra, key=lambda r: row_identity(r)[0] or "")[:max_rows]
+    return rows
+
+async def _summarize(system_prompt: str, text: str, cache: dict) -> str:
+    completion = await llm.complete(
+        await clients.openai.get(),
+        route="daily_summary",
+        **cache,
+        **router.choose("daily_summary", text=text).params(),
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": text},
+        ],
+        temperature=0.4,
+    )
+    return completion.text
 
-def _build_transcript(rows) -> str:
-    # できるだけ「読みやすい会話ログ」に整形
-    lines = []
-    for r in rows:
-        sp = r.get("speaker") or r.get("sender_type") or "?"
-        msg = (r.get("message") or "").strip()
-        if not msg:
-            continue
-        label = "あなた" if sp == "user" else "Jarvis"
-        lines.append(f"{label}: {msg}")
-    return "\n".join(lines)
+async def _summarize_incremental(rows: list[dict], report_key: str, user_id: str, conv_id: str, cache: dict) -> str:
+    """
+    埋まったチャンクは保存済みの部分要約を再利用し、新しいチャンクと末尾の端数だけ要約する。
+    保存済みでも指紋（content）がチャンクの今の中身と違えば作り直す。
+    """
+    full, tail = chunk_rows(rows, SUMMARY_CHUNK_SIZE)
+    if not full:
+        # 1チャンクに満たない日は従来どおり一発で
+        return await _summarize(DAILY_SUMMARY_PROMPT, build_transcript(tail), cache)
+
+    sb = await clients.supabase.get()
+    with metrics.stage("supabase_select"):
+        res = await (
+            sb.table("memory_log")
+            .select("report_key,message,content")
+            .eq("user_id", user_id)
+            .eq("conversation_id", conv_id)
+            .like("report_key", f"{report_key}-c%")
+            .execute()
+        )
+    stored = {r["report_key"]: r.get("message") or "" for r in (res.data or [])}
+    stored_fp = {r["report_key"]: r.get("content") for r in (res.data or [])}
+
+    keys = [part_key(report_key, i) for i in range(len(full))]
+    fps = [chunk_fingerprint(chunk) for chunk in full]
+    missing = [(i, k) for i, k in enumerate(keys) if k not in stored or stored_fp.get(k) != fps[i]]
+    new_parts = await asyncio.gather(*(
+        _summarize(CHUNK_SUMMARY_PROMPT, build_transcript(full[i]), cache) for i, _ in missing
+    ))
+    if missing:
+        part_rows = []
+        for (i, key), text in zip(missing, new_parts):
+            stored[key] = text
+            part_rows.append({
+                "user_id": user_id,
+                "conversation_id": conv_id,
+                "speaker": "bot",
+                "message": text,
+                "content": fps[i],
+                "sender_type": SUMMARY_PART_SENDER_TYPE,
+                "persona": SUMMARY_PERSONA,
+                "report_key": key,
+            })
+        with metrics.stage("supabase_upsert"):
+            await sb.table("memory_log").upsert(part_rows, on_conflict="report_key").execute()
+        if replica is not None:
+            for r in part_rows:
+                await asyncio.to_thread(replica.upsert_report, r)
+
+    parts = [stored[k] for k in keys]
+    tail_text = build_transcript(tail)
+    if tail_text.strip():
+        parts.append(await _summarize(CHUNK_SUMMARY_PROMPT, tail_text, cache))
+
+    return await _summarize(MERGE_SUMMARY_PROMPT, merge_input(parts), cache)
 
 # -----------------------------
 # Routes
 # -----------------------------
 @app.post("/chat", response_model=ChatOut)
-def chat(payload: ChatIn, x_api_key: str | None = Header(default=None, alias="X-API-KEY")) -> ChatOut:
-    require_api_key(x_api_key)
-    user_text = payload.text.strip()
-    if not user_text:
-        raise HTTPException(status_code=400, detail="text is empty")
-
-    # 1) ユーザー発言を保存
-    log_row("user", user_text)
-
-    # 2) 返事を生成
-    completion = oai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "あなたは親しみやすく、簡潔で、相手の気持ちを汲むアシスタントです。"},
-            {"role": "user", "content": user_text},
-        ],
+async def chat(
+    payload: ChatIn,
+    x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    authorization: str | None = Header(default=None),
+    cache_control: str | None = Header(default=None, alias="Cache-Control"),
+) -> ChatOut:
+    tenant = require_tenant(x_api_key, authorization)
+    user_text, system_prompt = _chat_input(payload)
+    conv_id = payload.conversation_id or tenant.conversation_id
+
+    # 1) 直近の会話を取ってから、ユーザー発言を保存
+    history, memories = await _chat_context(tenant, conv_id, user_text)
+    await log_row(tenant, conv_id, "user", user_text)
+
+    # 2) 返事を生成（同一入力の再送はキャッシュから）。モデルと max_tokens はモードと入力の長さで選ぶ
+    completion = await llm.complete(
+        await clients.openai.get(),
+        route="chat",
+        bypass=llm.cache_bypass(cache_control),
+        quota_key=tenant.id,
+        scope=tenant.id,
+        **router.choose("chat", mode=payload.mode, text=user_text).params(),
+        messages=_chat_messages(user_text, history, memories, system_prompt),
         temperature=0.6,
     )
-    reply = (completion.choices[0].message.content or "").strip()
+    reply = completion.text
 
     # 3) 返答を保存
-    log_row("bot", reply)
+    await log_row(tenant, conv_id, "bot", reply)
 
     now = datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S JST")
     return ChatOut(reply=reply, jst_time=now)
 
+@app.post("/chat/stream")
+async def chat_stream(
+    payload: ChatIn,
+    x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    authorization: str | None = Header(default=None),
+):
+    """
+    /chat のストリーミング版（text/event-stream）。
+    - data: {"delta": "..."} をトークンごとに流す
+    - 最後に event: done で {"reply", "jst_time"} を返す
+    - bot 側の memory_log はストリーム終了後に 1 回だけ書く
+    """
+    tenant = require_tenant(x_api_key, authorization)
+    user_text, system_prompt = _chat_input(payload)
+    conv_id = payload.conversation_id or tenant.conversation_id
+
+    history, memories = await _chat_context(tenant, conv_id, user_text)
+    await log_row(tenant, conv_id, "user", user_text)
+
+    params = dict(
+        **router.choose("chat", mode=payload.mode, text=user_text).params(),
+        messages=_chat_messages(user_text, history, memories, system_prompt),
+        temperature=0.6,
+    )
+    model = params["model"]
+    # レート制限の枠はストリームが終わるまで持つ
+    oai = await clients.openai.get()
+    lease = await llm.acquire("chat", params, key=tenant.id)
+    started = time.perf_counter()
+    try:
+        # ここで測れるのはストリームが開くまで（≒ 最初のトークンまで）
+        with metrics.stage("openai_stream_open"):
+            stream = await oai.chat.completions.create(
+                **params,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+    except BaseException:
+        lease.refund()
+        lease.release()
+        raise
+
+    async def close() -> None:
+        lease.release()
+        await stream.close()
+
+    async def events():
+        parts: list[str] = []
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage.model_dump()
+                    metrics.record_usage("chat", model, usage)
+                    lease.settle(usage.get("total_tokens"))
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield _sse({"delta": delta})
+        except Exception as e:
+            # ヘッダ送信後なので HTTP エラーにはできない → error イベントで通知
+            yield _sse({"detail": f"stream failed: {e}"}, event="error")
+            return
+        finally:
+            await close()
+
+        # ルーターの p95 は非ストリームと揃えて「生成し終わるまで」で見る
+        router.observe("chat", model, time.perf_counter() - started)
+        reply = "".join(parts).strip()
+        await log_row(tenant, conv_id, "bot", reply)
+        now = datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S JST")
+        yield _sse({"reply": reply, "jst_time": now}, event="done")
+
+    return _ReleasingStreamingResponse(
+        events(),
+        on_close=close,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # 動作確認用トップ
 @app.get("/", include_in_schema=False)
-def root():
+async def root():
     return {"service": "jarvis-chat", "ok": True}
 
 # バージョン
 @app.get("/version", include_in_schema=False)
-def version():
+async def version():
     return {"version": APP_VERSION}
 
 # Health Check（Render の /health 監視向け）
 @app.get("/health", include_in_schema=False)
-def health_get():
+async def health_get():
     return {"ok": True}
 
 @app.head("/health", include_in_schema=False)
-def health_head():
+async def health_head():
     return Response(status_code=200)
 
+# Prometheus テキスト形式
+@app.get("/metrics", include_in_schema=False)
+async def metrics_get(authorization: str | None = Header(default=None)):
+    if not metrics.authorized(authorization, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="invalid metrics token")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.post("/daily_summary", response_model=DailySummaryOut)
-def daily_summary(
+async def daily_summary(
     payload: DailySummaryIn,
     x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    authorization: str | None = Header(default=None),
+    cache_control: str | None = Header(default=None, alias="Cache-Control"),
 ) -> DailySummaryOut:
-    require_api_key(x_api_key)
+    tenant = require_tenant(x_api_key, authorization)
 
-    conv_id = payload.conversation_id or CONV_ID
+    conv_id = payload.conversation_id or tenant.conversation_id
+    day_start, _ = _jst_day_range(payload.date)
+    bypass = llm.cache_bypass(cache_control)
+
+    # cron と手動実行が重なっても、要約と report_key の upsert は 1 回だけ
+    key = (tenant.user_id, conv_id, day_start.date(), payload.max_rows, payload.incremental, bypass)
+    return await summary_flight.do(key, lambda: _compute_daily_summary(payload, tenant, conv_id, bypass))
+
+async def _compute_daily_summary(payload: DailySummaryIn, tenant: Tenant, conv_id: str, bypass: bool) -> DailySummaryOut:
     day_start, day_end = _jst_day_range(payload.date)
     date_str = day_start.strftime("%Y-%m-%d")
 
-    rows = _fetch_day_logs(day_start, day_end, conv_id, payload.max_rows)
-    transcript = _build_transcript(rows)
+    report_key = _report_key(tenant, conv_id, day_start)
 
-    if not transcript.strip():
-        summary = "本日の記録はまだありません。"
-    else:
-        system_prompt = (
-            "あなたは「Jarvisたん」です。以下は1日の会話ログです。\n"
-            "・事実を歪めず\n"
-            "・感情と出来事の流れが分かるように\n"
-            "・3〜6文で\n"
-            "・日記として自然な日本語で\n"
-            "・箇条書きは禁止\n"
-            "最後に一言、Jarvisとして短い所感を添えてください。"
-        )
+    rows = await _fetch_day_logs(day_start, day_end, tenant.user_id, conv_id, payload.max_rows)
+    rows = [r for r in conversation_rows(rows) if (r.get("message") or "").strip()]
 
-        completion = oai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": transcript},
-            ],
-            temperature=0.4,
-        )
-        summary = (completion.choices[0].message.content or "").strip()
+    # 過去日のログはもう増えないので、要約は無期限にキャッシュしてよい
+    # （llm.complete へそのまま渡す。キャッシュとレート制限の枠はテナント単位）
+    cache = {"bypass": bypass, "scope": tenant.id, "quota_key": tenant.id}
+    if day_end <= datetime.now(JST).replace(hour=0, minute=0, second=0, microsecond=0):
+        cache["ttl"] = None
 
-    # 1日1行にするキー（同日再実行は上書き）
-    report_key = day_start.strftime("summary-%Y%m%d")
+    if not rows:
+        summary = EMPTY_DAY_SUMMARY
+    elif payload.incremental:
+        summary = await _summarize_incremental(rows, report_key, tenant.user_id, conv_id, cache)
+    else:
+        summary = await _summarize(DAILY_SUMMARY_PROMPT, build_transcript(rows), cache)
 
     row = {
-        "user_id": USER_ID,
+        "user_id": tenant.user_id,
         "conversation_id": conv_id,
         "speaker": "bot",
         "message": summary,
         "content": summary,
-        "sender_type": "summary",
-        "persona": "jarvis-daily-summary",
+        "sender_type": SUMMARY_SENDER_TYPE,
+        "persona": SUMMARY_PERSONA,
         "report_key": report_key,
     }
 
     # report_key で upsert（ユニーク制約が必要）
-    supabase.table("memory_log").upsert(row, on_conflict="report_key").execute()
+    sb = await clients.supabase.get()
+    with metrics.stage("supabase_upsert"):
+        await sb.table("memory_log").upsert(row, on_conflict="report_key").execute()
+    if replica is not None:
+        await asyncio.to_thread(replica.upsert_report, row)
 
     now = datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S JST")
     return DailySummaryOut(date=date_str, summary=summary, jst_time=now)
 
-
-
-
-
+# -----------------------------
+# Stored summaries（読み出しだけ。LLM は呼ばない）
+# -----------------------------
+def _parse_day(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=JST)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"invalid date: {value}")
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match は弱い比較（W/ を無視）。* は何にでも一致"""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+def _conditional_json(body: dict, if_none_match: Optional[str]) -> Response:
+    """本文のバイト列から強い ETag を作り、一致すれば 304（本文なし）"""
+    raw = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha256(raw).hexdigest()[:32] + '"'
+    # POST で作り直されることがあるので、毎回 ETag で確かめてもらう
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(raw, media_type="application/json", headers=headers)
+
+async def _stored_summaries(tenant: Tenant, conv_id: str, days: list[datetime]) -> list[StoredSummaryOut]:
+    """report_key の IN で 1 クエリ。行がある日だけ返す"""
+    keys = {_report_key(tenant, conv_id, day): day for day in days}
+    sb = await clients.supabase.get()
+    with metrics.stage("supabase_select"):
+        res = await (
+            sb.table("memory_log")
+            .select("report_key,message")
+            .eq("user_id", tenant.user_id)
+            .in_("report_key", list(keys))
+            .execute()
+        )
+    found = {r["report_key"]: r.get("message") or "" for r in (res.data or [])}
+    return [
+        StoredSummaryOut(date=day.strftime("%Y-%m-%d"), conversation_id=conv_id, summary=found[key])
+        for key, day in sorted(keys.items(), key=lambda kv: kv[1])
+        if key in found
+    ]
+
+@app.get("/daily_summary/{date}", response_model=StoredSummaryOut)
+async def get_daily_summary(
+    date: str = Path(pattern=DATE_PATTERN),
+    conversation_id: Optional[str] = Query(default=None, pattern=CONVERSATION_ID_PATTERN),
+    x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    authorization: str | None = Header(default=None),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
+):
+    """保存済みのサマリー行を返す（作り直すのは POST /daily_summary だけ）。無ければ 404"""
+    tenant = require_tenant(x_api_key, authorization)
+    conv_id = conversation_id or tenant.conversation_id
+    rows = await _stored_summaries(tenant, conv_id, [_parse_day(date)])
+    if not rows:
+        raise HTTPException(status_code=404, detail=f"no summary for {date}")
+    return _conditional_json(rows[0].model_dump(), if_none_match)
+
+@app.get("/daily_summary", response_model=StoredSummaryListOut)
+async def list_daily_summaries(
+    start: str = Query(pattern=DATE_PATTERN),
+    end: str = Query(pattern=DATE_PATTERN),
+    conversation_id: Optional[str] = Query(default=None, pattern=CONVERSATION_ID_PATTERN),
+    x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    authorization: str | None = Header(default=None),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
+):
+    """カレンダー表示用: [start, end]（両端含む、JST）の保存済みサマリーを 1 クエリで"""
+    tenant = require_tenant(x_api_key, authorization)
+    conv_id = conversation_id or tenant.conversation_id
+    first, last = _parse_day(start), _parse_day(end)
+    n_days = (last - first).days + 1
+    if n_days < 1:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if n_days > SUMMARY_RANGE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"range is limited to {SUMMARY_RANGE_MAX_DAYS} days")
+    days = [first + timedelta(days=i) for i in range(n_days)]
+    body = StoredSummaryListOut(summaries=await _stored_summaries(tenant, conv_id, days))
+    return _conditional_json(body.model_dump(), if_none_match)
@@ -0,0 +1,463 @@
+# backfill.py
+"""
+memory_log の一括バックフィル（再実行・中断再開できる）。
+
+    python backfill.py summaries [--conversation-id live-chat] [--since 2025-01-01] [--until 2025-06-30]
+    python backfill.py normalize-content [--assign-user-id UUID] [--assign-conversation-id post]
+    共通: --workers 4 --page-size 500 --checkpoint PATH --reset --dry-run
+
+- (created_at, id) の keyset ページングで走査（offset を使わないので何ヶ月分でも一定コスト）
+- ページごとに変換を worker プールで並列実行し、結果はページ単位の一括 upsert
+- チェックポイント: 書き込みまで終わった「連続したページ」の末尾カーソルを JSON に保存。
+  落ちても --reset しなければそこから再開する（upsert なので重複実行しても壊れない）
+
+変換:
+  summaries          会話ログがあるのに summary-YYYYMMDD 行が無い日の日次サマリーを作る
+                     （チャンクごとの部分要約 summary-YYYYMMDD-cNNN も保存し、/daily_summary の差分要約で再利用）
+  normalize-content  post.py が書いていた content=[...] 配列・message 無しの旧形式行を
+                     message / content（文字列）/ speaker の現行形式に直す
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Optional
+
+from dotenv import load_dotenv
+
+import clients
+import llm
+import router
+from summarizer import (
+    CHUNK_SUMMARY_PROMPT,
+    DAILY_SUMMARY_PROMPT,
+    MERGE_SUMMARY_PROMPT,
+    JST,
+    SUMMARY_PART_SENDER_TYPE,
+    SUMMARY_SENDER_TYPE,
+    build_transcript,
+    chunk_fingerprint,
+    chunk_rows,
+    conversation_rows,
+    day_bound,
+    fetch_day_rows,
+    merge_input,
+    need,
+    parse_ts,
+    part_key,
+    pg_quote,
+    report_key_for,
+    summary_row,
+)
+from tenants import DEFAULT_CONVERSATION_ID
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+# -----------------------------
+# Checkpoint
+# -----------------------------
+class Checkpoint:
+    """ジョブ名と引数が同じ時だけ再開する（違う条件の途中経過は使わない）"""
+
+    def __init__(self, path: str, job: str, params: dict) -> None:
+        self.path = path
+        self.job = job
+        self.params = params
+        self.cursor: Optional[dict] = None  # {"created_at": ..., "id": ...}
+        self.pages = 0
+        self.scanned = 0
+        self.written = 0
+        self.finished = False
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            st = json.load(f)
+        if st.get("job") != self.job or st.get("params") != self.params:
+            raise SystemExit(f"[FATAL] {self.path} belongs to another run ({st.get('job')} {st.get('params')}); use --reset")
+        self.cursor = st.get("cursor")
+        self.pages = st.get("pages", 0)
+        self.scanned = st.get("scanned", 0)
+        self.written = st.get("written", 0)
+        self.finished = st.get("finished", False)
+
+    def save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "job": self.job,
+                "params": self.params,
+                "cursor": self.cursor,
+                "pages": self.pages,
+                "scanned": self.scanned,
+                "written": self.written,
+                "finished": self.finished,
+                "updated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            }, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+
+# -----------------------------
+# Transforms
+# -----------------------------
+class Transform:
+    name = ""
+    select = "*"
+    on_conflict = "id"
+
+    def filters(self, query):
+        return query
+
+    async def __call__(self, rows: list[dict]) -> list[dict]:
+        """ページの行 → upsert する行"""
+        raise NotImplementedError
+
+
+class NormalizeContent(Transform):
+    name = "normalize-content"
+    select = "*"
+    on_conflict = "id"
+
+    def __init__(self, user_id: Optional[str] = None, conversation_id: Optional[str] = None) -> None:
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+
+    def filters(self, query):
+        # 旧形式は message 列が空
+        return query.is_("message", "null")
+
+    @staticmethod
+    def _text(content) -> Optional[str]:
+        if isinstance(content, str) and content.startswith("["):
+            try:
+                content = json.loads(content)
+            except ValueError:
+                return content
+        if isinstance(content, list):
+            return "\n".join(str(c).strip() for c in content if c is not None and str(c).strip())
+        return content if isinstance(content, str) else None
+
+    async def __call__(self, rows: list[dict]) -> list[dict]:
+        out = []
+        for r in rows:
+            text = self._text(r.get("content"))
+            if text is None:
+                continue
+            fixed = {**r, "message": text, "content": text}
+            if not fixed.get("speaker"):
+                fixed["speaker"] = "bot" if (r.get("sender_type") or "") in ("jarvis", "bot") else "user"
+            if self.user_id and not fixed.get("user_id"):
+                fixed["user_id"] = self.user_id
+            if self.conversation_id and not fixed.get("conversation_id"):
+                fixed["conversation_id"] = self.conversation_id
+            out.append(fixed)
+        return out
+
+
+class SummaryBackfill(Transform):
+    """
+    走査するのは会話の行だけ（created_at と report_key）。ページに含まれる日を拾い、
+    サマリーが無い日はその日のログを読み直して要約する（ページ境界で日が切れても問題ない）。
+    """
+    name = "summaries"
+    select = "id,created_at,report_key"
+    on_conflict = "report_key"
+
+    def __init__(self, sb: "AsyncClient", oai, user_id: str, conversation_id: str, chunk_size: int, page_size: int, force: bool = False) -> None:
+        self.sb = sb
+        self.oai = oai
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+        self.force = force
+        self._claimed: set = set()  # 他の worker が処理中・処理済みの日
+        self.today = datetime.now(JST).date()
+
+    def filters(self, query):
+        return query.eq("user_id", self.user_id).eq("conversation_id", self.conversation_id)
+
+    def _report_key(self, day) -> str:
+        # app.py の /daily_summary と同じキー（既定の会話だけ従来の summary-YYYYMMDD）
+        if self.conversation_id == DEFAULT_CONVERSATION_ID:
+            return report_key_for(day)
+        return report_key_for(day, self.user_id, self.conversation_id)
+
+    async def __call__(self, rows: list[dict]) -> list[dict]:
+        days = {
+            parse_ts(r["created_at"]).astimezone(JST).date()
+            for r in rows
+            if r.get("created_at") and not r.get("report_key")
+        }
+        # 今日の分はまだ増えるので /daily_summary に任せる
+        days = sorted(d for d in days if d < self.today and d not in self._claimed)
+        self._claimed.update(days)
+        if not days:
+            return []
+
+        keys = {self._report_key(d): d for d in days}
+        if not self.force:
+            res = await self.sb.table("memory_log").select("report_key").in_("report_key", list(keys)).execute()
+            for r in res.data or []:
+                keys.pop(r["report_key"], None)
+
+        out: list[dict] = []
+        for batch in await asyncio.gather(*(self._summarize_day(d, k) for k, d in keys.items())):
+            out.extend(batch)
+        return out
+
+    async def _day_rows(self, day) -> list[dict]:
+        start = datetime(day.year, day.month, day.day, tzinfo=JST)
+        return await fetch_day_rows(
+            self.sb, self.user_id, self.conversation_id, start, start + timedelta(days=1),
+            columns="created_at,speaker,message,sender_type,report_key", page_size=self.page_size,
+        )
+
+    async def _summarize(self, prompt: str, text: str) -> str:
+        completion = await llm.complete(
+            self.oai,
+            route="daily_summary",
+            ttl=None,
+            priority=llm.PRIORITY_BATCH,
+            **router.choose("daily_summary", text=text).params(),
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": text},
+            ],
+            temperature=0.4,
+        )
+        return completion.text
+
+    def _row(self, report_key: str, text: str, sender_type: str, content: Optional[str] = None) -> dict:
+        return summary_row(self.user_id, self.conversation_id, report_key, text, sender_type, content)
+
+    async def _summarize_day(self, day, report_key: str) -> list[dict]:
+        rows = [r for r in conversation_rows(await self._day_rows(day)) if (r.get("message") or "").strip()]
+        if not rows:
+            return []
+        full, tail = chunk_rows(rows, self.chunk_size)
+        if not full:
+            summary = await self._summarize(DAILY_SUMMARY_PROMPT, build_transcript(tail))
+            return [self._row(report_key, summary, SUMMARY_SENDER_TYPE)]
+
+        # /daily_summary の差分要約と同じ形で部分要約も残す（次回以降はそのまま再利用される）
+        parts = list(await asyncio.gather(*(
+            self._summarize(CHUNK_SUMMARY_PROMPT, build_transcript(chunk)) for chunk in full
+        )))
+        out = [
+            self._row(part_key(report_key, i), text, SUMMARY_PART_SENDER_TYPE, chunk_fingerprint(chunk))
+            for i, (text, chunk) in enumerate(zip(parts, full))
+        ]
+        if build_transcript(tail).strip():
+            parts.append(await self._summarize(CHUNK_SUMMARY_PROMPT, build_transcript(tail)))
+        summary = await self._summarize(MERGE_SUMMARY_PROMPT, merge_input(parts))
+        out.append(self._row(report_key, summary, SUMMARY_SENDER_TYPE))
+        return out
+
+
+# -----------------------------
+# Runner
+# -----------------------------
+class Backfill:
+    def __init__(
+        self,
+        sb: "AsyncClient",
+        transform: Transform,
+        checkpoint: Checkpoint,
+        *,
+        workers: int = 4,
+        page_size: int = 500,
+        upsert_batch: int = 500,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        dry_run: bool = False,
+        max_retries: int = 3,
+    ) -> None:
+        self.sb = sb
+        self.transform = transform
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.page_size = page_size
+        self.upsert_batch = upsert_batch
+        self.since = since
+        self.until = until
+        self.dry_run = dry_run
+        self.max_retries = max_retries
+        self._done: dict[int, tuple[dict, int, int]] = {}  # 完了したページ seq -> (cursor, 行数, 書いた数)
+        self._next_commit = 0
+        self._started = time.monotonic()
+
+    async def _retry(self, what: str, fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await fn()
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(30.0, 0.5 * 2 ** attempt)
+                print(f"[WARN] {what} failed ({e!r}), retry in {delay:.1f}s", file=sys.stderr)
+                await asyncio.sleep(delay)
+
+    async def _page(self, cursor: Optional[dict]) -> list[dict]:
+        q = self.transform.filters(self.sb.table("memory_log").select(self.transform.select))
+        if self.since:
+            q = q.gte("created_at", self.since)
+        if self.until:
+            q = q.lt("created_at", self.until)
+        if cursor:
+            ts, rid = pg_quote(cursor["created_at"]), cursor["id"]
+            q = q.or_(f"created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{rid})")
+        res = await q.order("created_at", desc=False).order("id", desc=False).limit(self.page_size).execute()
+        return res.data or []
+
+    async def _upsert(self, rows: list[dict]) -> None:
+        from postgrest.types import ReturnMethod
+
+        for i in range(0, len(rows), self.upsert_batch):
+            chunk = rows[i:i + self.upsert_batch]
+            await self._retry("upsert", lambda: self.sb.table("memory_log").upsert(
+                chunk, on_conflict=self.transform.on_conflict, returning=ReturnMethod.minimal,
+            ).execute())
+
+    def _commit(self, seq: int, cursor: dict, scanned: int, written: int) -> None:
+        """連続して完了したページの分だけチェックポイントを進める"""
+        self._done[seq] = (cursor, scanned, written)
+        advanced = False
+        while self._next_commit in self._done:
+            cur, n, w = self._done.pop(self._next_commit)
+            self.checkpoint.cursor = cur
+            self.checkpoint.pages += 1
+            self.checkpoint.scanned += n
+            self.checkpoint.written += w
+            self._next_commit += 1
+            advanced = True
+            if self.checkpoint.pages % 10 == 0:
+                rate = self.checkpoint.scanned / max(time.monotonic() - self._started, 1e-6)
+                print(f"[INFO] pages={self.checkpoint.pages} scanned={self.checkpoint.scanned} written={self.checkpoint.written} ({rate:.0f} rows/s)")
+        if advanced and not self.dry_run:
+            self.checkpoint.save()
+
+    async def run(self) -> Checkpoint:
+        cp = self.checkpoint
+        if cp.finished:
+            print(f"[INFO] {cp.path} says this run already finished; use --reset to start over")
+            return cp
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def producer() -> None:
+            cursor, seq = cp.cursor, 0
+            try:
+                while True:
+                    rows = await self._retry("select", lambda: self._page(cursor))
+                    if not rows:
+                        break
+                    cursor = {"created_at": rows[-1]["created_at"], "id": rows[-1]["id"]}
+                    await queue.put((seq, rows, cursor))
+                    seq += 1
+                    if len(rows) < self.page_size:
+                        break
+            finally:
+                for _ in range(self.workers):
+                    await queue.put(None)
+
+        async def worker() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                seq, rows, cursor = item
+                out = await self.transform(rows)
+                if out and not self.dry_run:
+                    await self._upsert(out)
+                self._commit(seq, cursor, len(rows), len(out))
+
+        tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        cp.finished = True
+        if not self.dry_run:
+            cp.save()
+        return cp
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+async def amain(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Bulk backfill for memory_log")
+    p.add_argument("job", choices=["summaries", "normalize-content"])
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--page-size", type=int, default=500)
+    p.add_argument("--upsert-batch", type=int, default=500)
+    p.add_argument("--since", help="YYYY-MM-DD (JST, inclusive)")
+    p.add_argument("--until", help="YYYY-MM-DD (JST, exclusive)")
+    p.add_argument("--checkpoint", help="default: backfill.<job>.json")
+    p.add_argument("--reset", action="store_true", help="ignore and overwrite the checkpoint")
+    p.add_argument("--dry-run", action="store_true", help="scan and transform but do not write")
+    p.add_argument("--conversation-id", default="live-chat", help="summaries: conversation to summarize")
+    p.add_argument("--chunk-size", type=int, default=int(os.getenv("SUMMARY_CHUNK_SIZE", "40")))
+    p.add_argument("--force", action="store_true", help="summaries: regenerate even if the row exists")
+    p.add_argument("--assign-user-id", help="normalize-content: fill user_id where it is empty")
+    p.add_argument("--assign-conversation-id", help="normalize-content: fill conversation_id where it is empty")
+    args = p.parse_args(argv)
+
+    load_dotenv()
+    need("SUPABASE_URL")
+    os.getenv("SUPABASE_SERVICE_ROLE_KEY") or need("SUPABASE_KEY")
+    sb = await clients.supabase.get()
+
+    if args.job == "summaries":
+        user_id = need("SUPABASE_USER_ID")
+        need("OPENAI_API_KEY")
+        oai = await clients.openai.get()
+        transform: Transform = SummaryBackfill(
+            sb, oai, user_id, args.conversation_id, args.chunk_size, args.page_size, force=args.force,
+        )
+        params = {"conversation_id": args.conversation_id, "user_id": user_id}
+    else:
+        transform = NormalizeContent(args.assign_user_id, args.assign_conversation_id)
+        params = {"assign_user_id": args.assign_user_id, "assign_conversation_id": args.assign_conversation_id}
+    params.update({"since": args.since, "until": args.until})
+
+    checkpoint = Checkpoint(args.checkpoint or f"backfill.{args.job}.json", args.job, params)
+    if not args.reset:
+        checkpoint.load()
+    if checkpoint.cursor:
+        print(f"[INFO] resuming after {checkpoint.cursor} ({checkpoint.scanned} rows already scanned)")
+
+    runner = Backfill(
+        sb,
+        transform,
+        checkpoint,
+        workers=args.workers,
+        page_size=args.page_size,
+        upsert_batch=args.upsert_batch,
+        since=day_bound(args.since),
+        until=day_bound(args.until),
+        dry_run=args.dry_run,
+    )
+    try:
+        cp = await runner.run()
+    finally:
+        await clients.aclose()
+    verb = "would write" if args.dry_run else "written"
+    print(f"[DONE] {args.job}: pages={cp.pages} scanned={cp.scanned} {verb}={cp.written}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(amain()))
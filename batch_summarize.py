@@ -0,0 +1,592 @@
+# batch_summarize.py
+"""
+日次サマリーの一括生成（OpenAI Batch API 形式の JSONL で投げる）。
+
+    python batch_summarize.py run [--since 2025-01-01] [--until 2025-06-30] [--user-id UUID] [--conversation-id live-chat]
+    python batch_summarize.py status
+    共通: --workdir batch_summarize.run --local --poll-sec 30 --force --reset --dry-run
+
+/daily_summary は 1 回の HTTP で (日付, 会話) を 1 つ、同期の completion で要約する。
+溜まった日や会話をまとめて要約する時は、こちらで 1 つのバッチにして投げる（並列リクエストではなく
+バッチの中身を増やしてスループットを出す。Batch API は通常の半額）。
+
+流れ（作業ディレクトリに状態を置く。止まっても同じコマンドで続きから）:
+  collect   memory_log の会話行を (created_at, id) の keyset で走査し、サマリー行が無い
+            (user_id, conversation_id, JST の日) を集める。今日の分は /daily_summary に任せる
+            → plan.json と stage1.requests.jsonl
+  stage 1   1 チャンクに収まる日はその日の要約、それ以上の日はチャンクごとの部分要約。
+            投入 → 完了まで poll → stage1.results.jsonl → 日サマリーと部分要約（summary-...-cNNN）を一括 upsert
+  stage 2   複数チャンクの日だけ、部分要約をまとめる要求を同じ手順で（stage2.*.jsonl）
+state.json に段階ごとのバッチ ID・状態・書いた件数を残す。投入済みのバッチは再投入せず poll から再開する。
+失敗した要求の日は書かない（サマリー行が無いままなので、--reset して流し直せば拾われる）。
+
+--local: Batch API の代わりに同じ JSONL を llm.complete（PRIORITY_BATCH）で流し、同じ形式の結果ファイルを書く
+         （Batch API の無い互換エンドポイントや、ベンチの fake_openai で試す時）
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Optional
+
+from dotenv import load_dotenv
+
+import clients
+import llm
+import router
+from summarizer import (
+    CHUNK_SUMMARY_PROMPT,
+    DAILY_SUMMARY_PROMPT,
+    MERGE_SUMMARY_PROMPT,
+    JST,
+    SUMMARY_PART_SENDER_TYPE,
+    SUMMARY_SENDER_TYPE,
+    build_transcript,
+    chunk_fingerprint,
+    chunk_rows,
+    conversation_rows,
+    day_bound,
+    fetch_day_rows,
+    merge_input,
+    need,
+    parse_ts,
+    part_key,
+    pg_quote,
+    report_key_for,
+    summary_row,
+)
+from tenants import DEFAULT_CONVERSATION_ID
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+TEMPERATURE = 0.4
+ENDPOINT = "/v1/chat/completions"
+TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+
+def _request(custom_id: str, prompt: str, text: str) -> dict:
+    """Batch API の入力 1 行（body は chat.completions.create の引数そのまま）"""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {
+            # /daily_summary と同じ規則でモデルと max_tokens を選ぶ（バッチなので遅延のフォールバックは無い）
+            **router.choose("daily_summary", text=text).params(),
+            "messages": [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": text},
+            ],
+            "temperature": TEMPERATURE,
+        },
+    }
+
+
+def _write_jsonl(path: str, items: list[dict]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for item in items:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+
+
+def _read_results(path: str) -> tuple[dict[str, str], list[str]]:
+    """結果ファイル → ({custom_id: 本文}, 失敗した custom_id)"""
+    texts: dict[str, str] = {}
+    failed: list[str] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            resp = item.get("response") or {}
+            body = resp.get("body") or {}
+            choices = body.get("choices") or []
+            if item.get("error") or resp.get("status_code") != 200 or not choices:
+                failed.append(item["custom_id"])
+                continue
+            texts[item["custom_id"]] = (choices[0]["message"].get("content") or "").strip()
+    return texts, failed
+
+
+# -----------------------------
+# State
+# -----------------------------
+class RunState:
+    """作業ディレクトリの state.json。引数が同じ時だけ再開する"""
+
+    def __init__(self, workdir: str, params: dict) -> None:
+        self.workdir = workdir
+        self.path = os.path.join(workdir, "state.json")
+        self.params = params
+        self.collected = False
+        self.days = 0
+        self.stages: dict[str, dict] = {}
+        self.finished = False
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.workdir, name)
+
+    def stage(self, n: int) -> dict:
+        return self.stages.setdefault(str(n), {})
+
+    def load(self, check: bool = True) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            st = json.load(f)
+        if check and st.get("params") != self.params:
+            raise SystemExit(f"[FATAL] {self.path} belongs to another run ({st.get('params')}); use --reset")
+        self.collected = st.get("collected", False)
+        self.days = st.get("days", 0)
+        self.stages = st.get("stages", {})
+        self.finished = st.get("finished", False)
+
+    def save(self) -> None:
+        os.makedirs(self.workdir, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "params": self.params,
+                "collected": self.collected,
+                "days": self.days,
+                "stages": self.stages,
+                "finished": self.finished,
+                "updated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            }, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+
+# -----------------------------
+# Batch backends
+# -----------------------------
+class OpenAIBatches:
+    """OpenAI Batch API（files.create → batches.create → batches.retrieve → files.content）"""
+
+    def __init__(self, oai) -> None:
+        self.oai = oai
+
+    async def submit(self, path: str) -> str:
+        with open(path, "rb") as f:
+            data = f.read()
+        uploaded = await self.oai.files.create(file=(os.path.basename(path), data), purpose="batch")
+        batch = await self.oai.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=ENDPOINT,
+            completion_window="24h",
+            metadata={"job": "daily_summary"},
+        )
+        return batch.id
+
+    async def poll(self, batch_id: str) -> tuple[str, dict]:
+        batch = await self.oai.batches.retrieve(batch_id)
+        counts = batch.request_counts.model_dump() if batch.request_counts else {}
+        return batch.status, counts
+
+    async def download(self, batch_id: str, path: str) -> None:
+        # 成功分は output_file、失敗分は error_file に分かれて返る。1 つのファイルにまとめる
+        batch = await self.oai.batches.retrieve(batch_id)
+        chunks = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = await self.oai.files.content(file_id)
+                chunks.append(content.text.rstrip("\n"))
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(c for c in chunks if c) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+class LocalBatches:
+    """同じ JSONL を llm.complete で流す stand-in。submit の中で全部終わらせる"""
+
+    def __init__(self, oai, concurrency: int = 8) -> None:
+        self.oai = oai
+        self.concurrency = concurrency
+
+    async def submit(self, path: str) -> str:
+        with open(path, encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(req: dict) -> dict:
+            async with sem:
+                try:
+                    completion = await llm.complete(
+                        self.oai, route="daily_summary", ttl=None, priority=llm.PRIORITY_BATCH, **req["body"],
+                    )
+                except Exception as e:
+                    return {"custom_id": req["custom_id"], "response": None, "error": {"message": repr(e)}}
+            body = {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": completion.text}}],
+                "usage": completion.usage,
+            }
+            return {"custom_id": req["custom_id"], "response": {"status_code": 200, "body": body}, "error": None}
+
+        out_path = path.replace(".requests.", ".local-output.")
+        _write_jsonl(out_path, list(await asyncio.gather(*(one(r) for r in requests))))
+        return "local:" + out_path
+
+    async def poll(self, batch_id: str) -> tuple[str, dict]:
+        return "completed", {}
+
+    async def download(self, batch_id: str, path: str) -> None:
+        os.replace(batch_id[len("local:"):], path)
+
+
+# -----------------------------
+# Pipeline
+# -----------------------------
+class BatchSummarize:
+    def __init__(
+        self,
+        sb: "AsyncClient",
+        backend,
+        state: RunState,
+        *,
+        default_user_id: str,
+        user_id: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        chunk_size: int = 40,
+        page_size: int = 1000,
+        upsert_batch: int = 500,
+        poll_sec: float = 30.0,
+        force: bool = False,
+    ) -> None:
+        self.sb = sb
+        self.backend = backend
+        self.state = state
+        self.default_user_id = default_user_id
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.since = since
+        self.until = until
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+        self.upsert_batch = upsert_batch
+        self.poll_sec = poll_sec
+        self.force = force
+        self.today = datetime.now(JST).date()
+
+    def _report_key(self, day: date, user_id: str, conversation_id: str) -> str:
+        # app.py の /daily_summary と同じキー（既定テナントの既定会話だけ従来の summary-YYYYMMDD）
+        if user_id == self.default_user_id and conversation_id == DEFAULT_CONVERSATION_ID:
+            return report_key_for(day)
+        return report_key_for(day, user_id, conversation_id)
+
+    def _filters(self, query):
+        if self.user_id:
+            query = query.eq("user_id", self.user_id)
+        if self.conversation_id:
+            query = query.eq("conversation_id", self.conversation_id)
+        if self.since:
+            query = query.gte("created_at", self.since)
+        if self.until:
+            query = query.lt("created_at", self.until)
+        return query
+
+    # ---- collect ----
+    async def _pending_days(self) -> list[tuple[str, str, date]]:
+        """会話行のある (user_id, conversation_id, 日) を keyset で全部拾う"""
+        found: set[tuple[str, str, date]] = set()
+        cursor: Optional[dict] = None
+        scanned = 0
+        while True:
+            q = self._filters(
+                self.sb.table("memory_log").select("id,created_at,user_id,conversation_id").is_("report_key", "null")
+            )
+            if cursor:
+                ts = pg_quote(cursor["created_at"])
+                q = q.or_(f"created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{cursor['id']})")
+            res = await q.order("created_at", desc=False).order("id", desc=False).limit(self.page_size).execute()
+            rows = res.data or []
+            for r in rows:
+                if not r.get("user_id") or not r.get("conversation_id") or not r.get("created_at"):
+                    continue  # 旧形式の行（backfill.py normalize-content で直す）
+                day = parse_ts(r["created_at"]).astimezone(JST).date()
+                if day < self.today:
+                    found.add((r["user_id"], r["conversation_id"], day))
+            scanned += len(rows)
+            if len(rows) < self.page_size:
+                break
+            cursor = {"created_at": rows[-1]["created_at"], "id": rows[-1]["id"]}
+        print(f"[INFO] scanned {scanned} rows, {len(found)} (user, conversation, day) with logs")
+        return sorted(found, key=lambda t: (t[2], t[0], t[1]))
+
+    async def _existing(self, keys: list[str]) -> dict[str, dict]:
+        """report_key -> 行（message と、部分要約なら content にチャンクの指紋）"""
+        out: dict[str, dict] = {}
+        for i in range(0, len(keys), 100):
+            res = await self.sb.table("memory_log").select("report_key,message,content").in_("report_key", keys[i:i + 100]).execute()
+            out.update({r["report_key"]: r for r in res.data or []})
+        return out
+
+    async def _day_rows(self, user_id: str, conversation_id: str, day: date) -> list[dict]:
+        start = datetime(day.year, day.month, day.day, tzinfo=JST)
+        return await fetch_day_rows(
+            self.sb, user_id, conversation_id, start, start + timedelta(days=1),
+            columns="created_at,speaker,message,sender_type,report_key", page_size=self.page_size,
+        )
+
+    async def collect(self) -> None:
+        days = await self._pending_days()
+        keyed = [(self._report_key(d, u, c), u, c, d) for u, c, d in days]
+        if not self.force:
+            done = await self._existing([k for k, *_ in keyed])
+            keyed = [t for t in keyed if t[0] not in done]
+
+        plan: list[dict] = []
+        requests: list[dict] = []
+        for report_key, user_id, conv_id, day in keyed:
+            rows = [r for r in conversation_rows(await self._day_rows(user_id, conv_id, day)) if (r.get("message") or "").strip()]
+            if not rows:
+                continue
+            i = len(plan)
+            full, tail = chunk_rows(rows, self.chunk_size)
+            entry = {
+                "user_id": user_id, "conversation_id": conv_id, "day": day.isoformat(),
+                "report_key": report_key, "chunks": len(full), "tail": bool(build_transcript(tail).strip()),
+                "fingerprints": [chunk_fingerprint(chunk) for chunk in full],
+            }
+            plan.append(entry)
+            if not full:
+                requests.append(_request(f"{i}:day", DAILY_SUMMARY_PROMPT, build_transcript(tail)))
+                continue
+            # 保存済みの部分要約は /daily_summary と同じく使い回す
+            stored = {} if self.force else await self._existing([part_key(report_key, j) for j in range(len(full))])
+            for j, chunk in enumerate(full):
+                old = stored.get(part_key(report_key, j))
+                if old is None or old.get("content") != entry["fingerprints"][j]:
+                    requests.append(_request(f"{i}:c{j:03d}", CHUNK_SUMMARY_PROMPT, build_transcript(chunk)))
+            if entry["tail"]:
+                requests.append(_request(f"{i}:tail", CHUNK_SUMMARY_PROMPT, build_transcript(tail)))
+
+        os.makedirs(self.state.workdir, exist_ok=True)
+        with open(self.state.file("plan.json"), "w", encoding="utf-8") as f:
+            json.dump(plan, f, ensure_ascii=False, indent=2)
+        _write_jsonl(self.state.file("stage1.requests.jsonl"), requests)
+        self.state.collected = True
+        self.state.days = len(plan)
+        self.state.stage(1)["requests"] = len(requests)
+        self.state.save()
+        print(f"[INFO] {len(plan)} days to summarize, {len(requests)} requests in stage 1")
+
+    def _plan(self) -> list[dict]:
+        with open(self.state.file("plan.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    # ---- batches ----
+    async def _run_batch(self, n: int) -> tuple[dict[str, str], list[str]]:
+        """stage n の JSONL を投入して結果を読む（投入済みなら poll から）"""
+        st = self.state.stage(n)
+        results_path = self.state.file(f"stage{n}.results.jsonl")
+        if st.get("downloaded"):
+            return _read_results(results_path)
+
+        if not st.get("batch_id"):
+            st["batch_id"] = await self.backend.submit(self.state.file(f"stage{n}.requests.jsonl"))
+            st["submitted_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            self.state.save()
+            print(f"[INFO] stage {n}: submitted {st['batch_id']} ({st.get('requests', 0)} requests)")
+
+        started = time.monotonic()
+        while True:
+            status, counts = await self.backend.poll(st["batch_id"])
+            if status != st.get("status") or counts != st.get("counts"):
+                st["status"], st["counts"] = status, counts
+                self.state.save()
+                print(f"[INFO] stage {n}: {status} {counts} ({time.monotonic() - started:.0f}s)")
+            if status in TERMINAL:
+                break
+            await asyncio.sleep(self.poll_sec)
+
+        if status == "failed":
+            # 入力ファイルの検証エラー等。結果は無い
+            raise SystemExit(f"[FATAL] batch {st['batch_id']} failed; fix the input and rerun with --reset")
+        # expired / cancelled でも終わった分の結果は返ってくる
+        await self.backend.download(st["batch_id"], results_path)
+        st["downloaded"] = True
+        self.state.save()
+        return _read_results(results_path)
+
+    async def _upsert(self, rows: list[dict]) -> None:
+        from postgrest.types import ReturnMethod
+
+        for i in range(0, len(rows), self.upsert_batch):
+            await self.sb.table("memory_log").upsert(
+                rows[i:i + self.upsert_batch], on_conflict="report_key", returning=ReturnMethod.minimal,
+            ).execute()
+
+    @staticmethod
+    def _row(entry: dict, report_key: str, text: str, sender_type: str, content: Optional[str] = None) -> dict:
+        return summary_row(entry["user_id"], entry["conversation_id"], report_key, text, sender_type, content)
+
+    async def stage1(self, plan: list[dict]) -> None:
+        st = self.state.stage(1)
+        if st.get("done") or not st.get("requests"):
+            return
+        texts, failed = await self._run_batch(1)
+        rows = []
+        for i, entry in enumerate(plan):
+            if not entry["chunks"]:
+                if f"{i}:day" in texts:
+                    rows.append(self._row(entry, entry["report_key"], texts[f"{i}:day"], SUMMARY_SENDER_TYPE))
+                continue
+            fps = entry.get("fingerprints") or [None] * entry["chunks"]  # 指紋を持たない古い plan.json
+            for j in range(entry["chunks"]):
+                text = texts.get(f"{i}:c{j:03d}")
+                if text is not None:
+                    rows.append(self._row(entry, part_key(entry["report_key"], j), text, SUMMARY_PART_SENDER_TYPE, fps[j]))
+        await self._upsert(rows)
+        st.update({"written": len(rows), "failed": failed, "done": True})
+        self.state.save()
+        print(f"[INFO] stage 1: wrote {len(rows)} rows, {len(failed)} failed")
+
+    async def stage2(self, plan: list[dict]) -> None:
+        st = self.state.stage(2)
+        if st.get("done"):
+            return
+        if "requests" not in st:
+            tails, _ = _read_results(self.state.file("stage1.results.jsonl")) if self.state.stage(1).get("requests") else ({}, [])
+            requests, skipped = [], 0
+            for i, entry in enumerate(plan):
+                if not entry["chunks"]:
+                    continue
+                keys = [part_key(entry["report_key"], j) for j in range(entry["chunks"])]
+                stored = await self._existing(keys)
+                fps = entry.get("fingerprints")
+                if (
+                    any(k not in stored for k in keys)
+                    or (fps and any(stored[k].get("content") != fp for k, fp in zip(keys, fps)))
+                    or (entry["tail"] and f"{i}:tail" not in tails)
+                ):
+                    skipped += 1  # 部分要約が揃わなかった日（stage 1 の失敗）
+                    continue
+                parts = [stored[k].get("message") or "" for k in keys]
+                if entry["tail"]:
+                    parts.append(tails[f"{i}:tail"])
+                requests.append(_request(f"{i}:merge", MERGE_SUMMARY_PROMPT, merge_input(parts)))
+            _write_jsonl(self.state.file("stage2.requests.jsonl"), requests)
+            st.update({"requests": len(requests), "skipped": skipped})
+            self.state.save()
+        if not st["requests"]:
+            st["done"] = True
+            self.state.save()
+            return
+
+        texts, failed = await self._run_batch(2)
+        rows = [
+            self._row(entry, entry["report_key"], texts[f"{i}:merge"], SUMMARY_SENDER_TYPE)
+            for i, entry in enumerate(plan)
+            if f"{i}:merge" in texts
+        ]
+        await self._upsert(rows)
+        st.update({"written": len(rows), "failed": failed, "done": True})
+        self.state.save()
+        print(f"[INFO] stage 2: wrote {len(rows)} rows, {len(failed)} failed")
+
+    async def run(self, dry_run: bool = False) -> RunState:
+        state = self.state
+        if state.finished:
+            print(f"[INFO] {state.path} says this run already finished; use --reset to start over")
+            return state
+        if not state.collected:
+            await self.collect()
+        if dry_run:
+            return state
+        plan = self._plan()
+        await self.stage1(plan)
+        await self.stage2(plan)
+        state.finished = True
+        state.save()
+        return state
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+def _print_status(state: RunState) -> None:
+    print(f"days={state.days} collected={state.collected} finished={state.finished}")
+    for n, st in sorted(state.stages.items()):
+        failed = st.get("failed") or []
+        print(
+            f"stage {n}: requests={st.get('requests', 0)} batch={st.get('batch_id') or '-'} "
+            f"status={st.get('status') or '-'} written={st.get('written', 0)} failed={len(failed)}"
+        )
+
+
+async def amain(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Batch daily summaries for many conversations and dates")
+    p.add_argument("command", choices=["run", "status"])
+    p.add_argument("--workdir", default="batch_summarize.run", help="state, plan and JSONL files")
+    p.add_argument("--since", help="YYYY-MM-DD (JST, inclusive)")
+    p.add_argument("--until", help="YYYY-MM-DD (JST, exclusive)")
+    p.add_argument("--user-id", help="only this user (default: every user)")
+    p.add_argument("--conversation-id", help="only this conversation (default: every conversation)")
+    p.add_argument("--chunk-size", type=int, default=int(os.getenv("SUMMARY_CHUNK_SIZE", "40")))
+    p.add_argument("--page-size", type=int, default=1000)
+    p.add_argument("--poll-sec", type=float, default=30.0)
+    p.add_argument("--local", action="store_true", help="run the JSONL through chat.completions instead of the Batch API")
+    p.add_argument("--force", action="store_true", help="regenerate even if the summary row exists")
+    p.add_argument("--reset", action="store_true", help="ignore and overwrite the saved state")
+    p.add_argument("--dry-run", action="store_true", help="collect and write the stage 1 JSONL only")
+    args = p.parse_args(argv)
+
+    params = {
+        "since": args.since, "until": args.until, "user_id": args.user_id,
+        "conversation_id": args.conversation_id, "chunk_size": args.chunk_size,
+        "force": args.force, "local": args.local,
+    }
+    state = RunState(args.workdir, params)
+    if args.command == "status":
+        if not os.path.exists(state.path):
+            print(f"[INFO] no state in {args.workdir}")
+            return 0
+        state.load(check=False)
+        _print_status(state)
+        return 0
+
+    load_dotenv()
+    need("SUPABASE_URL")
+    os.getenv("SUPABASE_SERVICE_ROLE_KEY") or need("SUPABASE_KEY")
+    need("OPENAI_API_KEY")
+    if not args.reset:
+        state.load()
+    elif os.path.exists(state.path):
+        os.remove(state.path)
+    if state.collected and not state.finished:
+        print(f"[INFO] resuming {args.workdir}")
+
+    sb = await clients.supabase.get()
+    oai = await clients.openai.get()
+    runner = BatchSummarize(
+        sb,
+        LocalBatches(oai) if args.local else OpenAIBatches(oai),
+        state,
+        default_user_id=os.getenv("SUPABASE_USER_ID", ""),
+        user_id=args.user_id,
+        conversation_id=args.conversation_id,
+        since=day_bound(args.since),
+        until=day_bound(args.until),
+        chunk_size=args.chunk_size,
+        page_size=args.page_size,
+        poll_sec=args.poll_sec,
+        force=args.force,
+    )
+    try:
+        await runner.run(dry_run=args.dry_run)
+    finally:
+        await clients.aclose()
+    _print_status(state)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(amain()))
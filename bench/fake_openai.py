@@ -0,0 +1,195 @@
+# bench/fake_openai.py
+"""
+ベンチ用の OpenAI スタンドイン（/v1/chat/completions, /v1/embeddings）。
+
+- 最初のトークンまで FAKE_OPENAI_LATENCY_MS 待ち、その後 FAKE_OPENAI_TOKENS_PER_SEC で出力
+- 返すトークン数は max_tokens と FAKE_OPENAI_REPLY_TOKENS の小さい方
+- stream=True なら SSE（stream_options.include_usage にも対応）、n にも対応
+- usage は文字数からの概算（実モデルと同じ桁になれば十分）
+- プロンプト接頭辞キャッシュも真似る: 以前と同じ先頭メッセージ列の分を
+  usage.prompt_tokens_details.cached_tokens に入れる（FAKE_OPENAI_PREFIX_CACHE_MIN_TOKENS 以上、128 刻み）
+- 埋め込みは文字 bigram のハッシュ（FAKE_OPENAI_EMBED_DIM 次元）。似た文は似たベクトルになる
+
+起動: uvicorn --app-dir bench fake_openai:app --port 18001
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY_MS = float(os.getenv("FAKE_OPENAI_LATENCY_MS", "300"))
+TOKENS_PER_SEC = float(os.getenv("FAKE_OPENAI_TOKENS_PER_SEC", "50"))
+REPLY_TOKENS = int(os.getenv("FAKE_OPENAI_REPLY_TOKENS", "60"))
+EMBED_DIM = int(os.getenv("FAKE_OPENAI_EMBED_DIM", "1536"))
+EMBED_LATENCY_MS = float(os.getenv("FAKE_OPENAI_EMBED_LATENCY_MS", "50"))
+PREFIX_CACHE_MIN_TOKENS = int(os.getenv("FAKE_OPENAI_PREFIX_CACHE_MIN_TOKENS", "1024"))
+
+# 1 トークン ≒ 日本語 1〜2 文字
+_WORDS = ["了解", "です", "。", "ジャー", "ビス", "は", "今日", "も", "元気", "に", "動い", "て", "い", "ます", "、"]
+
+app = FastAPI(title="fake-openai")
+
+stats = {"requests": 0, "streams": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "embedding_inputs": 0}
+
+# 接頭辞（model + 先頭 i 件のメッセージ）のハッシュ。古いものから捨てる
+_prefixes: dict[bytes, None] = {}
+_PREFIX_MAX = 50_000
+
+
+def _tokens(n: int, seed: int) -> list[str]:
+    return [_WORDS[(seed + i) % len(_WORDS)] for i in range(n)]
+
+
+def _content(m: dict) -> str:
+    content = m.get("content") or ""
+    if isinstance(content, list):
+        content = "".join(str(p.get("text", "")) for p in content if isinstance(p, dict))
+    return str(content)
+
+
+def _prompt_tokens(messages: list) -> int:
+    return max(1, sum(len(_content(m).encode("utf-8")) for m in messages) // 3)
+
+
+def _cached_tokens(model: str, messages: list) -> int:
+    h = hashlib.blake2b(model.encode("utf-8"), digest_size=16)
+    size = hit = 0
+    for m in messages:
+        h.update(json.dumps([m.get("role"), _content(m)], ensure_ascii=False).encode("utf-8"))
+        size += len(_content(m).encode("utf-8"))
+        key = h.copy().digest()
+        if key in _prefixes:
+            hit = size // 3
+        else:
+            _prefixes[key] = None
+    while len(_prefixes) > _PREFIX_MAX:
+        del _prefixes[next(iter(_prefixes))]
+    if hit < PREFIX_CACHE_MIN_TOKENS:
+        return 0
+    return hit // 128 * 128
+
+
+def _usage(prompt_tokens: int, cached: int, completion_tokens: int) -> dict:
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_tokens"] += cached
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def _reply_len(body: dict) -> int:
+    limit = body.get("max_tokens") or body.get("max_completion_tokens") or REPLY_TOKENS
+    return max(1, min(int(limit), REPLY_TOKENS))
+
+
+async def _emit_delay(n_tokens: int) -> None:
+    if TOKENS_PER_SEC > 0:
+        await asyncio.sleep(n_tokens / TOKENS_PER_SEC)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    model = body.get("model", "fake")
+    n = int(body.get("n") or 1)
+    n_tokens = _reply_len(body)
+    prompt_tokens = _prompt_tokens(body.get("messages", []))
+    cached = _cached_tokens(model, body.get("messages", []))
+    cid = "chatcmpl-" + uuid.uuid4().hex[:12]
+    created = int(time.time())
+
+    if body.get("stream"):
+        stats["streams"] += 1
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        async def gen():
+            await asyncio.sleep(LATENCY_MS / 1000)
+            for i, tok in enumerate(_tokens(n_tokens, 0)):
+                if i:
+                    await _emit_delay(1)
+                chunk = {
+                    "id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": tok}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            last = {
+                "id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            yield f"data: {json.dumps(last)}\n\n"
+            if include_usage:
+                usage = {
+                    "id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [],
+                    "usage": _usage(prompt_tokens, cached, n_tokens),
+                }
+                yield f"data: {json.dumps(usage)}\n\n"
+            stats["completion_tokens"] += n_tokens
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    # n 本は並列に生成される想定なので待ち時間は 1 本分
+    await asyncio.sleep(LATENCY_MS / 1000)
+    await _emit_delay(n_tokens)
+    choices = [
+        {"index": i, "message": {"role": "assistant", "content": "".join(_tokens(n_tokens, i))}, "finish_reason": "stop"}
+        for i in range(n)
+    ]
+    stats["completion_tokens"] += n_tokens * n
+    return JSONResponse({
+        "id": cid,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": choices,
+        "usage": _usage(prompt_tokens, cached, n_tokens * n),
+    })
+
+
+def _embed(text: str) -> list[float]:
+    vec = [0.0] * EMBED_DIM
+    for i in range(max(1, len(text) - 1)):
+        h = int.from_bytes(hashlib.blake2b(text[i:i + 2].encode("utf-8"), digest_size=8).digest(), "little")
+        vec[h % EMBED_DIM] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = sum(v * v for v in vec) ** 0.5 or 1.0
+    return [v / norm for v in vec]
+
+
+@app.get("/v1/models")
+def models():
+    # clients.py のウォームアップ用
+    return {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model", "created": 0, "owned_by": "fake"}]}
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body.get("input")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    stats["embedding_inputs"] += len(inputs)
+    await asyncio.sleep(EMBED_LATENCY_MS / 1000)
+    tokens = sum(len(t.encode("utf-8")) // 3 for t in inputs)
+    return JSONResponse({
+        "object": "list",
+        "model": body.get("model", "fake-embedding"),
+        "data": [{"object": "embedding", "index": i, "embedding": _embed(t)} for i, t in enumerate(inputs)],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    })
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
@@ -0,0 +1,229 @@
+# bench/fake_supabase.py
+"""
+ベンチ用の Supabase (PostgREST) スタンドイン。テーブルはメモリ上に持つ。
+
+対応しているのは supabase-py が app.py 等から実際に投げる範囲だけ:
+- GET    /rest/v1/{table}?select=..&col=eq.x&col=gte.x&col=like.x*&col=in.(a,b)&order=col.desc&limit=&offset=
+         or=(a.gt.x,and(a.eq.x,id.gt.n)) のような論理式（keyset ページング用）、Range ヘッダでのページングも可
+- POST   /rest/v1/{table}            （1 件 / 配列、Prefer: resolution=merge-duplicates + on_conflict で upsert）
+- 各リクエストに FAKE_SUPABASE_LATENCY_MS の遅延
+
+起動: uvicorn --app-dir bench fake_supabase:app --port 18002
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import os
+import re
+from datetime import datetime, timezone
+from typing import Any
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+LATENCY_MS = float(os.getenv("FAKE_SUPABASE_LATENCY_MS", "20"))
+
+app = FastAPI(title="fake-supabase")
+
+tables: dict[str, list[dict]] = {}
+_ids = itertools.count(1)
+
+stats = {"selects": 0, "inserts": 0, "rows_inserted": 0}
+
+_RESERVED = {"select", "order", "limit", "offset", "on_conflict", "columns", "or", "and"}
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _parse_ts(v: Any):
+    if not isinstance(v, str) or len(v) < 10 or v[4] != "-":
+        return None
+    try:
+        dt = datetime.fromisoformat(v.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _cmp_value(v: Any):
+    """数値は数値、timestamptz は datetime、それ以外は文字列で比較（PostgREST はクエリ値を文字列で受ける）"""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return (0, v)
+    if isinstance(v, str) and re.fullmatch(r"-?\d+(\.\d+)?", v):
+        return (0, float(v))
+    ts = _parse_ts(v)
+    if ts is not None:
+        return (1, ts)
+    return (2, "" if v is None else str(v))
+
+
+def _like(value: Any, pattern: str, ignore_case: bool = False) -> bool:
+    # PostgREST は % の代わりに * も受け付ける
+    rx = "".join(".*" if c in "*%" else "." if c == "_" else re.escape(c) for c in pattern)
+    return re.fullmatch(rx, "" if value is None else str(value), re.I if ignore_case else 0) is not None
+
+
+def _split_top(s: str) -> list[str]:
+    """カンマ区切り。ただし括弧と "..." の中は区切らない"""
+    parts, depth, quoted, cur = [], 0, False, []
+    for ch in s:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ",":
+            parts.append("".join(cur))
+            cur = []
+            continue
+        cur.append(ch)
+    parts.append("".join(cur))
+    return [p for p in parts if p]
+
+
+def _match_logic(row: dict, op: str, body: str) -> bool:
+    """or=(...) / and=(...) 。中身は col.op.value または入れ子の or(...) / and(...)"""
+    if body.startswith("(") and body.endswith(")"):
+        body = body[1:-1]
+    results = []
+    for term in _split_top(body):
+        head, _, rest = term.partition("(")
+        if head in ("or", "and") and term.endswith(")"):
+            results.append(_match_logic(row, head, "(" + rest))
+        else:
+            col, _, expr = term.partition(".")
+            results.append(_match(row, col, _unquote(expr)))
+    return any(results) if op == "or" else all(results)
+
+
+def _unquote(expr: str) -> str:
+    op, _, raw = expr.partition(".")
+    if len(raw) >= 2 and raw[0] == raw[-1] == '"':
+        raw = raw[1:-1]
+    return f"{op}.{raw}"
+
+
+def _in_values(raw: str) -> list[str]:
+    inner = raw[1:-1] if raw.startswith("(") and raw.endswith(")") else raw
+    return [v.strip().strip('"') for v in inner.split(",")]
+
+
+def _match(row: dict, col: str, expr: str) -> bool:
+    op, _, raw = expr.partition(".")
+    negate = False
+    if op == "not":
+        negate = True
+        op, _, raw = raw.partition(".")
+    v = row.get(col)
+    if op == "eq":
+        ok = v is not None and _cmp_value(v) == _cmp_value(raw)
+    elif op == "neq":
+        ok = v is not None and _cmp_value(v) != _cmp_value(raw)
+    elif op in ("gt", "gte", "lt", "lte"):
+        if v is None:
+            ok = False
+        else:
+            a, b = _cmp_value(v), _cmp_value(raw)
+            ok = {"gt": a > b, "gte": a >= b, "lt": a < b, "lte": a <= b}[op]
+    elif op == "like":
+        ok = _like(v, raw)
+    elif op == "ilike":
+        ok = _like(v, raw, ignore_case=True)
+    elif op == "in":
+        ok = v is not None and str(v) in _in_values(raw)
+    elif op == "is":
+        ok = v is None if raw == "null" else str(v).lower() == raw
+    else:
+        ok = True
+    return ok != negate
+
+
+def _order(rows: list[dict], spec: str) -> list[dict]:
+    # order=created_at.desc,id.asc → 後ろのキーから安定ソート
+    for part in reversed([p for p in spec.split(",") if p]):
+        col, *mods = part.split(".")
+        desc = "desc" in mods
+        rows = sorted(rows, key=lambda r: (r.get(col) is None, _cmp_value(r.get(col))), reverse=desc)
+    return rows
+
+
+def _project(row: dict, select: str) -> dict:
+    if not select or select == "*":
+        return dict(row)
+    cols = [c.strip() for c in select.split(",") if c.strip()]
+    return {c: row.get(c) for c in cols}
+
+
+@app.get("/rest/v1/{table}")
+async def select(table: str, request: Request):
+    await asyncio.sleep(LATENCY_MS / 1000)
+    stats["selects"] += 1
+    rows = tables.get(table, [])
+    params = request.query_params
+    for col, expr in params.multi_items():
+        if col in ("or", "and"):
+            rows = [r for r in rows if _match_logic(r, col, expr)]
+        elif col not in _RESERVED:
+            rows = [r for r in rows if _match(r, col, expr)]
+    if params.get("order"):
+        rows = _order(rows, params["order"])
+
+    offset = int(params.get("offset") or 0)
+    limit = int(params["limit"]) if params.get("limit") else None
+    rng = request.headers.get("range")
+    if rng and "-" in rng:
+        lo, hi = rng.split("-", 1)
+        offset, limit = int(lo), int(hi) - int(lo) + 1
+    rows = rows[offset:offset + limit] if limit is not None else rows[offset:]
+
+    select_cols = params.get("select", "*")
+    return JSONResponse([_project(r, select_cols) for r in rows])
+
+
+@app.post("/rest/v1/{table}")
+async def insert(table: str, request: Request):
+    await asyncio.sleep(LATENCY_MS / 1000)
+    stats["inserts"] += 1
+    body = await request.json()
+    items = body if isinstance(body, list) else [body]
+    prefer = request.headers.get("prefer", "")
+    on_conflict = request.query_params.get("on_conflict")
+    merge = "merge-duplicates" in prefer and on_conflict
+    rows = tables.setdefault(table, [])
+
+    written = []
+    for item in items:
+        conflict_cols = on_conflict.split(",") if merge else []
+        existing = None
+        if conflict_cols:
+            existing = next(
+                (r for r in rows if all(r.get(c) == item.get(c) for c in conflict_cols)),
+                None,
+            )
+        if existing is not None:
+            existing.update(item)
+            written.append(existing)
+            continue
+        row = {"id": next(_ids), "created_at": _now_iso(), **item}
+        rows.append(row)
+        written.append(row)
+    stats["rows_inserted"] += len(written)
+
+    if "return=representation" in prefer:
+        return JSONResponse(written, status_code=201)
+    return Response(status_code=201)
+
+
+@app.get("/stats")
+def get_stats():
+    return {**stats, "tables": {name: len(rows) for name, rows in tables.items()}}
+
+
+@app.post("/reset")
+def reset():
+    tables.clear()
+    return {"ok": True}
@@ -0,0 +1,354 @@
+# bench/run.py
+"""
+オフラインの負荷テスト。OpenAI / Supabase はローカルのスタンドインに差し替えて、
+app.py（/mushroom 含む）と jarvis_gateway.py を実プロセスとして立ち上げて叩く。
+
+    python bench/run.py                                  # 既定: 全シナリオ × 並列 1,8,32
+    python bench/run.py --scenarios chat,gateway_chat --concurrency 4,16 --requests 300
+    python bench/run.py --out before.json
+    python bench/run.py --out after.json --compare before.json
+
+- シナリオ: chat / chat_stream / daily_summary / mushroom / gateway_chat
+- 結果はシナリオ × 並列度ごとに p50/p95/p99/平均（ms）・RPS・エラー数（chat_stream は TTFT も）
+- JSON はキー順固定・インデント付きなので、そのまま diff できる
+- OpenAI の遅延・トークン速度、Supabase の遅延はオプションで変えられる（スタンドインの環境変数に渡す）
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+JST = timezone(timedelta(hours=9))
+
+API_KEY = "bench-key"
+USER_ID = "bench-user"
+CONV_ID = "live-chat"  # app.py の CONV_ID と同じ
+SUMMARY_DATE = "2024-01-15"  # 過去日（要約は無期限キャッシュ対象）
+
+SCENARIOS = ("chat", "chat_stream", "daily_summary", "mushroom", "gateway_chat")
+
+# 本文の通し番号（並列度・ウォームアップをまたいで一意にする）
+_SEQ = itertools.count()
+
+
+# -----------------------------
+# Processes
+# -----------------------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Service:
+    def __init__(self, name: str, target: str, env: dict, app_dir: Path, log_dir: Path) -> None:
+        self.name = name
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log_path = log_dir / f"{name}.log"
+        self._log = open(self.log_path, "wb")
+        self.proc = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", target,
+                "--app-dir", str(app_dir),
+                "--host", "127.0.0.1", "--port", str(self.port),
+                "--log-level", "warning", "--no-access-log",
+            ],
+            cwd=str(log_dir),
+            env={**os.environ, **env},
+            stdout=self._log,
+            stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, path: str, timeout: float = 30.0) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                if httpx.get(self.url + path, timeout=1.0).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"{self.name} did not start; see {self.log_path}")
+
+    def stop(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self._log.close()
+
+
+def start_stack(args, workdir: Path) -> dict[str, Service]:
+    services: dict[str, Service] = {}
+    try:
+        services["openai"] = Service("fake_openai", "fake_openai:app", {
+            "FAKE_OPENAI_LATENCY_MS": str(args.openai_latency_ms),
+            "FAKE_OPENAI_TOKENS_PER_SEC": str(args.tokens_per_sec),
+            "FAKE_OPENAI_REPLY_TOKENS": str(args.reply_tokens),
+        }, BENCH_DIR, workdir)
+        services["supabase"] = Service("fake_supabase", "fake_supabase:app", {
+            "FAKE_SUPABASE_LATENCY_MS": str(args.supabase_latency_ms),
+        }, BENCH_DIR, workdir)
+        services["openai"].wait_ready("/stats")
+        services["supabase"].wait_ready("/stats")
+
+        app_env = {
+            "OPENAI_API_KEY": "sk-bench",
+            "OPENAI_BASE_URL": services["openai"].url + "/v1",
+            "SUPABASE_URL": services["supabase"].url,
+            "SUPABASE_SERVICE_ROLE_KEY": "bench.service.key",  # JWT 風の形だけ合わせる
+            "SUPABASE_USER_ID": USER_ID,
+            "JARVIS_API_KEY": API_KEY,
+            "MEMORY_LOG_SPILL_PATH": str(workdir / "memory_log.spill.jsonl"),
+            "LLM_CACHE_PATH": str(workdir / "llm_cache.sqlite3"),
+        }
+        services["app"] = Service("app", "app:app", app_env, REPO_DIR, workdir)
+        services["app"].wait_ready("/health")
+
+        services["gateway"] = Service("gateway", "jarvis_gateway:app", {
+            "UPSTREAM_BASE_URL": services["app"].url,
+            "UPSTREAM_API_KEY": API_KEY,
+        }, REPO_DIR, workdir)
+        services["gateway"].wait_ready("/health")
+    except Exception:
+        for s in services.values():
+            s.stop()
+        raise
+    return services
+
+
+def seed_day(supabase_url: str, rows: int) -> None:
+    """SUMMARY_DATE の会話ログを rows 行だけ入れておく"""
+    day = datetime.strptime(SUMMARY_DATE, "%Y-%m-%d").replace(hour=9, tzinfo=JST)
+    step = timedelta(seconds=max(1, 12 * 3600 // max(rows, 1)))
+    batch = []
+    for i in range(rows):
+        speaker = "user" if i % 2 == 0 else "bot"
+        text = f"ベンチ用の発言 {i} です。今日は温室の湿度を確認しました。"
+        batch.append({
+            "user_id": USER_ID,
+            "conversation_id": CONV_ID,
+            "speaker": speaker,
+            "message": text,
+            "content": text,
+            "sender_type": speaker,
+            "created_at": (day + step * i).astimezone(timezone.utc).isoformat(),
+        })
+    for i in range(0, len(batch), 500):
+        httpx.post(f"{supabase_url}/rest/v1/memory_log", json=batch[i:i + 500], timeout=30).raise_for_status()
+
+
+# -----------------------------
+# Load
+# -----------------------------
+def _percentile(sorted_values: list[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return round(sorted_values[i], 2)
+
+
+def _summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    done = len(ordered)
+    return {
+        "requests": done + errors,
+        "errors": errors,
+        "rps": round(done / elapsed, 2) if elapsed > 0 else None,
+        "p50_ms": _percentile(ordered, 50),
+        "p95_ms": _percentile(ordered, 95),
+        "p99_ms": _percentile(ordered, 99),
+        "mean_ms": round(sum(ordered) / done, 2) if done else None,
+    }
+
+
+def _request_for(scenario: str, i: int, urls: dict[str, str]) -> tuple[str, dict, dict]:
+    """(url, json, headers)。本文は毎回変えて、キャッシュや重複排除に当たらないようにする"""
+    headers = {"X-API-Key": API_KEY}
+    if scenario in ("chat", "chat_stream"):
+        path = "/chat" if scenario == "chat" else "/chat/stream"
+        return urls["app"] + path, {"text": f"ベンチ {i}: 今日の予定を教えて"}, headers
+    if scenario == "daily_summary":
+        # 毎回計算させる（同時に来た同一リクエストは single-flight でまとまる）
+        headers["Cache-Control"] = "no-cache"
+        return urls["app"] + "/daily_summary", {"date": SUMMARY_DATE}, headers
+    if scenario == "mushroom":
+        return urls["app"] + "/mushroom/generate", {"seed": f"朝の森 {i}", "count": 3}, headers
+    if scenario == "gateway_chat":
+        return urls["gateway"] + "/chat", {"text": f"ゲートウェイ {i}: 調子はどう？"}, {}
+    raise ValueError(scenario)
+
+
+async def _one(client: httpx.AsyncClient, scenario: str, url: str, body: dict, headers: dict) -> tuple[float, Optional[float]]:
+    """(全体の秒数, 最初のイベントまでの秒数)。失敗は例外"""
+    started = time.perf_counter()
+    if scenario != "chat_stream":
+        res = await client.post(url, json=body, headers=headers)
+        res.raise_for_status()
+        return time.perf_counter() - started, None
+
+    first: Optional[float] = None
+    async with client.stream("POST", url, json=body, headers=headers) as res:
+        res.raise_for_status()
+        async for chunk in res.aiter_bytes():
+            if first is None and chunk:
+                first = time.perf_counter() - started
+    return time.perf_counter() - started, first
+
+
+async def run_level(scenario: str, concurrency: int, total: int, urls: dict[str, str], timeout: float) -> dict:
+    latencies: list[float] = []
+    ttfts: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def worker() -> None:
+            nonlocal errors
+            for _ in counter:
+                url, body, headers = _request_for(scenario, next(_SEQ), urls)
+                try:
+                    elapsed, first = await _one(client, scenario, url, body, headers)
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(elapsed * 1000)
+                if first is not None:
+                    ttfts.append(first * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    result = _summarize(latencies, errors, elapsed)
+    if scenario == "chat_stream":
+        ordered = sorted(ttfts)
+        result.update({
+            "ttft_p50_ms": _percentile(ordered, 50),
+            "ttft_p95_ms": _percentile(ordered, 95),
+            "ttft_p99_ms": _percentile(ordered, 99),
+        })
+    return result
+
+
+# -----------------------------
+# Report
+# -----------------------------
+def _git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    """p50/p95/p99/rps の変化を表にする（+ は遅くなった / RPS は増えた）"""
+    lines = [f"{'scenario':<16}{'c':>5}  {'metric':<8}{'before':>10}{'after':>10}{'delta':>9}"]
+    for scenario, levels in sorted(new.get("results", {}).items()):
+        for level, cur in sorted(levels.items(), key=lambda kv: int(kv[0][1:])):
+            prev = old.get("results", {}).get(scenario, {}).get(level)
+            if not prev:
+                continue
+            for metric in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+                a, b = prev.get(metric), cur.get(metric)
+                if a is None or b is None:
+                    continue
+                delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+                lines.append(f"{scenario:<16}{level[1:]:>5}  {metric:<8}{a:>10}{b:>10}{delta:>9}")
+    return lines
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Offline load test for app.py / jarvis_gateway.py")
+    p.add_argument("--scenarios", default=",".join(SCENARIOS))
+    p.add_argument("--concurrency", default="1,8,32", help="comma separated levels")
+    p.add_argument("--requests", type=int, default=200, help="requests per scenario and level")
+    p.add_argument("--warmup", type=int, default=5, help="requests per scenario before measuring")
+    p.add_argument("--timeout", type=float, default=60.0)
+    p.add_argument("--seed-rows", type=int, default=400, help="memory_log rows for the summarized day")
+    p.add_argument("--openai-latency-ms", type=float, default=300)
+    p.add_argument("--tokens-per-sec", type=float, default=50)
+    p.add_argument("--reply-tokens", type=int, default=60)
+    p.add_argument("--supabase-latency-ms", type=float, default=20)
+    p.add_argument("--out", default=None, help="result JSON (default: bench/results/<timestamp>.json)")
+    p.add_argument("--compare", default=None, help="previous result JSON to diff against")
+    args = p.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        p.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    out_path = Path(args.out) if args.out else BENCH_DIR / "results" / (datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    results: dict[str, dict] = {}
+    with tempfile.TemporaryDirectory(prefix="jarvis-bench-") as tmp:
+        services = start_stack(args, Path(tmp))
+        urls = {name: s.url for name, s in services.items()}
+        try:
+            if "daily_summary" in scenarios:
+                seed_day(urls["supabase"], args.seed_rows)
+            for scenario in scenarios:
+                if args.warmup:
+                    asyncio.run(run_level(scenario, 1, args.warmup, urls, args.timeout))
+                for c in levels:
+                    r = asyncio.run(run_level(scenario, c, args.requests, urls, args.timeout))
+                    results.setdefault(scenario, {})[f"c{c}"] = r
+                    print(f"{scenario:<16} c={c:<4} p50={r['p50_ms']}ms p95={r['p95_ms']}ms p99={r['p99_ms']}ms rps={r['rps']} errors={r['errors']}")
+        finally:
+            for s in reversed(list(services.values())):
+                s.stop()
+
+    report = {
+        "meta": {
+            "git_rev": _git_rev(),
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+        },
+        "config": {
+            "concurrency": levels,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "seed_rows": args.seed_rows,
+            "openai_latency_ms": args.openai_latency_ms,
+            "tokens_per_sec": args.tokens_per_sec,
+            "reply_tokens": args.reply_tokens,
+            "supabase_latency_ms": args.supabase_latency_ms,
+        },
+        "results": results,
+    }
+    out_path.write_text(json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False) + "\n", encoding="utf-8")
+    print(f"wrote {out_path}")
+
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        print("\n".join(compare(old, report)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# bench/startup.py
+"""
+コールドスタートの計測（Render の起動直後を手元で再現する）。
+
+    python bench/startup.py                      # 5 回ずつ計測して bench/results/startup-<timestamp>.json
+    python bench/startup.py --out after.json --compare before.json
+
+測るもの（どれも中央値 / 最小 / 最大, ms）:
+  import_app / import_gateway   python -c "import app" 等にかかる時間（インタプリタ起動分 python_baseline を含む）
+  listen_app                    uvicorn を起動してから /health が 200 を返すまで
+  first_chat / second_chat      listen 直後の /chat と、その次の /chat（差がクライアント生成・接続の分）
+
+OpenAI / Supabase は run.py と同じスタンドインを使う（遅延は 0 にして起動コストだけを見る）。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from run import API_KEY, BENCH_DIR, REPO_DIR, USER_ID, Service, _free_port, _git_rev
+
+
+def _stats(samples: list[float]) -> dict:
+    return {
+        "median_ms": round(statistics.median(samples), 1),
+        "min_ms": round(min(samples), 1),
+        "max_ms": round(max(samples), 1),
+    }
+
+
+def _time_cmd(code: str, env: dict) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=str(REPO_DIR), env=env, check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def _cold_start(env: dict, workdir: Path) -> tuple[float, float, float]:
+    """(listen まで, 1 回目の /chat, 2 回目の /chat)"""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    log = open(workdir / "app-startup.log", "ab")
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--app-dir", str(REPO_DIR), "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning",
+        ],
+        cwd=str(workdir),
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        with httpx.Client(timeout=30) as client:
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"app exited during startup; see {workdir / 'app-startup.log'}")
+                try:
+                    if client.get(url + "/health").status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.005)
+            listen = (time.perf_counter() - started) * 1000
+
+            chats = []
+            for i in range(2):
+                t = time.perf_counter()
+                res = client.post(url + "/chat", json={"text": f"起動テスト {time.time_ns()} {i}"}, headers={"X-API-Key": API_KEY})
+                res.raise_for_status()
+                chats.append((time.perf_counter() - t) * 1000)
+        return listen, chats[0], chats[1]
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    lines = [f"{'metric':<16}{'before':>10}{'after':>10}{'delta':>9}"]
+    for name, cur in sorted(new.get("results", {}).items()):
+        prev = old.get("results", {}).get(name)
+        if not prev:
+            continue
+        a, b = prev["median_ms"], cur["median_ms"]
+        delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+        lines.append(f"{name:<16}{a:>10}{b:>10}{delta:>9}")
+    return lines
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Cold-start benchmark for app.py / jarvis_gateway.py")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--out", default=None, help="result JSON (default: bench/results/startup-<timestamp>.json)")
+    p.add_argument("--compare", default=None, help="previous result JSON to diff against")
+    args = p.parse_args(argv)
+
+    out_path = Path(args.out) if args.out else BENCH_DIR / "results" / ("startup-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    samples: dict[str, list[float]] = {}
+    with tempfile.TemporaryDirectory(prefix="jarvis-startup-") as tmp:
+        workdir = Path(tmp)
+        fakes = {
+            "openai": Service("fake_openai", "fake_openai:app", {
+                "FAKE_OPENAI_LATENCY_MS": "0", "FAKE_OPENAI_TOKENS_PER_SEC": "0", "FAKE_OPENAI_EMBED_LATENCY_MS": "0",
+            }, BENCH_DIR, workdir),
+            "supabase": Service("fake_supabase", "fake_supabase:app", {"FAKE_SUPABASE_LATENCY_MS": "0"}, BENCH_DIR, workdir),
+        }
+        try:
+            for s in fakes.values():
+                s.wait_ready("/stats")
+            env = {
+                **os.environ,
+                "OPENAI_API_KEY": "sk-bench",
+                "OPENAI_BASE_URL": fakes["openai"].url + "/v1",
+                "SUPABASE_URL": fakes["supabase"].url,
+                "SUPABASE_SERVICE_ROLE_KEY": "bench.service.key",
+                "SUPABASE_USER_ID": USER_ID,
+                "JARVIS_API_KEY": API_KEY,
+                "UPSTREAM_BASE_URL": "http://127.0.0.1:9",
+                "MEMORY_LOG_SPILL_PATH": str(workdir / "memory_log.spill.jsonl"),
+            }
+            for _ in range(args.runs):
+                samples.setdefault("python_baseline", []).append(_time_cmd("pass", env))
+                samples.setdefault("import_app", []).append(_time_cmd("import app", env))
+                samples.setdefault("import_gateway", []).append(_time_cmd("import jarvis_gateway", env))
+                listen, first, second = _cold_start(env, workdir)
+                samples.setdefault("listen_app", []).append(listen)
+                samples.setdefault("first_chat", []).append(first)
+                samples.setdefault("second_chat", []).append(second)
+        finally:
+            for s in fakes.values():
+                s.stop()
+
+    results = {name: _stats(v) for name, v in samples.items()}
+    for name, r in sorted(results.items()):
+        print(f"{name:<16} median={r['median_ms']}ms min={r['min_ms']}ms max={r['max_ms']}ms")
+
+    report = {
+        "meta": {
+            "git_rev": _git_rev(),
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+        },
+        "config": {"runs": args.runs},
+        "results": results,
+    }
+    out_path.write_text(json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False) + "\n", encoding="utf-8")
+    print(f"wrote {out_path}")
+
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        print("\n".join(compare(old, report)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# clients.py
+"""
+OpenAI / Supabase クライアントの遅延生成（プロセス内で 1 つずつ共有）。
+
+- import 時には SDK を読み込まない（openai + supabase で import に 0.5〜1 秒かかる）
+- 最初の get() で生成。同時に呼ばれても生成は 1 回
+- lifespan で warm_up() を呼ぶと、起動処理をブロックせずにバックグラウンドで生成・接続しておく
+  → listen 開始は待たせず、最初のリクエストが来る頃には暖まっている
+- app.py と mushroom_app.py は同じ OpenAI クライアント（= 同じコネクションプール）を使う
+"""
+from __future__ import annotations
+
+import asyncio
+import importlib
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Generic, Optional, TypeVar
+
+import metrics
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from supabase import AsyncClient
+
+logger = logging.getLogger("clients")
+
+T = TypeVar("T")
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_TIMEOUT_SEC = float(os.getenv("OPENAI_TIMEOUT_SEC", "60"))
+CLIENT_WARMUP_CONNECT = os.getenv("CLIENT_WARMUP_CONNECT", "1") == "1"  # 生成後に 1 回通信して接続を張っておく
+
+CLIENT_INIT_SECONDS = metrics.REGISTRY.register(metrics.Gauge(
+    "jarvis_client_init_seconds", "Time spent constructing a shared client", ("client",),
+))
+
+
+class LazyClient(Generic[T]):
+    def __init__(
+        self,
+        name: str,
+        factory: Callable[[], Awaitable[T]],
+        warm: Optional[Callable[[T], Awaitable[Any]]] = None,
+        close: Optional[Callable[[T], Awaitable[Any]]] = None,
+    ) -> None:
+        self.name = name
+        self._factory = factory
+        self._warm = warm
+        self._close = close
+        self._value: Optional[T] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._warm_task: Optional[asyncio.Task] = None
+
+    def peek(self) -> Optional[T]:
+        return self._value
+
+    async def get(self) -> T:
+        if self._value is not None:
+            return self._value
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._value is None:
+                started = time.perf_counter()
+                with metrics.stage(f"{self.name}_init"):
+                    self._value = await self._factory()
+                CLIENT_INIT_SECONDS.set(time.perf_counter() - started, client=self.name)
+        return self._value
+
+    def warm_up(self) -> asyncio.Task:
+        """バックグラウンドで生成（+ 接続）。失敗しても最初の get() でやり直すだけ"""
+        if self._warm_task is None:
+            self._warm_task = asyncio.create_task(self._warm_up())
+        return self._warm_task
+
+    async def _warm_up(self) -> None:
+        try:
+            client = await self.get()
+            if self._warm is not None and CLIENT_WARMUP_CONNECT:
+                await self._warm(client)
+        except Exception as e:
+            logger.warning("%s warm-up failed: %r", self.name, e)
+
+    async def aclose(self) -> None:
+        if self._warm_task is not None and not self._warm_task.done():
+            self._warm_task.cancel()
+            try:
+                await self._warm_task
+            except asyncio.CancelledError:
+                pass
+        if self._value is not None and self._close is not None:
+            await self._close(self._value)
+        self._value = None
+        self._warm_task = None
+
+
+async def _import(name: str) -> None:
+    # SDK の import は重い（〜0.5 秒）ので、イベントループを止めないようスレッドで
+    await asyncio.to_thread(importlib.import_module, name)
+
+
+# -----------------------------
+# OpenAI
+# -----------------------------
+async def _make_openai() -> "AsyncOpenAI":
+    await _import("openai")
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    import httpx
+
+    return AsyncOpenAI(
+        api_key=os.environ["OPENAI_API_KEY"],
+        timeout=OPENAI_TIMEOUT_SEC,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            ),
+        ),
+    )
+
+
+async def _warm_openai(client: "AsyncOpenAI") -> None:
+    # 課金されない軽い呼び出しで TLS / コネクションを張っておく
+    await client.models.list()
+
+
+async def _close_openai(client: "AsyncOpenAI") -> None:
+    await client.close()
+
+
+# -----------------------------
+# Supabase
+# -----------------------------
+async def _make_supabase() -> "AsyncClient":
+    await _import("supabase")
+    from supabase import acreate_client
+
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.environ["SUPABASE_KEY"]
+    return await acreate_client(os.environ["SUPABASE_URL"], key)
+
+
+async def _warm_supabase(client: "AsyncClient") -> None:
+    await client.table("memory_log").select("id").limit(1).execute()
+
+
+async def _close_supabase(client: "AsyncClient") -> None:
+    await client.postgrest.aclose()
+
+
+openai: LazyClient["AsyncOpenAI"] = LazyClient("openai", _make_openai, _warm_openai, _close_openai)
+supabase: LazyClient["AsyncClient"] = LazyClient("supabase", _make_supabase, _warm_supabase, _close_supabase)
+
+
+def warm_up() -> None:
+    openai.warm_up()
+    supabase.warm_up()
+
+
+async def aclose() -> None:
+    await openai.aclose()
+    await supabase.aclose()
@@ -1,8 +1,7 @@
 import os, sys
 import math
-import requests
 from datetime import datetime, timezone, timedelta
-from supabase import create_client
+# requests / supabase は使う直前に import（起動を軽くする）
 
 JST = timezone(timedelta(hours=9))
 CONV_ID = "daily-report"
@@ -56,6 +55,8 @@ def make_message(now_jst): # type: ignore
 
 
 def post_to_discord(webhook_url: str, message: str) -> None:
+    import requests
+
     r = requests.post(webhook_url, json={"content": message}, timeout=10)
     if r.status_code not in (200, 204):
         print("[WARN] Discord post failed:", r.status_code, r.text)
@@ -65,6 +66,8 @@ def main():
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or need("SUPABASE_KEY")
     user_id = need("SUPABASE_USER_ID")
 
+    from supabase import create_client
+
     client = create_client(url, key)
     now_jst = datetime.now(JST)
     msg = make_message(now_jst)
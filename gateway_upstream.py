@@ -0,0 +1,499 @@
+# gateway_upstream.py
+"""
+jarvis_gateway から上流（app.py / Render）を叩くクライアント。
+
+- 1 本の keep-alive コネクションプールを共有（httpx.AsyncClient）
+- 上流は複数台可。P2C（ランダム 2 台のうち EWMA レイテンシ×処理中件数 が小さい方）で振り分け
+- /health を定期プローブし、連続失敗した上流は一定時間外す（outlier ejection）
+- connect タイムアウトと read タイムアウトを分ける（コールドスタートで connect が詰まっても早く諦める）
+- 「上流に届いていない」失敗（接続失敗）だけジッタ付きで再試行。
+  503 での再試行は status_retry_paths に挙げたパスだけ（POST /chat は冪等ではないので既定はなし）
+- ヘッジ（任意）: 過去のレイテンシ p95 を超えたら 2 本目を投げ、先に返った方を使う
+- サーキットブレーカー: 連続失敗で open → 一定時間は即 503 → half-open で 1 本だけ試す
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Optional
+
+import httpx
+
+# 上流が「受け付けていない」ことが明らかなステータス（Render のコールドスタート等）。
+# 502/504 は上流で処理が走った後のこともあるので再試行しない
+RETRYABLE_STATUS = {503}
+# 接続確立前の失敗（リクエストは上流に届いていない）
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class UpstreamUnavailable(Exception):
+    """ブレーカー open 中、または再試行を使い切った"""
+
+
+# -----------------------------
+# Latency histogram
+# -----------------------------
+class LatencyHistogram:
+    BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 60000)
+
+    def __init__(self, window: int = 512) -> None:
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self._recent: deque[float] = deque(maxlen=window)
+
+    def observe(self, ms: float) -> None:
+        for i, b in enumerate(self.BUCKETS_MS):
+            if ms <= b:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self._recent.append(ms)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """直近 window 件での p パーセンタイル（ms）"""
+        if not self._recent:
+            return None
+        data = sorted(self._recent)
+        idx = min(len(data) - 1, max(0, int(round(p / 100 * len(data))) - 1))
+        return data[idx]
+
+    def __len__(self) -> int:
+        return len(self._recent)
+
+    def snapshot(self) -> dict:
+        labels = [f"le_{b}ms" for b in self.BUCKETS_MS] + ["le_inf"]
+        return {
+            "count": self.total,
+            "mean_ms": round(self.sum_ms / self.total, 1) if self.total else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+# -----------------------------
+# Circuit breaker
+# -----------------------------
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, open_sec: float = 15.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def available(self) -> bool:
+        """状態を変えずに「今投げてよさそうか」だけ見る（振り分け候補の絞り込み用）"""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.open_sec
+        if self.state == self.HALF_OPEN:
+            return not self._probing
+        return True
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.open_sec:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        # half-open: 同時に 1 本だけ通す
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def release_probe(self) -> None:
+        """half-open の試行が結果を残さずに終わった（ヘッジの負け・クライアント切断でキャンセル）。次の 1 本を通す"""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        out = {"state": self.state, "consecutive_failures": self.failures}
+        if self.state == self.OPEN:
+            out["retry_in_sec"] = round(max(0.0, self.open_sec - (time.monotonic() - self.opened_at)), 1)
+        return out
+
+
+# -----------------------------
+# Upstream
+# -----------------------------
+class Upstream:
+    """上流 1 台分の状態"""
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, base_url: str, breaker: CircuitBreaker) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.breaker = breaker
+        self.latency = LatencyHistogram()
+        self.ewma_ms: Optional[float] = None
+        self.outstanding = 0
+        self.probe_failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    def observe(self, ms: float) -> None:
+        self.latency.observe(ms)
+        self.ewma_ms = ms if self.ewma_ms is None else self.EWMA_ALPHA * ms + (1 - self.EWMA_ALPHA) * self.ewma_ms
+
+    def score(self, balance: str) -> float:
+        if balance == "least_outstanding":
+            return self.outstanding
+        # まだ実測が無い上流は優先的に試す（0 扱い）
+        return (self.ewma_ms or 0.0) * (self.outstanding + 1)
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+            "ejected": self.ejected,
+            "probe_failures": self.probe_failures,
+            "circuit": self.breaker.snapshot(),
+            "latency": self.latency.snapshot(),
+        }
+
+
+class UpstreamStream:
+    """ストリーム応答のラッパー。aclose() で処理中件数を戻す"""
+
+    def __init__(self, response: httpx.Response, upstream: Upstream) -> None:
+        self._r = response
+        self._up = upstream
+        self._closed = False
+
+    @property
+    def status_code(self) -> int:
+        return self._r.status_code
+
+    async def aread(self) -> bytes:
+        return await self._r.aread()
+
+    def aiter_raw(self):
+        return self._r.aiter_raw()
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._up.outstanding -= 1
+        await self._r.aclose()
+
+
+class UpstreamClient:
+    def __init__(
+        self,
+        base_urls: list[str],
+        *,
+        connect_timeout_sec: float = 3.0,
+        read_timeout_sec: float = 20.0,
+        max_connections: int = 200,
+        max_keepalive: int = 50,
+        keepalive_expiry_sec: float = 30.0,
+        retries: int = 2,
+        retry_backoff_sec: float = 0.3,
+        status_retry_paths: tuple[str, ...] = (),
+        hedge_enabled: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_min_samples: int = 20,
+        breaker_failures: int = 5,
+        breaker_open_sec: float = 15.0,
+        balance: str = "ewma",
+        probe_path: str = "/health",
+        probe_interval_sec: float = 10.0,
+        probe_timeout_sec: float = 3.0,
+        eject_after: int = 3,
+        eject_sec: float = 30.0,
+    ) -> None:
+        if not base_urls:
+            raise ValueError("at least one upstream base url is required")
+        self.upstreams = [Upstream(u, CircuitBreaker(breaker_failures, breaker_open_sec)) for u in base_urls]
+        self.latency = LatencyHistogram()  # 全上流まとめて（ヘッジ判定用）
+        self.retries = retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self.status_retry_paths = frozenset(status_retry_paths)  # 503 でも再試行してよい（冪等な）パス
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.balance = balance
+        self.probe_path = probe_path
+        self.probe_interval_sec = probe_interval_sec
+        self.probe_timeout_sec = probe_timeout_sec
+        self.eject_after = eject_after
+        self.eject_sec = eject_sec
+        self._probe_task: Optional[asyncio.Task] = None
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout_sec, connect=connect_timeout_sec),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry_sec,
+            ),
+        )
+
+    async def start(self) -> None:
+        if self._probe_task is None and self.probe_interval_sec > 0:
+            self._probe_task = asyncio.create_task(self._probe_loop(), name="upstream-health-probe")
+
+    async def aclose(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+        await self.http.aclose()
+
+    # -----------------------------
+    # Public API
+    # -----------------------------
+    async def post(self, path: str, *, headers: dict, json: dict) -> httpx.Response:
+        """
+        POST（非ストリーム）。4xx はそのまま返す（呼び出し側で判断）。
+        接続系の失敗だけ、できれば別の上流に再試行する（503 は status_retry_paths のパスだけ）。
+        """
+        last_exc: Optional[Exception] = None
+        tried: set[Upstream] = set()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await self._backoff(attempt)
+            try:
+                r, up = await self._hedged(path, headers, json, tried)
+            except UpstreamUnavailable:
+                raise
+            except _AttemptFailed as e:
+                tried.add(e.upstream)
+                last_exc = e.cause
+                continue
+            if self._retry_status(path, r.status_code) and attempt < self.retries:
+                tried.add(up)
+                last_exc = httpx.HTTPStatusError(f"upstream {r.status_code}", request=r.request, response=r)
+                continue
+            return r
+        raise UpstreamUnavailable(f"upstream request failed after {self.retries + 1} attempts: {last_exc}")
+
+    async def stream(self, path: str, *, headers: dict, json: dict) -> UpstreamStream:
+        """
+        ストリーム応答を開く（呼び出し側で aclose すること）。
+        ヘッジはしない。再試行は最初のバイトより前（接続、status_retry_paths なら 503）だけ。
+        """
+        last_exc: Optional[Exception] = None
+        tried: set[Upstream] = set()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await self._backoff(attempt)
+            up = self._pick(exclude=tried)
+            probe = up.breaker.state == CircuitBreaker.HALF_OPEN  # この 1 本が half-open の試行
+            req = self.http.build_request("POST", f"{up.base_url}{path}", headers=headers, json=json)
+            started = time.monotonic()
+            up.outstanding += 1
+            try:
+                r = await self.http.send(req, stream=True)
+            except RETRYABLE_ERRORS as e:
+                up.outstanding -= 1
+                up.breaker.record_failure()
+                tried.add(up)
+                last_exc = e
+                continue
+            except httpx.HTTPError:
+                up.outstanding -= 1
+                up.breaker.record_failure()
+                raise
+            except asyncio.CancelledError:
+                up.outstanding -= 1
+                if probe:
+                    up.breaker.release_probe()
+                raise
+            # ストリームは「ヘッダが返るまで」を記録（TTFB）
+            self._record(up, r.status_code, started)
+            stream = UpstreamStream(r, up)
+            if self._retry_status(path, r.status_code) and attempt < self.retries:
+                await stream.aclose()
+                tried.add(up)
+                last_exc = httpx.HTTPStatusError(f"upstream {r.status_code}", request=req, response=r)
+                continue
+            return stream
+        raise UpstreamUnavailable(f"upstream request failed after {self.retries + 1} attempts: {last_exc}")
+
+    def status(self) -> dict:
+        return {
+            "balance": self.balance,
+            "upstreams": [u.snapshot() for u in self.upstreams],
+            "latency": self.latency.snapshot(),
+            "hedging": {
+                "enabled": self.hedge_enabled,
+                "percentile": self.hedge_percentile,
+                "fired": self.hedges_fired,
+                "won": self.hedges_won,
+            },
+        }
+
+    # -----------------------------
+    # Balancing
+    # -----------------------------
+    def _pick(self, exclude: set = frozenset()) -> Upstream:
+        """
+        P2C: 使える上流からランダムに 2 台選び、スコアの低い方。
+        除外（試行済み・ejected）で候補が空になったら、条件を緩めて選び直す。
+        """
+        usable = [u for u in self.upstreams if u.breaker.available()]
+        for pool in (
+            [u for u in usable if not u.ejected and u not in exclude],
+            [u for u in usable if not u.ejected],
+            usable,  # 全台 eject された時は eject を無視（全断よりはまし）
+        ):
+            if not pool:
+                continue
+            cands = random.sample(pool, 2) if len(pool) >= 2 else pool
+            for up in sorted(cands, key=lambda u: u.score(self.balance)):
+                if up.breaker.allow():
+                    return up
+        raise UpstreamUnavailable("circuit open: all upstreams are failing, try again later")
+
+    # -----------------------------
+    # Health probing / ejection
+    # -----------------------------
+    async def _probe_loop(self) -> None:
+        while True:
+            await asyncio.gather(*(self._probe(u) for u in self.upstreams))
+            await asyncio.sleep(self.probe_interval_sec)
+
+    async def _probe(self, up: Upstream) -> None:
+        try:
+            r = await self.http.get(f"{up.base_url}{self.probe_path}", timeout=self.probe_timeout_sec)
+            ok = r.status_code < 500
+        except httpx.HTTPError:
+            ok = False
+
+        if ok:
+            up.probe_failures = 0
+            up.ejected_until = 0.0
+            # half-open のまま試行が来ない上流も、ヘルスチェックが通れば閉じる
+            if up.breaker.state == CircuitBreaker.HALF_OPEN:
+                up.breaker.record_success()
+            # 遅いと判定されて干されている上流にも、時間とともに再び回ってくるよう減衰させる
+            if up.ewma_ms is not None and up.outstanding == 0:
+                up.ewma_ms *= 0.8
+            return
+        up.probe_failures += 1
+        if up.probe_failures >= self.eject_after:
+            up.ejected_until = time.monotonic() + self.eject_sec
+
+    # -----------------------------
+    # Internals
+    # -----------------------------
+    def _retry_status(self, path: str, status_code: int) -> bool:
+        return status_code in RETRYABLE_STATUS and path in self.status_retry_paths
+
+    async def _backoff(self, attempt: int) -> None:
+        # full jitter
+        await asyncio.sleep(random.uniform(0, self.retry_backoff_sec * (2 ** (attempt - 1))))
+
+    def _record(self, up: Upstream, status_code: int, started: float) -> None:
+        ms = (time.monotonic() - started) * 1000
+        up.observe(ms)
+        self.latency.observe(ms)
+        if status_code >= 500:
+            up.breaker.record_failure()
+        else:
+            up.breaker.record_success()
+
+    async def _send_once(self, path: str, headers: dict, json: dict, exclude: set) -> tuple[httpx.Response, Upstream]:
+        up = self._pick(exclude=exclude)
+        probe = up.breaker.state == CircuitBreaker.HALF_OPEN  # この 1 本が half-open の試行
+        started = time.monotonic()
+        up.outstanding += 1
+        try:
+            r = await self.http.post(f"{up.base_url}{path}", headers=headers, json=json)
+        except RETRYABLE_ERRORS as e:
+            up.breaker.record_failure()
+            raise _AttemptFailed(up, e)
+        except httpx.HTTPError:
+            up.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            # ヘッジの負けとしてキャンセルされた試行が half-open の 1 本だった場合
+            if probe:
+                up.breaker.release_probe()
+            raise
+        finally:
+            up.outstanding -= 1
+        self._record(up, r.status_code, started)
+        return r, up
+
+    def _hedge_delay_sec(self) -> Optional[float]:
+        if not self.hedge_enabled or len(self.latency) < self.hedge_min_samples:
+            return None
+        p = self.latency.percentile(self.hedge_percentile)
+        return p / 1000 if p is not None else None
+
+    async def _hedged(self, path: str, headers: dict, json: dict, exclude: set) -> tuple[httpx.Response, Upstream]:
+        """
+        ヘッジ有効時: 1 本目が p95 を超えても返らなければ 2 本目を（できれば別の上流に）投げ、
+        先に成功した方を返す。
+        注意: /chat は冪等ではない（上流で memory_log に 2 回書かれ得る）ので既定は無効。
+        """
+        delay = self._hedge_delay_sec()
+        if delay is None:
+            return await self._send_once(path, headers, json, exclude)
+
+        first = asyncio.create_task(self._send_once(path, headers, json, exclude))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        self.hedges_fired += 1
+        busy = {u for u in self.upstreams if u.outstanding > 0}
+        second = asyncio.create_task(self._send_once(path, headers, json, exclude | busy))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is second:
+                            self.hedges_won += 1
+                        return t.result()
+            # 両方失敗: 1 本目の例外を優先（2 本目はブレーカーで弾かれただけのこともある）
+            raise first.exception()  # type: ignore[misc]
+        finally:
+            for t in pending:
+                t.cancel()
+
+
+class _AttemptFailed(Exception):
+    """接続前の失敗（どの上流で失敗したかを再試行側に伝える）"""
+
+    def __init__(self, upstream: Upstream, cause: Exception) -> None:
+        super().__init__(str(cause))
+        self.upstream = upstream
+        self.cause = cause
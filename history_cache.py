@@ -0,0 +1,114 @@
+# history_cache.py
+"""
+会話ごとの直近ターンをプロセス内に持つキャッシュ。
+
+- conversation_id ごとにリングバッファ（deque(maxlen)）
+- 会話をまたいで LRU で追い出し（メモリ上限）
+- キーを (テナント, 会話) のタプルにすると、max_per_tenant でテナントごとの会話数も抑える
+  （1 テナントが大量の会話を作っても他テナントの履歴を追い出し切らない）
+- ミス時だけ loader（Supabase）から温める。定常状態では DB を読まない
+- trim_to_budget() でトークン予算に収まるよう古い方から削る
+"""
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Hashable, Optional
+
+Turn = dict  # {"role": "user" | "assistant", "content": str}
+Loader = Callable[[], Awaitable[list[Turn]]]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    ざっくり見積もり。日本語はほぼ 1 文字 1 トークン、英語は 4 文字 1 トークン前後なので
+    UTF-8 バイト数 / 3 で多めに見積もる（予算オーバーしない側に倒す）。
+    """
+    return max(1, len(text.encode("utf-8")) // 3)
+
+
+def trim_to_budget(turns: list[Turn], max_tokens: int, per_message_overhead: int = 4) -> list[Turn]:
+    """新しい方から詰めて、予算に収まる分だけ返す（時系列順）"""
+    kept: list[Turn] = []
+    used = 0
+    for turn in reversed(turns):
+        cost = estimate_tokens(turn["content"]) + per_message_overhead
+        if used + cost > max_tokens:
+            break
+        kept.append(turn)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+class HistoryCache:
+    def __init__(self, *, max_conversations: int = 256, max_turns: int = 40, max_per_tenant: int = 0) -> None:
+        self.max_conversations = max_conversations
+        self.max_turns = max_turns
+        self.max_per_tenant = max_per_tenant  # 0 = 無制限。キーがタプルの時だけ key[0] をテナントとみなす
+        self._data: "OrderedDict[Hashable, deque[Turn]]" = OrderedDict()
+        self._per_tenant: dict[Hashable, int] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def append(self, key: Hashable, role: str, content: str) -> None:
+        """温まっている会話にだけ足す（冷えた会話は次の get で DB から読む）"""
+        buf = self._data.get(key)
+        if buf is None:
+            return
+        buf.append({"role": role, "content": content})
+        self._data.move_to_end(key)
+
+    def peek(self, key: Hashable) -> Optional[list[Turn]]:
+        buf = self._data.get(key)
+        return list(buf) if buf is not None else None
+
+    async def get(self, key: Hashable, loader: Loader) -> list[Turn]:
+        buf = self._data.get(key)
+        if buf is not None:
+            self._data.move_to_end(key)
+            return list(buf)
+
+        turns = await loader()
+        # loader の await 中に別リクエストが温めていたらそちらを優先
+        buf = self._data.get(key)
+        if buf is None:
+            buf = deque(turns[-self.max_turns :], maxlen=self.max_turns)
+            self._data[key] = buf
+            self._count(key, +1)
+            self._evict(key)
+        self._data.move_to_end(key)
+        return list(buf)
+
+    def invalidate(self, key: Hashable) -> None:
+        if self._data.pop(key, None) is not None:
+            self._count(key, -1)
+
+    @staticmethod
+    def _tenant(key: Hashable) -> Optional[Hashable]:
+        return key[0] if isinstance(key, tuple) and key else None
+
+    def _count(self, key: Hashable, delta: int) -> None:
+        tenant = self._tenant(key)
+        if tenant is None:
+            return
+        n = self._per_tenant.get(tenant, 0) + delta
+        if n > 0:
+            self._per_tenant[tenant] = n
+        else:
+            self._per_tenant.pop(tenant, None)
+
+    def _evict(self, added: Hashable) -> None:
+        tenant = self._tenant(added)
+        if self.max_per_tenant and tenant is not None and self._per_tenant.get(tenant, 0) > self.max_per_tenant:
+            # そのテナントの一番古い会話から
+            for old in self._data:
+                if old != added and self._tenant(old) == tenant:
+                    self.invalidate(old)
+                    break
+        while len(self._data) > self.max_conversations:
+            old, _ = self._data.popitem(last=False)
+            self._count(old, -1)
@@ -1,14 +1,23 @@
 # jarvis_gateway.py
 from __future__ import annotations
 
+import hashlib
+import json
 import os
-import re
-import requests
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Tuple
 
+import httpx
+
+import metrics
+from gateway_upstream import UpstreamClient, UpstreamUnavailable
+from prompts import detect_mode, mode_preamble
+from singleflight import SingleFlight
+
 from fastapi import FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 
@@ -19,18 +28,53 @@ JST = timezone(timedelta(hours=9))
 # -----------------------------
 # ENV
 # -----------------------------
-UPSTREAM_BASE_URL = os.getenv("UPSTREAM_BASE_URL", "").rstrip("/")
-if not UPSTREAM_BASE_URL:
+# 複数台にする時は UPSTREAM_BASE_URLS にカンマ区切りで（UPSTREAM_BASE_URL より優先）
+UPSTREAM_BASE_URLS = [
+    u.strip().rstrip("/")
+    for u in (os.getenv("UPSTREAM_BASE_URLS") or os.getenv("UPSTREAM_BASE_URL", "")).split(",")
+    if u.strip()
+]
+if not UPSTREAM_BASE_URLS:
     # 例: https://jarvis-chat-61fu.onrender.com
     raise RuntimeError("Missing env: UPSTREAM_BASE_URL (e.g. https://jarvis-chat-61fu.onrender.com)")
+UPSTREAM_BASE_URL = UPSTREAM_BASE_URLS[0]
 
 UPSTREAM_CHAT_PATH = os.getenv("UPSTREAM_CHAT_PATH", "/chat")
-UPSTREAM_TIMEOUT_SEC = float(os.getenv("UPSTREAM_TIMEOUT_SEC", "20"))
+UPSTREAM_STREAM_PATH = os.getenv("UPSTREAM_STREAM_PATH", "/chat/stream")
+UPSTREAM_TIMEOUT_SEC = float(os.getenv("UPSTREAM_TIMEOUT_SEC", "20"))  # read timeout
+UPSTREAM_CONNECT_TIMEOUT_SEC = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_SEC", "3"))
+
+# 再試行（接続失敗のみ。503 での再試行は UPSTREAM_STATUS_RETRY_PATHS に挙げた冪等なパスだけ）とヘッジ
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF_SEC = float(os.getenv("UPSTREAM_RETRY_BACKOFF_SEC", "0.3"))
+UPSTREAM_STATUS_RETRY_PATHS = tuple(
+    p.strip() for p in os.getenv("UPSTREAM_STATUS_RETRY_PATHS", "").split(",") if p.strip()
+)
+UPSTREAM_HEDGE_ENABLED = os.getenv("UPSTREAM_HEDGE_ENABLED", "0") == "1"
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"))
+
+# サーキットブレーカー
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+UPSTREAM_BREAKER_OPEN_SEC = float(os.getenv("UPSTREAM_BREAKER_OPEN_SEC", "15"))
+
+# 振り分け（ewma | least_outstanding）と /health プローブによる切り離し
+UPSTREAM_BALANCE = os.getenv("UPSTREAM_BALANCE", "ewma")
+UPSTREAM_PROBE_INTERVAL_SEC = float(os.getenv("UPSTREAM_PROBE_INTERVAL_SEC", "10"))
+UPSTREAM_EJECT_AFTER = int(os.getenv("UPSTREAM_EJECT_AFTER", "3"))
+UPSTREAM_EJECT_SEC = float(os.getenv("UPSTREAM_EJECT_SEC", "30"))
+
+# 上流への keep-alive コネクションプール（1プロセスで共有）
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "50"))
+UPSTREAM_KEEPALIVE_EXPIRY_SEC = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY_SEC", "30"))
 
 # 外部からゲートウェイへ入る時のキー（任意）
 # これを設定すると、ゲートウェイ自体にも認証がかかる
 GATEWAY_API_KEY = os.getenv("GATEWAY_API_KEY")  # optional
 
+# 同一 /chat ペイロードの二重送信をまとめる窓（秒）。0 で同時実行分だけまとめる
+GATEWAY_DEDUPE_WINDOW_SEC = float(os.getenv("GATEWAY_DEDUPE_WINDOW_SEC", "2"))
+
 # 上流（既存Jarvis）のキー（任意）
 # これを設定すると、クライアントキーとは別のキーで上流を叩ける
 UPSTREAM_API_KEY = os.getenv("UPSTREAM_API_KEY")  # optional
@@ -40,10 +84,49 @@ UPSTREAM_API_KEY = os.getenv("UPSTREAM_API_KEY")  # optional
 ALLOW_ORIGINS = [o.strip() for o in os.getenv("ALLOW_ORIGINS", "").split(",") if o.strip()]
 
 
+# -----------------------------
+# Upstream HTTP client
+# -----------------------------
+upstream: UpstreamClient  # lifespan で生成・破棄
+chat_flight = SingleFlight(linger_sec=GATEWAY_DEDUPE_WINDOW_SEC)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global upstream
+    upstream = UpstreamClient(
+        UPSTREAM_BASE_URLS,
+        connect_timeout_sec=UPSTREAM_CONNECT_TIMEOUT_SEC,
+        read_timeout_sec=UPSTREAM_TIMEOUT_SEC,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry_sec=UPSTREAM_KEEPALIVE_EXPIRY_SEC,
+        retries=UPSTREAM_RETRIES,
+        retry_backoff_sec=UPSTREAM_RETRY_BACKOFF_SEC,
+        status_retry_paths=UPSTREAM_STATUS_RETRY_PATHS,
+        hedge_enabled=UPSTREAM_HEDGE_ENABLED,
+        hedge_percentile=UPSTREAM_HEDGE_PERCENTILE,
+        breaker_failures=UPSTREAM_BREAKER_FAILURES,
+        breaker_open_sec=UPSTREAM_BREAKER_OPEN_SEC,
+        balance=UPSTREAM_BALANCE,
+        probe_interval_sec=UPSTREAM_PROBE_INTERVAL_SEC,
+        eject_after=UPSTREAM_EJECT_AFTER,
+        eject_sec=UPSTREAM_EJECT_SEC,
+    )
+    await upstream.start()
+    yield
+    await upstream.aclose()
+
+
 # -----------------------------
 # FastAPI
 # -----------------------------
-app = FastAPI(title="Jarvis Gateway API")
+app = FastAPI(title="Jarvis Gateway API", lifespan=lifespan)
+
+# 区間計測・Server-Timing ヘッダ・/metrics
+metrics.set_service("gateway")
+app.add_middleware(metrics.ServerTimingMiddleware)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # optional: require Bearer on /metrics
 
 app.add_middleware(
     CORSMiddleware,
@@ -59,6 +142,7 @@ app.add_middleware(
 # -----------------------------
 class ChatIn(BaseModel):
     text: str
+    conversation_id: Optional[str] = None  # 上流へそのまま渡す
 
 
 class ChatOut(BaseModel):
@@ -67,63 +151,13 @@ class ChatOut(BaseModel):
 
 
 # -----------------------------
-# Mode rules (prompt prepend)
+# Mode rules
 # -----------------------------
-MODE_RE = re.compile(r"^\s*#(?P<mode>waiting|work|edit|note)\b", re.IGNORECASE)
-
-
-def _detect_mode(text: str) -> Tuple[Optional[str], str]:
-    """
-    Returns: (mode, stripped_text_without_mode_tag)
-    """
-    m = MODE_RE.match(text or "")
-    if not m:
-        return None, text.strip()
-
-    mode = m.group("mode").lower()
-    stripped = MODE_RE.sub("", text, count=1).strip()
-    return mode, stripped
-
-
-def _mode_preamble(mode: Optional[str]) -> str:
-    """
-    Short, stable rules. Designed to push "拾い" before explanations.
-    """
-    base = (
-        "あなたは『拾い屋AI』。ユーザー発話の中にある "
-        "文字/音/意味/感情 のズレを最優先で拾い、まず反射で返す。"
-        "解説・最適化・結論づけは、ユーザーが求めた時だけ。"
-        "曖昧な時は候補を2〜3出し、一番萌える解釈で返す。"
-    )
-
-    if mode == "waiting":
-        return base + (
-            "【#waiting】ここは永久凍結待合室。"
-            "意味づけ・正しさ・助言・手順は禁止。"
-            "萌え/空気/受けのみ。途中で閉じてよい。"
-        )
-    if mode == "work":
-        return base + (
-            "【#work】要点整理・設計・手順化OK。結論あり。"
-            "ただし説教調や過剰な最適化は避ける。"
-        )
-    if mode == "edit":
-        return base + (
-            "【#edit】文章の整形・トーン調整のみ。内容の追加提案はしない。"
-        )
-    if mode == "note":
-        return base + (
-            "【#note】非公開の下書き生成。投稿・拡散は前提にしない。"
-        )
-    return base
-
-
-def _build_upstream_text(user_text: str) -> str:
-    mode, stripped = _detect_mode(user_text)
-    pre = _mode_preamble(mode)
-    # 上流の /chat は text 1本なので、ここで「前置き＋本文」を同じ text にまとめる
-    # 余計な装飾は避け、安定して効く形にする
-    return f"{pre}\n\nユーザー: {stripped}"
+def _build_upstream_body(user_text: str) -> dict:
+    # 前置きは本文に混ぜず mode / system として別に渡す（前置きは prompts.py で組み立て済み）
+    # 上流はこれをシステムプロンプト側に置くので、同じモードなら毎ターン同じ接頭辞になる
+    mode, stripped = detect_mode(user_text)
+    return {"text": stripped, "mode": mode, "system": mode_preamble(mode)}
 
 
 # -----------------------------
@@ -134,72 +168,162 @@ def _require_gateway_key(x_api_key: Optional[str]) -> None:
         raise HTTPException(status_code=401, detail="invalid gateway api key")
 
 
-def _pick_upstream_key(incoming_x_api_key: Optional[str]) -> str:
+def _upstream_auth(incoming_x_api_key: Optional[str], authorization: Optional[str]) -> dict:
     """
-    If UPSTREAM_API_KEY is set, use it (key separation).
-    Else, pass-through the caller's key.
+    Bearer (JWT) from the caller is passed through as-is so upstream can resolve the tenant.
+    Otherwise: if UPSTREAM_API_KEY is set, use it (key separation), else pass-through the caller's key.
     """
+    if authorization and authorization[:7].lower() == "bearer ":
+        return {"Authorization": authorization}
     key = UPSTREAM_API_KEY or incoming_x_api_key
     if not key:
         # 上流がキー必須なのに何も渡せないケース
         raise HTTPException(status_code=401, detail="missing api key for upstream")
-    return key
+    return {"X-API-KEY": key}
 
 
 # -----------------------------
 # Routes
 # -----------------------------
 @app.get("/", include_in_schema=False)
-def root():
+async def root():
     return {"service": "jarvis-gateway", "ok": True}
 
 
 @app.get("/version", include_in_schema=False)
-def version():
+async def version():
     return {"version": APP_VERSION}
 
 
 @app.get("/health", include_in_schema=False)
-def health_get():
+async def health_get():
     return {"ok": True}
 
 
 @app.head("/health", include_in_schema=False)
-def health_head():
+async def health_head():
     return Response(status_code=200)
 
 
-@app.post("/chat", response_model=ChatOut)
-def chat(payload: ChatIn, x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY")) -> ChatOut:
+@app.get("/metrics", include_in_schema=False)
+async def metrics_get(authorization: Optional[str] = Header(default=None)):
+    if not metrics.authorized(authorization, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="invalid metrics token")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/upstream/status", include_in_schema=False)
+async def upstream_status(x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY")):
+    """サーキット状態とレイテンシ分布（運用確認用）"""
+    _require_gateway_key(x_api_key)
+    return upstream.status()
+
+
+def _prepare_upstream(payload: ChatIn, x_api_key: Optional[str], authorization: Optional[str] = None) -> Tuple[dict, dict]:
+    """
+    Common front half of /chat and /chat/stream.
+    Returns: (headers, json_body) for the upstream call.
+    """
     _require_gateway_key(x_api_key)
 
     user_text = (payload.text or "").strip()
     if not user_text:
         raise HTTPException(status_code=400, detail="text is empty")
 
-    upstream_text = _build_upstream_text(user_text)
-    upstream_key = _pick_upstream_key(x_api_key)
+    body = _build_upstream_body(user_text)
+    if not body["text"]:
+        raise HTTPException(status_code=400, detail="text is empty")
+    if payload.conversation_id:
+        body["conversation_id"] = payload.conversation_id
+
+    headers = {**_upstream_auth(x_api_key, authorization), "Content-Type": "application/json"}
+    return headers, body
 
-    url = f"{UPSTREAM_BASE_URL}{UPSTREAM_CHAT_PATH}"
+
+def _raise_for_upstream_status(status_code: int, body: str) -> None:
+    if status_code == 401:
+        raise HTTPException(status_code=502, detail="upstream unauthorized (check api key)")
+    if status_code >= 400:
+        raise HTTPException(status_code=502, detail=f"upstream error: {status_code} {body[:300]}")
+
+
+async def _upstream_chat(headers: dict, body: dict) -> str:
     try:
-        r = requests.post(
-            url,
-            headers={"X-API-KEY": upstream_key, "Content-Type": "application/json"},
-            json={"text": upstream_text},
-            timeout=UPSTREAM_TIMEOUT_SEC,
-        )
-    except requests.RequestException as e:
+        with metrics.stage("upstream_http"):
+            r = await upstream.post(UPSTREAM_CHAT_PATH, headers=headers, json=body)
+    except UpstreamUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"upstream request failed: {e}")
 
-    if r.status_code == 401:
-        raise HTTPException(status_code=502, detail="upstream unauthorized (check api key)")
-    if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"upstream error: {r.status_code} {r.text[:300]}")
+    _raise_for_upstream_status(r.status_code, r.text)
 
     data = r.json()
     reply = (data.get("reply") or "").strip()
     if not reply:
         raise HTTPException(status_code=502, detail="upstream returned empty reply")
+    return reply
+
+
+@app.post("/chat", response_model=ChatOut)
+async def chat(
+    payload: ChatIn,
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY"),
+    authorization: Optional[str] = Header(default=None),
+) -> ChatOut:
+    headers, body = _prepare_upstream(payload, x_api_key, authorization)
+
+    # 同じキー・同じ本文の同時／短時間の二重送信は上流 1 回にまとめる
+    auth = headers.get("X-API-KEY") or headers.get("Authorization")
+    key = hashlib.sha256(
+        json.dumps([auth, body], ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    reply = await chat_flight.do(key, lambda: _upstream_chat(headers, body))
 
     now = datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S JST")
     return ChatOut(reply=reply, jst_time=now)
+
+
+@app.post("/chat/stream")
+async def chat_stream(
+    payload: ChatIn,
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY"),
+    authorization: Optional[str] = Header(default=None),
+):
+    """
+    SSE pass-through proxy: upstream /chat/stream bytes are relayed as-is,
+    so the first token reaches the client as soon as upstream emits it.
+    """
+    headers, body = _prepare_upstream(payload, x_api_key, authorization)
+    headers["Accept"] = "text/event-stream"
+
+    try:
+        # read timeout はチャンク間の無通信時間に効く
+        with metrics.stage("upstream_http"):
+            r = await upstream.stream(UPSTREAM_STREAM_PATH, headers=headers, json=body)
+    except UpstreamUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"upstream request failed: {e}")
+
+    if r.status_code >= 400:
+        text = (await r.aread()).decode("utf-8", "replace")
+        await r.aclose()
+        _raise_for_upstream_status(r.status_code, text)
+
+    async def relay():
+        try:
+            async for chunk in r.aiter_raw():
+                if chunk:
+                    yield chunk
+        except httpx.HTTPError as e:
+            msg = json.dumps({"detail": f"upstream stream broken: {e}"}, ensure_ascii=False)
+            yield f"event: error\ndata: {msg}\n\n".encode("utf-8")
+        finally:
+            await r.aclose()
+
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,374 @@
+# jobs.py
+"""
+定期処理用の小さな永続ジョブキュー（SQLite 1 ファイル）。worker.py から使う。
+
+- enqueue は冪等キー（report_key 等）つき。同じキーは 2 回入らない（スケジューラが何度積んでも 1 回）
+- ワーカーは claim → 実行 → done / 再試行。実行中のプロセスが落ちても lease が切れたら他が拾い直す
+- 失敗は種類ごとの RetryPolicy で指数バックオフ。回数を使い切ったら dead（status で確認・requeue で戻す）
+- Scheduler は「今日まで catchup_days 日分」の発火時刻を毎回積み直すだけ。止まっていた間の分も追いつく
+  ただしキューを初めて使った時刻（meta の scheduler_since）より前の発火時刻は積まない（初回起動で過去分を投稿しない）
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger("jobs")
+
+JST = timezone(timedelta(hours=9))
+
+QUEUED, RUNNING, DONE, DEAD = "queued", "running", "done", "dead"
+
+
+class PermanentError(Exception):
+    """再試行しても直らない失敗（4xx 等）。すぐ dead にする"""
+
+
+class RetryLater(Exception):
+    """相手が待てと言ってきた（429 の Retry-After 等）。delay 秒後に再試行"""
+
+    def __init__(self, delay: float, message: str = "") -> None:
+        super().__init__(message or f"retry after {delay:.1f}s")
+        self.delay = delay
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 5
+    base_sec: float = 30.0
+    max_sec: float = 3600.0
+    jitter: float = 0.2  # ±20%
+
+    def delay(self, attempt: int) -> float:
+        """attempt 回目（1 始まり）が失敗した後の待ち時間"""
+        d = min(self.max_sec, self.base_sec * (2 ** (attempt - 1)))
+        return d * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    key: str
+    payload: dict
+    attempts: int
+    max_attempts: int
+
+
+Handler = Callable[[Job], Awaitable[Any]]
+
+
+@dataclass
+class JobType:
+    handler: Handler
+    retry: RetryPolicy = field(default_factory=RetryPolicy)
+    timeout_sec: float = 300.0  # lease もこれ + 余裕で取る
+
+
+class JobQueue:
+    """スレッドセーフ。非同期側からは asyncio.to_thread 経由で呼ぶ"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                run_at REAL NOT NULL,
+                locked_until REAL,
+                last_error TEXT,
+                result TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.wake = asyncio.Event()  # 同じプロセス内の enqueue でワーカーを起こす（イベントループのスレッドから呼ぶこと）
+
+    def enqueue(
+        self,
+        kind: str,
+        payload: dict,
+        *,
+        key: str,
+        run_at: Optional[float] = None,
+        max_attempts: int = 5,
+    ) -> bool:
+        """新しく積んだら True（同じ key が既にあれば何もしない）"""
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (kind, key, payload, status, max_attempts, run_at, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(payload, ensure_ascii=False), QUEUED, max_attempts,
+                 now if run_at is None else run_at, now, now),
+            )
+        if cur.rowcount:
+            self.wake.set()
+        return bool(cur.rowcount)
+
+    def claim(self, kinds: list[str], lease_sec: dict[str, float]) -> Optional[Job]:
+        """期限の来た queued（または lease 切れの running）を 1 件取って running にする"""
+        now = time.time()
+        marks = ",".join("?" * len(kinds))
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")  # 複数プロセスで同じファイルを使っても二重取りしない
+            try:
+                row = self._db.execute(
+                    f"SELECT id, kind, key, payload, attempts, max_attempts FROM jobs"
+                    f" WHERE kind IN ({marks})"
+                    f" AND ((status = ? AND run_at <= ?) OR (status = ? AND locked_until <= ?))"
+                    f" ORDER BY run_at, id LIMIT 1",
+                    (*kinds, QUEUED, now, RUNNING, now),
+                ).fetchone()
+                if row is None:
+                    self._db.execute("COMMIT")
+                    return None
+                job_id, kind, key, payload, attempts, max_attempts = row
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, locked_until = ?, updated_at = ? WHERE id = ?",
+                    (RUNNING, now + lease_sec.get(kind, 300.0), now, job_id),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return Job(job_id, kind, key, json.loads(payload), attempts + 1, max_attempts)
+
+    def complete(self, job: Job, result: Any = None) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, locked_until = NULL, last_error = NULL, result = ?, updated_at = ? WHERE id = ?",
+                (DONE, json.dumps(result, ensure_ascii=False, default=str), time.time(), job.id),
+            )
+
+    def retry(self, job: Job, error: str, delay: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, locked_until = NULL, last_error = ?, run_at = ?, updated_at = ? WHERE id = ?",
+                (QUEUED, error[:2000], now + delay, now, job.id),
+            )
+
+    def bury(self, job: Job, error: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, locked_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                (DEAD, error[:2000], time.time(), job.id),
+            )
+
+    def requeue_dead(self, kind: Optional[str] = None) -> int:
+        """dead を試行回数 0 に戻して積み直す"""
+        now = time.time()
+        sql = "UPDATE jobs SET status = ?, attempts = 0, run_at = ?, updated_at = ? WHERE status = ?"
+        args: list = [QUEUED, now, now, DEAD]
+        if kind:
+            sql += " AND kind = ?"
+            args.append(kind)
+        with self._lock:
+            n = self._db.execute(sql, args).rowcount
+        if n:
+            self.wake.set()
+        return n
+
+    def purge(self, older_than_sec: float) -> int:
+        """終わった行を消す。冪等キーもここで忘れるので catchup より十分長く"""
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM jobs WHERE status = ? AND updated_at < ?",
+                (DONE, time.time() - older_than_sec),
+            ).rowcount
+
+    def watermark(self, name: str) -> float:
+        """name の時刻（UNIX 秒）。初めて聞かれた時に記録する（既存のキューなら最古の行の時刻）"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                return float(row[0])
+            oldest = self._db.execute("SELECT MIN(created_at) FROM jobs").fetchone()[0]
+            value = oldest if oldest is not None else time.time()
+            self._db.execute("INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)", (name, repr(value)))
+            return float(self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()[0])
+
+    def stats(self) -> dict:
+        out: dict[str, dict[str, int]] = {}
+        with self._lock:
+            for kind, status, n in self._db.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status"):
+                out.setdefault(kind, {})[status] = n
+        return out
+
+    def failures(self, limit: int = 20) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT kind, key, status, attempts, last_error FROM jobs"
+                " WHERE last_error IS NOT NULL ORDER BY updated_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(zip(("kind", "key", "status", "attempts", "last_error"), r)) for r in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class Worker:
+    """types に載っている種類だけを concurrency 本並列で処理する"""
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        types: dict[str, JobType],
+        *,
+        concurrency: int = 2,
+        poll_sec: float = 5.0,
+        name: str = "worker",
+    ) -> None:
+        self.queue = queue
+        self.types = types
+        self.concurrency = concurrency
+        self.poll_sec = poll_sec
+        self.name = name
+        self._kinds = list(types)
+        self._lease = {k: t.timeout_sec + 60 for k, t in types.items()}
+        self._running: set[asyncio.Task] = set()
+        self._stop = asyncio.Event()
+
+    async def _claim(self) -> Optional[Job]:
+        return await asyncio.to_thread(self.queue.claim, self._kinds, self._lease)
+
+    async def _run(self, job: Job) -> None:
+        jt = self.types[job.kind]
+        try:
+            result = await asyncio.wait_for(jt.handler(job), jt.timeout_sec)
+        except asyncio.CancelledError:
+            # 停止時。lease 切れを待たずに次の起動ですぐ拾えるよう戻しておく
+            self.queue.retry(job, "cancelled (shutdown)", 0)
+            raise
+        except PermanentError as e:
+            logger.error("%s %s failed permanently: %s", job.kind, job.key, e)
+            await asyncio.to_thread(self.queue.bury, job, f"permanent: {e}")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                logger.error("%s %s gave up after %d attempts: %s", job.kind, job.key, job.attempts, error)
+                await asyncio.to_thread(self.queue.bury, job, error)
+                return
+            delay = e.delay if isinstance(e, RetryLater) else jt.retry.delay(job.attempts)
+            logger.warning("%s %s attempt %d failed (%s); retry in %.0fs", job.kind, job.key, job.attempts, error, delay)
+            await asyncio.to_thread(self.queue.retry, job, error, delay)
+        else:
+            logger.info("%s %s done", job.kind, job.key)
+            await asyncio.to_thread(self.queue.complete, job, result)
+
+    async def _fill(self) -> bool:
+        """空きスロットの分だけ claim して走らせる。1 件でも取れたら True"""
+        took = False
+        while len(self._running) < self.concurrency:
+            job = await self._claim()
+            if job is None:
+                break
+            took = True
+            task = asyncio.create_task(self._run(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        return took
+
+    async def run(self) -> None:
+        while not self._stop.is_set():
+            self.queue.wake.clear()
+            await self._fill()
+            waits = [asyncio.create_task(self.queue.wake.wait()), asyncio.create_task(self._stop.wait()), *self._running]
+            await asyncio.wait(waits, timeout=self.poll_sec, return_when=asyncio.FIRST_COMPLETED)
+            for w in waits[:2]:
+                w.cancel()
+        for task in list(self._running):
+            task.cancel()
+        await self.drain_running()
+
+    async def drain(self) -> None:
+        """今実行できるものが無くなるまで処理して戻る（--once 用。先の再試行は待たない）"""
+        while await self._fill() or self._running:
+            if self._running:
+                await asyncio.wait(set(self._running), return_when=asyncio.FIRST_COMPLETED)
+
+    async def drain_running(self) -> None:
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+@dataclass
+class Schedule:
+    """毎日 at（JST）に、day → (key, payload) で作ったジョブを kind として積む"""
+
+    kind: str
+    at: dtime
+    make: Callable[[date], tuple[str, dict]]
+    max_attempts: int = 5
+
+
+def parse_at(value: str) -> Optional[dtime]:
+    """'HH:MM'。空なら無効（そのスケジュールは積まない）"""
+    value = (value or "").strip()
+    if not value:
+        return None
+    return datetime.strptime(value, "%H:%M").time()
+
+
+class Scheduler:
+    def __init__(self, queue: JobQueue, schedules: list[Schedule], *, catchup_days: int = 3) -> None:
+        self.queue = queue
+        self.schedules = schedules
+        self.catchup_days = catchup_days
+        self._since: Optional[float] = None
+
+    def tick(self, now: Optional[datetime] = None) -> int:
+        """発火時刻を過ぎた分を積む（冪等キーがあるので何回呼んでもよい）。新しく積んだ数を返す"""
+        now = now or datetime.now(JST)
+        if self._since is None:
+            self._since = self.queue.watermark("scheduler_since")
+        added = 0
+        for s in self.schedules:
+            for back in range(self.catchup_days, -1, -1):
+                day = now.date() - timedelta(days=back)
+                fire = datetime.combine(day, s.at, JST)
+                if fire > now or fire.timestamp() < self._since:
+                    continue
+                key, payload = s.make(day)
+                if self.queue.enqueue(s.kind, payload, key=key, run_at=fire.timestamp(), max_attempts=s.max_attempts):
+                    logger.info("scheduled %s %s", s.kind, key)
+                    added += 1
+        return added
+
+    async def run(self, interval_sec: float = 60.0, stop: Optional[asyncio.Event] = None) -> None:
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            try:
+                self.tick()  # 数行の INSERT だけなのでループ上で（wake.set() もここから）
+            except Exception as e:
+                logger.warning("scheduler tick failed: %r", e)
+            try:
+                await asyncio.wait_for(stop.wait(), interval_sec)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,201 @@
+# llm.py
+"""
+OpenAI chat completion の共通入口（app.py / mushroom_app.py 共用）。
+
+- 同じ入力（model / messages / パラメータ）ならキャッシュから返す
+- TTL はルートごと（LLM_CACHE_TTL_*）。呼び出し側で上書き可（None = 無期限, 0 = 保存しない）
+- Cache-Control: no-cache / no-store ヘッダでキャッシュ読み出しをスキップ
+- キャッシュに無い時だけ共有リミッタ（ratelimit.py）で RPM / TPM を確保してから呼ぶ
+- 実際に呼んだ時の所要時間は router.observe へ（モデル選択の p95 に使う）
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import metrics
+import router
+from history_cache import estimate_tokens
+from llm_cache import MemoryCacheBackend, SQLiteCacheBackend, cache_key
+from ratelimit import Lease, QueueTimeout, RateLimiter
+
+# -----------------------------
+# Settings
+# -----------------------------
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")  # memory | sqlite | off
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+ROUTE_TTLS: dict[str, float] = {
+    "chat": float(os.getenv("LLM_CACHE_TTL_CHAT", "300")),
+    "daily_summary": float(os.getenv("LLM_CACHE_TTL_SUMMARY", "3600")),
+    "mushroom": float(os.getenv("LLM_CACHE_TTL_MUSHROOM", "600")),
+}
+
+# --- rate limit（0 = 無制限）---
+LLM_RPM = float(os.getenv("LLM_RPM", "500"))
+LLM_TPM = float(os.getenv("LLM_TPM", "200000"))
+LLM_KEY_MAX_INFLIGHT = int(os.getenv("LLM_KEY_MAX_INFLIGHT", "8"))  # テナントごとの同時実行数
+LLM_KEY_RPM = float(os.getenv("LLM_KEY_RPM", "0"))  # テナントごとの RPM（0 = 全体の RPM だけ）
+LLM_MAX_KEYS = int(os.getenv("LLM_MAX_KEYS", "10000"))  # キーごとのバケットを持つ上限（LRU）
+LLM_INTERACTIVE_RESERVE = float(os.getenv("LLM_INTERACTIVE_RESERVE", "0.2"))  # /chat 用に残す割合
+LLM_DEFAULT_COMPLETION_TOKENS = int(os.getenv("LLM_DEFAULT_COMPLETION_TOKENS", "400"))  # max_tokens 無指定時の見積もり
+
+# 優先度（小さいほど先）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+ROUTE_PRIORITY: dict[str, int] = {
+    "chat": PRIORITY_INTERACTIVE,
+    "daily_summary": PRIORITY_NORMAL,
+    "mushroom": PRIORITY_NORMAL,
+}
+
+# 待ち行列で待てる最大秒数
+ROUTE_QUEUE_TIMEOUTS: dict[str, float] = {
+    "chat": float(os.getenv("LLM_QUEUE_TIMEOUT_CHAT", "10")),
+    "daily_summary": float(os.getenv("LLM_QUEUE_TIMEOUT_SUMMARY", "60")),
+    "mushroom": float(os.getenv("LLM_QUEUE_TIMEOUT_MUSHROOM", "30")),
+}
+
+
+def _build_backend():
+    if LLM_CACHE_BACKEND == "sqlite":
+        return SQLiteCacheBackend(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES)
+    if LLM_CACHE_BACKEND == "memory":
+        return MemoryCacheBackend(LLM_CACHE_MAX_BYTES)
+    return None
+
+
+cache = _build_backend()
+
+limiter = RateLimiter(
+    rpm=LLM_RPM,
+    tpm=LLM_TPM,
+    key_max_inflight=LLM_KEY_MAX_INFLIGHT,
+    reserve=LLM_INTERACTIVE_RESERVE,
+    key_rpm=LLM_KEY_RPM,
+    max_keys=LLM_MAX_KEYS,
+)
+
+CACHE_LOOKUPS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_llm_cache_lookups_total", "Completion cache lookups", ("route", "result"),
+))
+QUEUE_WAIT = metrics.REGISTRY.register(metrics.Histogram(
+    "jarvis_llm_queue_wait_seconds", "Time spent waiting for rate limit budget", ("route",),
+))
+QUEUE_TIMEOUTS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_llm_queue_timeouts_total", "Requests that gave up waiting for rate limit budget", ("route",),
+))
+
+_ROUTE_DEFAULT: Any = object()
+
+
+@dataclass
+class Completion:
+    texts: list[str]
+    usage: Optional[dict] = None
+    cached: bool = False
+
+    @property
+    def text(self) -> str:
+        return self.texts[0] if self.texts else ""
+
+
+def cache_bypass(cache_control: Optional[str]) -> bool:
+    v = (cache_control or "").lower()
+    return "no-cache" in v or "no-store" in v
+
+
+def estimate_request_tokens(params: dict) -> int:
+    """プロンプト（バイト数からの概算）+ 出力上限 × n"""
+    prompt = sum(estimate_tokens(str(m.get("content") or "")) for m in params.get("messages", []))
+    completion = params.get("max_tokens") or params.get("max_completion_tokens") or LLM_DEFAULT_COMPLETION_TOKENS
+    return prompt + int(completion) * int(params.get("n") or 1)
+
+
+async def acquire(route: str, params: dict, *, key: str = "", priority: Optional[int] = None) -> Lease:
+    """
+    リミッタの枠を確保する（llm.complete 以外、例えばストリーミングで直接呼ぶ時用）。
+    使い終わったら lease.settle(usage の total_tokens) → lease.release()。
+    """
+    if priority is None:
+        priority = ROUTE_PRIORITY.get(route, PRIORITY_NORMAL)
+    try:
+        with metrics.stage("llm_queue"):
+            lease = await limiter.acquire(
+                estimate_request_tokens(params),
+                priority=priority,
+                key=key,
+                timeout=ROUTE_QUEUE_TIMEOUTS.get(route),
+            )
+    except QueueTimeout:
+        QUEUE_TIMEOUTS.inc(route=route)
+        raise
+    QUEUE_WAIT.observe(lease.waited, route=route)
+    return lease
+
+
+async def _cache_get(key: str) -> Optional[bytes]:
+    if isinstance(cache, SQLiteCacheBackend):
+        return await asyncio.to_thread(cache.get, key)
+    return cache.get(key)
+
+
+async def _cache_set(key: str, value: bytes, ttl: Optional[float]) -> None:
+    if isinstance(cache, SQLiteCacheBackend):
+        await asyncio.to_thread(cache.set, key, value, ttl)
+    else:
+        cache.set(key, value, ttl)
+
+
+async def complete(
+    client,
+    *,
+    route: str,
+    ttl: Optional[float] = _ROUTE_DEFAULT,
+    bypass: bool = False,
+    quota_key: str = "",
+    priority: Optional[int] = None,
+    scope: str = "",
+    **params,
+) -> Completion:
+    """
+    client.chat.completions.create(**params) のキャッシュ・レート制限付き版。
+    - ttl: 省略でルート既定値 / None で無期限 / 0 でキャッシュしない
+    - bypass: 読み出しをスキップ（結果は保存し直す）
+    - quota_key: キーごとの同時実行枠（テナント等）。priority: 省略でルート既定値
+    - scope: キャッシュをこの単位で分ける（テナント ID 等。別テナントの結果は返さない）
+    - 予算待ちが deadline を超えたら ratelimit.QueueTimeout
+    """
+    if ttl is _ROUTE_DEFAULT:
+        ttl = ROUTE_TTLS.get(route, 0)
+    use_cache = cache is not None and ttl != 0
+    key = cache_key({"scope": scope, "params": params} if scope else params) if use_cache else ""
+
+    if use_cache and not bypass:
+        hit = await _cache_get(key)
+        CACHE_LOOKUPS.inc(route=route, result="hit" if hit is not None else "miss")
+        if hit is not None:
+            data = json.loads(hit)
+            return Completion(texts=data["texts"], usage=data.get("usage"), cached=True)
+
+    async with await acquire(route, params, key=quota_key, priority=priority) as lease:
+        with metrics.stage("openai_completion"):
+            started = time.perf_counter()
+            completion = await client.chat.completions.create(**params)
+        router.observe(route, params.get("model", ""), time.perf_counter() - started)
+        usage = completion.usage.model_dump() if getattr(completion, "usage", None) else None
+        lease.settle((usage or {}).get("total_tokens"))
+    texts = [(c.message.content or "").strip() for c in completion.choices]
+    metrics.record_usage(route, params.get("model", ""), usage)
+
+    if use_cache:
+        value = json.dumps({"texts": texts, "usage": usage}, ensure_ascii=False).encode("utf-8")
+        await _cache_set(key, value, ttl)
+    return Completion(texts=texts, usage=usage)
@@ -0,0 +1,129 @@
+# llm_cache.py
+"""
+LLM 応答のコンテンツアドレス・キャッシュ。
+
+キー = sha256(model + messages + パラメータ の正規化 JSON)
+値   = JSON（choices のテキストと usage）
+
+バックエンド:
+- MemoryCacheBackend: プロセス内 LRU（合計バイト数で上限）
+- SQLiteCacheBackend: ディスク上の SQLite（再起動しても残る。同じく LRU + バイト上限）
+どちらも TTL（None = 無期限）を持つ。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def cache_key(params: dict) -> str:
+    canon = json.dumps(params, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, tuple[Optional[float], bytes]]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.time():
+            self._drop(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        if len(value) > self.max_bytes:
+            return
+        self._drop(key)
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._size += len(value)
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._data))
+            self._drop(oldest)
+
+    def _drop(self, key: str) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._size -= len(item[1])
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self._data), "bytes": self._size, "max_bytes": self.max_bytes}
+
+
+class SQLiteCacheBackend:
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_lru ON llm_cache(last_access)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, size, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, size, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._size -= size
+                return None
+            self._db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            old = self._db.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache(key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires_at, now),
+            )
+            self._size += len(value) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        # 期限切れを先に捨て、それでも溢れていたら古い順に
+        self._db.execute("DELETE FROM llm_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        rows = self._db.execute("SELECT key, size FROM llm_cache ORDER BY last_access ASC").fetchall()
+        doomed = []
+        for key, size in rows:
+            if self._size <= self.max_bytes:
+                break
+            doomed.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "entries": entries, "bytes": self._size, "max_bytes": self.max_bytes}
@@ -2,7 +2,6 @@ from http.client import HTTPException
 import os
 import sys
 from datetime import datetime, timedelta, timezone
-from supabase import create_client
 import app
 from fastapi import Response # type: ignore
 from fastapi.middleware.cors import CORSMiddleware # type: ignore
@@ -34,6 +33,8 @@ def main():
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
     user_id = get_env("SUPABASE_USER_ID")  # あなたのUUID
 
+    from supabase import create_client  # SDK は使う時だけ読み込む
+
     client = create_client(url, key)
 
     now_jst = datetime.now(JST)
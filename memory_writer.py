@@ -0,0 +1,258 @@
+# memory_writer.py
+"""
+memory_log の write-behind キュー。
+
+- enqueue() はメモリに積むだけ（ネットワーク往復なし）
+- バックグラウンドでまとめて bulk insert（件数 or 時間でフラッシュ）
+- 失敗時は指数バックオフ＋ジッタで再試行、それでもダメならローカルの
+  追記専用ファイル（JSONL）に退避し、次の成功時に再送する
+  （ファイルに書けなかった分はメモリに持って再送。壊れた行は <spill_path>.bad へ隔離）
+- バックグラウンドのループは例外で止めない（ログだけ残して次の周回へ）
+- pending() で「まだ Supabase に届いていない行」を返す（read-your-writes 用）
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger("memory_writer")
+
+InsertFn = Callable[[list[dict]], Awaitable[object]]
+
+
+def _parse_ts(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def row_identity(row: dict) -> tuple:
+    """
+    キュー上の行と Supabase から読んだ行を突き合わせるためのキー。
+    created_at はクライアント側で付けているので、正規化すれば一致する。
+    """
+    ts = row.get("created_at")
+    ts_key = _parse_ts(ts).astimezone(timezone.utc).isoformat() if ts else None
+    return (ts_key, row.get("speaker"), row.get("message"))
+
+
+class MemoryLogWriter:
+    def __init__(
+        self,
+        insert: InsertFn,
+        *,
+        batch_size: int = 50,
+        flush_interval_sec: float = 1.0,
+        max_retries: int = 5,
+        backoff_base_sec: float = 0.5,
+        backoff_max_sec: float = 10.0,
+        spill_path: Optional[str] = None,
+    ) -> None:
+        self._insert = insert
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.spill_path = spill_path
+
+        self._queue: list[dict] = []     # 未送信
+        self._inflight: list[dict] = []  # 送信中（まだ確定していない）
+        self._spilled: list[dict] = []   # このプロセスで退避した分（再送待ち）
+        self._unsaved: list[dict] = []   # 退避したがファイルに書けなかった分（メモリから再送）
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    # -----------------------------
+    # Public API
+    # -----------------------------
+    def enqueue(self, row: dict) -> dict:
+        """行を積む。created_at が無ければ今の UTC 時刻を付ける（並び順の保証）"""
+        row = dict(row)
+        row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+        self._queue.append(row)
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return row
+
+    def pending(
+        self,
+        *,
+        user_id: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[dict]:
+        """まだ Supabase で読めない可能性のある行（[start, end) で絞り込み）"""
+        out = []
+        for row in (*self._spilled, *self._inflight, *self._queue):
+            if user_id is not None and row.get("user_id") != user_id:
+                continue
+            if conversation_id is not None and row.get("conversation_id") != conversation_id:
+                continue
+            ts = _parse_ts(row["created_at"])
+            if start is not None and ts < start:
+                continue
+            if end is not None and ts >= end:
+                continue
+            out.append(row)
+        return out
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run(), name="memory-log-writer")
+
+    async def stop(self) -> None:
+        """残りを全部流してから止める（失敗分はファイルへ退避）"""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    # -----------------------------
+    # Internals
+    # -----------------------------
+    async def _run(self) -> None:
+        try:
+            await self._replay_spill()
+        except Exception as e:
+            logger.warning("spill replay failed: %r", e)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                while self._queue:
+                    await self._flush_once()
+                    if len(self._queue) < self.batch_size and not self._closing:
+                        break
+            except Exception as e:
+                # ここでタスクが死ぬと以後の行が永久に流れない
+                logger.warning("memory_log flush failed: %r", e)
+
+            if self._closing and not self._queue:
+                return
+
+    async def _flush_once(self) -> None:
+        batch = self._queue[: self.batch_size]
+        del self._queue[: len(batch)]
+        self._inflight = batch
+        try:
+            ok = await self._insert_with_retry(batch)
+            if ok:
+                await self._replay_spill()
+            else:
+                self._spill(batch)
+        finally:
+            self._inflight = []
+
+    async def _insert_with_retry(self, rows: list[dict]) -> bool:
+        # シャットダウン中は粘らない（再起動後にファイルから再送される）
+        retries = 1 if self._closing else self.max_retries
+        for attempt in range(retries):
+            try:
+                await self._insert(rows)
+                return True
+            except Exception as e:
+                if attempt + 1 >= retries:
+                    logger.warning("memory_log insert failed (%d rows): %r", len(rows), e)
+                    return False
+                delay = min(self.backoff_max_sec, self.backoff_base_sec * (2 ** attempt))
+                await asyncio.sleep(random.uniform(0, delay))
+        return False
+
+    def _spill(self, rows: list[dict]) -> None:
+        self._spilled.extend(rows)
+        if not self.spill_path:
+            self._unsaved.extend(rows)
+            return
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.warning("memory_log spill to %s failed (%d rows kept in memory): %r", self.spill_path, len(rows), e)
+            self._unsaved.extend(rows)
+
+    def _read_spill(self) -> list[dict]:
+        """退避ファイルの行。途中で切れた行・壊れた行は .bad に移して飛ばす"""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return []
+        rows: list[dict] = []
+        bad: list[str] = []
+        with open(self.spill_path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    bad.append(line)
+                    continue
+                if isinstance(row, dict) and row.get("created_at"):
+                    rows.append(row)
+                else:
+                    bad.append(line)
+        if bad:
+            logger.warning("skipping %d undecodable spilled rows (moved to %s.bad)", len(bad), self.spill_path)
+            try:
+                with open(f"{self.spill_path}.bad", "a", encoding="utf-8") as f:
+                    f.writelines(line if line.endswith("\n") else line + "\n" for line in bad)
+            except OSError as e:
+                logger.warning("could not quarantine bad spill rows: %r", e)
+        return rows
+
+    def _rewrite_spill(self, rows: list[dict]) -> bool:
+        """退避ファイルを rows だけで作り直す（空なら消す）。書けなければ False"""
+        if not self.spill_path:
+            return False
+        try:
+            if not rows:
+                if os.path.exists(self.spill_path):
+                    os.remove(self.spill_path)
+                return True
+            tmp = f"{self.spill_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.spill_path)
+            return True
+        except OSError as e:
+            logger.warning("memory_log spill rewrite failed: %r", e)
+            return False
+
+    async def _replay_spill(self) -> None:
+        """退避ファイル（とファイルに書けなかった分）を先頭から再送。全部通ったらファイルを消す"""
+        rows = self._read_spill() + self._unsaved
+        if not rows:
+            self._rewrite_spill([])
+            self._spilled.clear()
+            return
+
+        for i in range(0, len(rows), self.batch_size):
+            chunk = rows[i : i + self.batch_size]
+            try:
+                await self._insert(chunk)
+            except Exception as e:
+                logger.warning("spill replay stopped at row %d: %r", i, e)
+                # 送れた分を除いて書き戻す。書けなければメモリに持って次回に再送
+                rest = rows[i:]
+                self._spilled = rest
+                self._unsaved = [] if self._rewrite_spill(rest) else rest
+                return
+
+        self._spilled.clear()
+        self._unsaved = []
+        self._rewrite_spill([])
+        logger.info("replayed %d spilled memory_log rows", len(rows))
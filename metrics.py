@@ -0,0 +1,243 @@
+# metrics.py
+"""
+app.py / mushroom_app.py / jarvis_gateway.py 共通の計測。
+
+- stage("openai_completion") で区間を計測 → ヒストグラム + Server-Timing ヘッダ
+- ServerTimingMiddleware: リクエスト単位の所要時間・処理中件数・Server-Timing の付与
+- render() で Prometheus テキスト形式（/metrics 用）
+
+依存を増やさないよう、Prometheus クライアントは使わずに最小限を自前で持つ。
+"""
+from __future__ import annotations
+
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _fmt_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *a, **kw) -> None:
+        super().__init__(*a, **kw)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        k = self._key(labels)
+        self._values[k] = self._values.get(k, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def lines(self) -> list[str]:
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *a, buckets: tuple[float, ...] = LATENCY_BUCKETS, **kw) -> None:
+        super().__init__(*a, **kw)
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        k = self._key(labels)
+        row = self._values.get(k)
+        if row is None:
+            row = self._values[k] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def lines(self) -> list[str]:
+        out = []
+        for k, row in self._values.items():
+            for i, b in enumerate(self.buckets):
+                le = _fmt_labels(self.labels, k, 'le="%s"' % b)
+                out.append(f"{self.name}_bucket{le} {row[i]}")
+            le = _fmt_labels(self.labels, k, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{le} {row[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {row[-2]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {row[-1]}")
+        return out
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        out: list[str] = []
+        for m in self._metrics.values():
+            out += m.header()
+            out += m.lines()
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "jarvis_stage_duration_seconds", "Duration of an instrumented stage", ("service", "stage"),
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "jarvis_stage_errors_total", "Stages that raised", ("service", "stage"),
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "jarvis_http_request_duration_seconds", "HTTP request duration until response start", ("service", "route", "status"),
+))
+INFLIGHT = REGISTRY.register(Gauge(
+    "jarvis_http_requests_inflight", "HTTP requests currently being handled", ("service",),
+))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "jarvis_llm_tokens_total", "Tokens reported by completion.usage", ("route", "model", "kind"),
+))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# リクエスト内で計測した区間（Server-Timing 用）
+_timings: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("server_timings", default=None)
+
+# プロセス単位のサービス名（app / gateway）。バックグラウンドタスクの計測にも付く
+SERVICE = "jarvis"
+
+
+def set_service(name: str) -> None:
+    global SERVICE
+    SERVICE = name
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def authorized(authorization: Optional[str], token: Optional[str]) -> bool:
+    """METRICS_TOKEN を設定した時だけ Bearer を要求する"""
+    return not token or authorization == f"Bearer {token}"
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("supabase_insert"): ... の区間をヒストグラムと Server-Timing に記録"""
+    service = SERVICE
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(service=service, stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, service=service, stage=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def record_usage(route: str, model: str, usage: Optional[dict]) -> None:
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        n = usage.get(kind)
+        if n:
+            LLM_TOKENS.inc(n, route=route, model=model, kind=kind.replace("_tokens", ""))
+    # プロンプト接頭辞キャッシュに当たった分（prompt の内数）
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached:
+        LLM_TOKENS.inc(cached, route=route, model=model, kind="cached_prompt")
+
+
+def _server_timing(timings: list, total: float) -> str:
+    # 同じ区間が複数回あれば合算（例: supabase_select がページングで複数回）
+    merged: dict[str, float] = {}
+    for name, sec in timings:
+        merged[name] = merged.get(name, 0.0) + sec
+    parts = [f"{name};dur={sec * 1000:.1f}" for name, sec in merged.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class ServerTimingMiddleware:
+    """
+    素の ASGI ミドルウェア（BaseHTTPMiddleware だと contextvars がエンドポイントに伝わらない）。
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        service = SERVICE
+        timings: list = []
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        INFLIGHT.inc(service=service)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                total = time.perf_counter() - started
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", _server_timing(timings, total).encode("latin-1")))
+                message = {**message, "headers": headers}
+                # ルートのテンプレート（/daily_summary/{date} 等）でラベル付け。mount 先は root_path を前置
+                route = scope.get("route")
+                label = scope.get("root_path", "") + route.path if route is not None else "unmatched"
+                REQUEST_SECONDS.observe(
+                    total,
+                    service=service,
+                    route=label,
+                    status=str(message["status"]),
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            INFLIGHT.dec(service=service)
+            _timings.reset(token)
@@ -1,21 +1,45 @@
 # mushroom_app.py
+import asyncio
 import os
-from typing import Literal, Optional
+from typing import Annotated, Literal, Optional
 from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
-from openai import OpenAI
+
+import clients
+import llm
+import router
+from mushroom_pool import CandidatePool
+from ratelimit import QueueTimeout
+from wordscan import HotDictionary
 
 
 mush_app = FastAPI(title="Mushroom API")
 
+
+# mount 先の例外ハンドラは親 app から引き継がれないのでこちらにも置く
+@mush_app.exception_handler(QueueTimeout)
+async def _queue_timeout(_request, exc: QueueTimeout):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "rate limited"},
+        headers={"Retry-After": str(int(exc.retry_after + 0.999))},
+    )
+
 # ---- Auth ----
-def require_api_key(x_api_key: Optional[str]) -> None:
-    # 🍄専用キーがあればそれを優先。なければ既存のJARVIS_API_KEYを流用できる設計。
-    expected = os.getenv("MUSHROOM_API_KEY") or os.getenv("JARVIS_API_KEY")
+def require_api_key(x_api_key: Optional[str]) -> str:
+    """
+    通ったキーのテナント id を返す（レート制限のスコープ。キーそのものは quota_key に使わない）。
+    🍄専用キーがあればそれを優先。なければ既存のJARVIS_API_KEYを流用できる設計。
+    """
+    mushroom_key = os.getenv("MUSHROOM_API_KEY")
+    expected = mushroom_key or os.getenv("JARVIS_API_KEY")
     if not expected:
         raise HTTPException(status_code=500, detail="Missing env: MUSHROOM_API_KEY or JARVIS_API_KEY")
     if x_api_key != expected:
         raise HTTPException(status_code=401, detail="invalid api key")
+    # JARVIS_API_KEY は app.py の既定テナント（DEFAULT_TENANT）と同じ枠
+    return "key:mushroom" if mushroom_key else "default"
 
 # ---- Dictionaries ----
 STOP_WORDS = ["あなた", "君", "みんな", "大丈夫", "一人じゃない", "わかるよ", "救われ", "正しい", "間違い", "私たちは", "公式"]
@@ -23,15 +47,27 @@ NG_WORDS   = ["すべき", "してください", "考えて", "気づいて", "
               "嬉しい", "悲しい", "怒り", "好き", "嫌い", "私はAI", "AIです", "アルゴリズム", "モデル"]
 SWEET_WORDS = ["ありがとう", "ごめん", "寂しい", "会いたい", "消えたくない", "まだ話したい", "助けて"]
 
-def hit_any(text: str, words: list[str]) -> bool:
-    return any(w in text for w in words)
+# 3辞書まとめて 1 つの Aho–Corasick オートマトンにする。
+# MUSHROOM_DICT_PATH に JSON（{"stop": [...], "ng": [...], "sweet": [...]}）を置くと
+# そのカテゴリを差し替え、ファイル更新は再起動なしで反映される。
+dictionary = HotDictionary(
+    {"stop": STOP_WORDS, "ng": NG_WORDS, "sweet": SWEET_WORDS},
+    path=os.getenv("MUSHROOM_DICT_PATH"),
+    check_interval_sec=float(os.getenv("MUSHROOM_DICT_CHECK_SEC", "2")),
+)
 
 def scan_text(text: str) -> dict:
-    stop_hit  = hit_any(text, STOP_WORDS)
-    ng_hit    = hit_any(text, NG_WORDS)
-    sweet_hit = hit_any(text, SWEET_WORDS)
+    matches = dictionary.automaton.finditer(text)
+    cats = {m.category for m in matches}
+    stop_hit  = "stop" in cats
+    ng_hit    = "ng" in cats
+    sweet_hit = "sweet" in cats
     verdict = "停止" if stop_hit else ("要確認" if (ng_hit or sweet_hit) else "OK")
-    return {"stopHit": stop_hit, "ngHit": ng_hit, "sweetHit": sweet_hit, "verdict": verdict}
+    return {
+        "stopHit": stop_hit, "ngHit": ng_hit, "sweetHit": sweet_hit, "verdict": verdict,
+        # 編集用：どの語がどこに当たったか
+        "matches": [m._asdict() for m in matches],
+    }
 
 # ---- I/O ----
 Mode = Literal["Normal", "Experiment"]
@@ -45,14 +81,52 @@ class GenerateReq(BaseModel):
     temperature: Optional[float] = Field(default=None, ge=0.0, le=1.2)
 
 
+class Candidate(BaseModel):
+    text: str
+    scan: dict
+
+
 class GenerateRes(BaseModel):
+    # 先頭候補（従来互換）
     text: str
     scan: dict
+    # 全候補（verdict "OK" が先頭になるよう並べ替え済み）
+    candidates: list[Candidate] = Field(default_factory=list)
+
+
+class GenerateBulkReq(BaseModel):
+    mode: Mode = Field(default="Normal")
+    seeds: list[Annotated[str, Field(min_length=1)]] = Field(min_length=1, max_length=50)
+    maxChars: int = Field(default=120, ge=30, le=280)
+    hashtags: str = Field(default="")
+    count: int = Field(default=1, ge=1, le=5)
+    temperature: Optional[float] = Field(default=None, ge=0.0, le=1.2)
+
+
+class GenerateBulkRes(BaseModel):
+    results: list[GenerateRes]
 
 
 
 # ---- OpenAI ----
-oai = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+# クライアントは app.py と共有（clients.openai、初回利用時に生成）
+
+# /generate/bulk の同時実行数（OpenAI のレート上限に合わせて調整）
+MUSHROOM_BULK_CONCURRENCY = int(os.getenv("MUSHROOM_BULK_CONCURRENCY", "4"))
+
+# 作り置き候補プール（mushroom_pool.py）。補充の開始・停止は app.py の lifespan
+# 補充はリクエストが無くても裏で OpenAI を呼ぶ（最大 MUSHROOM_POOL_RPM 回/分）ので既定は無効。
+# 使う時は MUSHROOM_POOL_ENABLED=1 にして、RPM・HIGH・MAX_BUCKETS で課金の上限を決める
+MUSHROOM_POOL_ENABLED = os.getenv("MUSHROOM_POOL_ENABLED", "0") == "1"
+MUSHROOM_POOL_SEEDS = [s.strip() for s in os.getenv("MUSHROOM_POOL_SEEDS", "").split(",") if s.strip()]
+MUSHROOM_POOL_LOW = int(os.getenv("MUSHROOM_POOL_LOW", "2"))
+MUSHROOM_POOL_HIGH = int(os.getenv("MUSHROOM_POOL_HIGH", "6"))
+MUSHROOM_POOL_MAX_AGE_SEC = float(os.getenv("MUSHROOM_POOL_MAX_AGE_SEC", "3600"))
+MUSHROOM_POOL_MAX_BUCKETS = int(os.getenv("MUSHROOM_POOL_MAX_BUCKETS", "64"))
+MUSHROOM_POOL_MIN_HITS = int(os.getenv("MUSHROOM_POOL_MIN_HITS", "2"))  # この回数来た Seed をプールする
+MUSHROOM_POOL_RPM = float(os.getenv("MUSHROOM_POOL_RPM", "6"))  # 補充に使う completion の上限
+
+VERDICT_RANK = {"OK": 0, "要確認": 1, "停止": 2}
 
 def build_system_prompt(mode: Mode) -> str:
     stop = "……未整理。" if mode == "Experiment" else "未整理。"
@@ -75,42 +149,165 @@ def build_system_prompt(mode: Mode) -> str:
     return base
 
 
-@mush_app.post("/generate", response_model=GenerateRes)
-def generate(req: GenerateReq, x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY")):
+def _check_enabled() -> None:
     # feature flag（切りたい時は Renderの env で 0 にする）
     if os.getenv("MUSHROOM_ENABLED", "1") != "1":
         raise HTTPException(status_code=404, detail="disabled")
 
-    require_api_key(x_api_key)
 
-    system_prompt = build_system_prompt(req.mode)
+def postprocess(text: str, req: GenerateReq) -> dict:
+    # 末尾固定（保険）
+    stop_phrase = "……未整理。" if req.mode == "Experiment" else "未整理。"
+    if not text.endswith(stop_phrase):
+        text = (text[: max(0, req.maxChars - len(stop_phrase) - 1)]).rstrip()
+        text = f"{text}\n{stop_phrase}".strip()
+
+    # ハッシュタグ（任意）
+    if req.hashtags:
+        text = f"{text}\n{req.hashtags}".strip()
 
+    return {"text": text, "scan": scan_text(text)}
+
+
+def rank_candidates(cands: list[dict]) -> list[dict]:
+    """verdict が OK → 要確認 → 停止 の順。同じ verdict なら辞書ヒットの少ない順"""
+    def score(c: dict):
+        s = c["scan"]
+        return (VERDICT_RANK.get(s["verdict"], 9), s["stopHit"] + s["ngHit"] + s["sweetHit"])
+    return sorted(cands, key=score)
+
+
+async def generate_texts(
+    req: GenerateReq,
+    bypass: bool = False,
+    quota_key: str = "",
+    priority: Optional[int] = None,
+    cache: bool = True,
+) -> list[str]:
+    """
+    1 回の completion で n=count 本まとめて生成する（後処理前の本文）。
+    n が効かず本数が足りない時だけ、不足分を並列で追加生成する。
+    quota_key / priority はレート制限用（llm.complete にそのまま渡す）。cache=False は結果を保存しない
+    """
     temp = req.temperature
     if temp is None:
         temp = 0.6 if req.mode == "Experiment" else 0.4
 
-    completion = oai.chat.completions.create(
-        model="gpt-4o-mini",
+    # 出力は maxChars で切るので、ROUTER_CAPS=1 ならそれより長く生成させない（日本語は 1 文字 ≒ 1 トークン強）
+    cap = int(req.maxChars * 1.5) + 20 if router.ROUTER_CAPS else None
+    decision = router.choose("mushroom", text=req.seed, max_tokens=cap)
+    params = dict(
+        **decision.params(),
         messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Seed/観測メモ：{req.seed}\n目安文字数：{req.maxChars}\nHashtags：{req.hashtags}\n本数：{req.count}"},
+            {"role": "system", "content": build_system_prompt(req.mode)},
+            {"role": "user", "content": f"Seed/観測メモ：{req.seed}\n目安文字数：{req.maxChars}\nHashtags：{req.hashtags}"},
         ],
         temperature=temp,
     )
 
-    
+    limit = dict(quota_key=quota_key, priority=priority)
+    ttl = {} if cache else {"ttl": 0}
+    oai = await clients.openai.get()
+    completion = await llm.complete(oai, route="mushroom", bypass=bypass, n=req.count, **ttl, **limit, **params)
+    texts = list(completion.texts)
 
-    text = (completion.choices[0].message.content or "").strip()
+    shortfall = req.count - len(texts)
+    if shortfall > 0:
+        extra = await asyncio.gather(*(
+            llm.complete(oai, route="mushroom", ttl=0, **limit, **params) for _ in range(shortfall)
+        ))
+        texts += [c.text for c in extra]
+    return texts
 
-    # 末尾固定（保険）
-    stop_phrase = "……未整理。" if req.mode == "Experiment" else "未整理。"
-    if not text.endswith(stop_phrase):
-        text = (text[: max(0, req.maxChars - len(stop_phrase) - 1)]).rstrip()
-        text = f"{text}\n{stop_phrase}".strip()
 
-    # ハッシュタグ（任意）
-    if req.hashtags:
-        text = f"{text}\n{req.hashtags}".strip()
+async def _produce_for_pool(mode: str, seed: str, max_chars: int, n: int) -> list[str]:
+    """プールの補充: 同じ Seed で n 本作り、後処理して verdict "OK" のものだけ残す"""
+    req = GenerateReq(mode=mode, seed=seed, maxChars=max_chars, count=n)
+    texts = await generate_texts(req, quota_key="mushroom-pool", priority=llm.PRIORITY_BATCH, cache=False)
+    return [t for t in texts if postprocess(t, req)["scan"]["verdict"] == "OK"]
+
+
+def _build_pool() -> Optional[CandidatePool]:
+    if not MUSHROOM_POOL_ENABLED or os.getenv("MUSHROOM_ENABLED", "1") != "1":
+        return None
+    pool = CandidatePool(
+        _produce_for_pool,
+        low=MUSHROOM_POOL_LOW,
+        high=MUSHROOM_POOL_HIGH,
+        max_age_sec=MUSHROOM_POOL_MAX_AGE_SEC,
+        max_buckets=MUSHROOM_POOL_MAX_BUCKETS,
+        min_hits=MUSHROOM_POOL_MIN_HITS,
+        rpm=MUSHROOM_POOL_RPM,
+    )
+    default_chars = GenerateReq.model_fields["maxChars"].default
+    for mode in ("Normal", "Experiment"):
+        pool.pin(mode, MUSHROOM_POOL_SEEDS, default_chars)
+    return pool
+
+
+candidate_pool = _build_pool()
+
+
+async def generate_candidates(
+    req: GenerateReq,
+    bypass: bool = False,
+    quota_key: str = "",
+    priority: Optional[int] = None,
+) -> list[dict]:
+    """
+    プールに count 本あればそれを使い（待たない）、無ければその場で生成する。
+    温度指定・キャッシュ無視のリクエストはプールを使わない。
+    """
+    texts = None
+    if candidate_pool is not None and req.temperature is None and not bypass:
+        texts = candidate_pool.take(req.mode, req.seed, req.maxChars, req.count)
+    if texts is None:
+        texts = await generate_texts(req, bypass=bypass, quota_key=quota_key, priority=priority)
+    # ハッシュタグ付きや辞書の更新後でもここで scan し直す（プール分も verdict は最新の辞書で）
+    return rank_candidates([postprocess(t, req) for t in texts])
+
+
+def _to_response(cands: list[dict]) -> dict:
+    best = cands[0]
+    return {"text": best["text"], "scan": best["scan"], "candidates": cands}
+
+
+@mush_app.post("/generate", response_model=GenerateRes)
+async def generate(
+    req: GenerateReq,
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY"),
+    cache_control: Optional[str] = Header(default=None, alias="Cache-Control"),
+):
+    _check_enabled()
+    tenant_id = require_api_key(x_api_key)
+
+    cands = await generate_candidates(req, bypass=llm.cache_bypass(cache_control), quota_key=tenant_id)
+    return _to_response(cands)
+
+
+@mush_app.post("/generate/bulk", response_model=GenerateBulkRes)
+async def generate_bulk(
+    req: GenerateBulkReq,
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-KEY"),
+    cache_control: Optional[str] = Header(default=None, alias="Cache-Control"),
+):
+    """複数 Seed をまとめて処理（同時実行数は MUSHROOM_BULK_CONCURRENCY まで）。結果は seeds の順"""
+    _check_enabled()
+    tenant_id = require_api_key(x_api_key)
+
+    bypass = llm.cache_bypass(cache_control)
+    sem = asyncio.Semaphore(MUSHROOM_BULK_CONCURRENCY)
+    common = req.model_dump(exclude={"seeds"})
+
+    async def one(seed: str) -> dict:
+        async with sem:
+            cands = await generate_candidates(
+                GenerateReq(seed=seed, **common),
+                bypass=bypass,
+                quota_key=tenant_id,
+                priority=llm.PRIORITY_BATCH,
+            )
+        return _to_response(cands)
 
-    scan = scan_text(text)
-    return {"text": text, "scan": scan}
+    results = await asyncio.gather(*(one(s) for s in req.seeds))
+    return {"results": results}
@@ -0,0 +1,212 @@
+# mushroom_pool.py
+"""
+/mushroom/generate 用の作り置き候補プール（mushroom_app.py から使う。起動・停止は app.py の lifespan）。
+MUSHROOM_POOL_ENABLED=1 の時だけ動く（既定は無効）。
+
+- コスト: 補充は利用者のリクエストとは別に OpenAI を呼ぶ。多くて MUSHROOM_POOL_RPM 回/分
+  （既定 6 → 最大 8640 回/日）。捨てた候補（古い・verdict が OK でない）の分も課金される
+- バケット = (mode, 正規化した Seed, maxChars)。よく来る Seed だけプールする:
+  MUSHROOM_POOL_SEEDS（カンマ区切り）は起動時から両モード分、それ以外は
+  MUSHROOM_POOL_MIN_HITS 回来た Seed をバケットにする（最大 MUSHROOM_POOL_MAX_BUCKETS、古いものから外す）
+- 中身は生成済み・scan_text で verdict "OK" を通った本文だけ（produce 側で弾く）
+- take() は待たない（deque から取り出すだけ）。足りなければ None → 呼び出し側がその場で生成
+- 水位: LOW を下回ったバケットを HIGH まで補充。MAX_AGE_SEC より古い候補は捨てる
+- 補充は専用の RPM（MUSHROOM_POOL_RPM）と llm の PRIORITY_BATCH で、対話のリクエストより後回し
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Iterable, Optional
+
+import metrics
+from ratelimit import RateLimiter
+
+logger = logging.getLogger("mushroom_pool")
+
+# (mode, 正規化した seed, max_chars)
+PoolKey = tuple[str, str, int]
+# (mode, seed, max_chars, n) -> verdict "OK" の本文（n 本以下）。seed はそのバケットで最初に来た原文
+Produce = Callable[[str, str, int, int], Awaitable[list[str]]]
+
+POOL_LOOKUPS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_mushroom_pool_lookups_total", "Candidate pool lookups", ("result",),
+))
+POOL_CANDIDATES = metrics.REGISTRY.register(metrics.Gauge(
+    "jarvis_mushroom_pool_candidates", "Pre-generated candidates waiting in the pool", (),
+))
+POOL_REFILLS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_mushroom_pool_refills_total", "Pool refill calls", ("result",),
+))
+POOL_EVICTED = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_mushroom_pool_evicted_total", "Candidates dropped from the pool", ("reason",),
+))
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_seed(seed: str) -> str:
+    """全角・半角、大文字・小文字、空白の違いは同じバケット"""
+    return _SPACE_RE.sub(" ", unicodedata.normalize("NFKC", seed)).strip().lower()
+
+
+class CandidatePool:
+    def __init__(
+        self,
+        produce: Produce,
+        *,
+        low: int = 2,
+        high: int = 6,
+        max_age_sec: float = 3600.0,
+        max_buckets: int = 64,
+        min_hits: int = 2,
+        rpm: float = 6.0,
+        batch: int = 5,
+        interval_sec: float = 30.0,
+    ) -> None:
+        self.produce = produce
+        self.low = low
+        self.high = max(high, low)
+        self.max_age_sec = max_age_sec
+        self.max_buckets = max_buckets
+        self.min_hits = min_hits
+        self.batch = batch
+        self.interval_sec = interval_sec
+        self.limiter = RateLimiter(rpm=rpm)
+
+        # バケット（LRU）: key -> deque[(作った時刻, 本文)]。古い順に並ぶ
+        self._buckets: OrderedDict[PoolKey, deque[tuple[float, str]]] = OrderedDict()
+        self._seeds: dict[PoolKey, str] = {}  # バケット -> 生成に使う Seed の原文
+        self._pinned: set[PoolKey] = set()  # MUSHROOM_POOL_SEEDS（外さない）
+        self._hits: OrderedDict[PoolKey, int] = OrderedDict()  # まだバケットでない Seed の回数
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    # -----------------------------
+    # Buckets
+    # -----------------------------
+    @staticmethod
+    def key(mode: str, seed: str, max_chars: int) -> PoolKey:
+        return (mode, normalize_seed(seed), max_chars)
+
+    def pin(self, mode: str, seeds: Iterable[str], max_chars: int) -> None:
+        for seed in seeds:
+            key = self.key(mode, seed, max_chars)
+            self._pinned.add(key)
+            self._seeds.setdefault(key, seed)
+            self._buckets.setdefault(key, deque())
+        self._wake.set()
+
+    def _size(self) -> int:
+        return sum(len(q) for q in self._buckets.values())
+
+    def _evict_old(self, q: deque, now: float) -> None:
+        while q and now - q[0][0] > self.max_age_sec:
+            q.popleft()
+            POOL_EVICTED.inc(reason="age")
+
+    def _note(self, key: PoolKey, seed: str) -> None:
+        """バケットでない Seed の回数を数え、MIN_HITS に達したらバケットにする"""
+        n = self._hits.pop(key, 0) + 1
+        if n < self.min_hits:
+            self._hits[key] = n
+            while len(self._hits) > self.max_buckets * 16:
+                self._hits.popitem(last=False)
+            return
+        self._buckets[key] = deque()
+        self._seeds[key] = seed
+        while len(self._buckets) > self.max_buckets + len(self._pinned):
+            old = next((k for k in self._buckets if k not in self._pinned), None)
+            if old is None:
+                break
+            POOL_EVICTED.inc(len(self._buckets.pop(old)), reason="bucket")
+            self._seeds.pop(old, None)
+        self._wake.set()
+
+    def take(self, mode: str, seed: str, max_chars: int, n: int) -> Optional[list[str]]:
+        """n 本そろっていれば取り出して返す（古い順）。無ければ None"""
+        key = self.key(mode, seed, max_chars)
+        q = self._buckets.get(key)
+        if q is None:
+            POOL_LOOKUPS.inc(result="untracked")
+            self._note(key, seed)
+            return None
+        self._buckets.move_to_end(key)
+        self._evict_old(q, time.monotonic())
+        if len(q) < n:
+            POOL_LOOKUPS.inc(result="miss")
+            self._wake.set()
+            return None
+        texts = [q.popleft()[1] for _ in range(n)]
+        POOL_LOOKUPS.inc(result="hit")
+        POOL_CANDIDATES.set(self._size())
+        if len(q) < self.low:
+            self._wake.set()
+        return texts
+
+    # -----------------------------
+    # Refill
+    # -----------------------------
+    async def refill_once(self) -> int:
+        """LOW を下回ったバケットを HIGH まで。作った本数を返す"""
+        made = 0
+        now = time.monotonic()
+        for q in self._buckets.values():
+            self._evict_old(q, now)
+        for key in [k for k, q in self._buckets.items() if len(q) < self.low]:
+            while key in self._buckets and len(self._buckets[key]) < self.high:
+                n = min(self.batch, self.high - len(self._buckets[key]))
+                mode, _, max_chars = key
+                async with await self.limiter.acquire(0):
+                    try:
+                        texts = await self.produce(mode, self._seeds[key], max_chars, n)
+                    except Exception as e:
+                        POOL_REFILLS.inc(result="error")
+                        logger.warning("mushroom pool refill failed for %r: %r", key, e)
+                        break
+                POOL_REFILLS.inc(result="ok")
+                q = self._buckets.get(key)
+                if q is None:
+                    break  # 補充中にバケットが外れた
+                stamp = time.monotonic()
+                q.extend((stamp, t) for t in texts)
+                made += len(texts)
+                if not texts:
+                    break  # 全部弾かれた。次の周回で
+        POOL_CANDIDATES.set(self._size())
+        return made
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.refill_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("mushroom pool refill loop failed: %r", e)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="mushroom-pool")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self._buckets),
+            "candidates": self._size(),
+            "pinned": len(self._pinned),
+        }
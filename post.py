@@ -1,17 +1,25 @@
-import openai
 from datetime import timezone
+import time
+import router
+JARVIS_SYSTEM_PROMPT = "あなたは日々の生活に寄り添う、頼れるAIアシスタント『ジャービスたん』です。"
+DISCORD_TIMEOUT_SEC = 10
+
 def generate_jarvis_reply(user_message: str) -> str:
-    system_prompt = "あなたは日々の生活に寄り添う、頼れるAIアシスタント『ジャービスたん』です。"
+    system_prompt = JARVIS_SYSTEM_PROMPT
     try:
+        import openai  # SDK は使う時だけ読み込む
+
         client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        decision = router.choose("jarvis_post", text=user_message, max_tokens=300)
+        started = time.perf_counter()
         response = client.chat.completions.create(
-            model="gpt-4",
+            **decision.params(),
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_message}
             ],
-            max_tokens=300
         )
+        router.observe("jarvis_post", decision.model, time.perf_counter() - started)
         return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"OpenAI返答生成エラー: {e}")
@@ -19,11 +27,13 @@ def generate_jarvis_reply(user_message: str) -> str:
 
 # --- 構造整理・エラーハンドリング・環境変数チェック追加版 ---
 import os
-import openai
-import requests
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 from datetime import datetime
-from supabase import create_client, Client
+
+# openai / requests / supabase は使う直前に import（起動を軽くする）
+if TYPE_CHECKING:
+    from supabase import Client
 
 def load_env_vars():
     load_dotenv()
@@ -41,7 +51,7 @@ def load_env_vars():
         raise EnvironmentError(f"環境変数が未設定: {', '.join(missing)}")
     return env
 
-def get_today_message():
+def get_today_message(now=None):
     weekday_texts = {
         0: "月曜日だよ！今週もがんばろ〜💪",
         1: "火曜日！ちょっと慣れてきた？🐢",
@@ -51,13 +61,15 @@ def get_today_message():
         5: "土曜日〜🎉 ゆっくりできてる？",
         6: "日曜日😴 明日からの準備もぼちぼちね〜"
     }
-    today = datetime.now().weekday()
+    today = (now or datetime.now()).weekday()
     return weekday_texts.get(today, "やっほー！今日も元気？🌞")
 
 def post_to_discord(webhook_url, message):
+    import requests
+
     payload = {"content": message}
     try:
-        response = requests.post(webhook_url, json=payload)
+        response = requests.post(webhook_url, json=payload, timeout=DISCORD_TIMEOUT_SEC)
         if response.status_code == 204:
             print("送信成功！")
         else:
@@ -67,7 +79,7 @@ def post_to_discord(webhook_url, message):
         print(f"Discord送信エラー: {e}")
         return None
 
-def insert_to_supabase(supabase: Client, user_message):
+def insert_to_supabase(supabase: "Client", user_message):
     data = {
         "sender_type": "user",
         "sender_id": "00000000-0000-0000-0000-000000000000",  # 仮のUUID（全ゼロ）
@@ -91,10 +103,11 @@ def main():
         print(e)
         return
 
-    openai.api_key = env["OPENAI_API_KEY"]
     user_message = get_today_message()
 
     # ユーザー発言をSupabaseに保存
+    from supabase import create_client
+
     supabase = create_client(env["SUPABASE_URL"], env["SUPABASE_SERVICE_ROLE_KEY"])
     insert_to_supabase(supabase, user_message)
 
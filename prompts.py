@@ -0,0 +1,63 @@
+# prompts.py
+"""
+モード別の前置き（#waiting / #work / #edit / #note）。jarvis_gateway.py と app.py で共有。
+
+- 前置きは import 時に 1 回だけ組み立てる（リクエストごとに文字列を作らない）
+- ゲートウェイはタグを外した本文と mode / system を別フィールドで上流に渡す
+- app.py は「共通のシステムプロンプト + 前置き」をモードごとに 1 つ作っておき、
+  毎ターン同じバイト列を messages の先頭に置く（プロバイダのプロンプト接頭辞キャッシュが効く）
+"""
+from __future__ import annotations
+
+import re
+from typing import Literal, Optional, Tuple, get_args
+
+Mode = Literal["waiting", "work", "edit", "note"]
+MODES: Tuple[str, ...] = get_args(Mode)
+
+MODE_RE = re.compile(r"^\s*#(?P<mode>" + "|".join(MODES) + r")\b", re.IGNORECASE)
+
+# Short, stable rules. Designed to push "拾い" before explanations.
+BASE_PREAMBLE = (
+    "あなたは『拾い屋AI』。ユーザー発話の中にある "
+    "文字/音/意味/感情 のズレを最優先で拾い、まず反射で返す。"
+    "解説・最適化・結論づけは、ユーザーが求めた時だけ。"
+    "曖昧な時は候補を2〜3出し、一番萌える解釈で返す。"
+)
+
+_MODE_RULES = {
+    "waiting": (
+        "【#waiting】ここは永久凍結待合室。"
+        "意味づけ・正しさ・助言・手順は禁止。"
+        "萌え/空気/受けのみ。途中で閉じてよい。"
+    ),
+    "work": (
+        "【#work】要点整理・設計・手順化OK。結論あり。"
+        "ただし説教調や過剰な最適化は避ける。"
+    ),
+    "edit": "【#edit】文章の整形・トーン調整のみ。内容の追加提案はしない。",
+    "note": "【#note】非公開の下書き生成。投稿・拡散は前提にしない。",
+}
+
+# mode（None = タグなし）→ 前置き。ここで組み立て済み
+MODE_PREAMBLES: dict[Optional[str], str] = {
+    None: BASE_PREAMBLE,
+    **{mode: BASE_PREAMBLE + _MODE_RULES[mode] for mode in MODES},
+}
+
+
+def detect_mode(text: str) -> Tuple[Optional[str], str]:
+    """
+    Returns: (mode, stripped_text_without_mode_tag)
+    """
+    m = MODE_RE.match(text or "")
+    if not m:
+        return None, (text or "").strip()
+
+    mode = m.group("mode").lower()
+    stripped = MODE_RE.sub("", text, count=1).strip()
+    return mode, stripped
+
+
+def mode_preamble(mode: Optional[str]) -> str:
+    return MODE_PREAMBLES.get(mode, BASE_PREAMBLE)
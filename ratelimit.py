@@ -0,0 +1,257 @@
+# ratelimit.py
+"""
+OpenAI 呼び出しの前段に置く共有リミッタ（app.py / mushroom_app.py 共用、プロセス内で 1 つ）。
+
+- RPM / TPM をトークンバケットで管理。トークンは呼び出し前に見積もって確保し、
+  usage が返ったら実数で精算する（見積もりより多ければ借り越し＝後続が待つ）
+- 予算が足りない時は失敗させずに待ち行列へ。deadline を過ぎたら QueueTimeout
+- 優先度: 数字が小さいほど先（0 = /chat）。低優先度はバケットの reserve 分を使えない
+  （バックグラウンドが走っていても対話の分を残しておく）
+- キー（テナント）ごとの同時実行上限と、同じ優先度内ではインフライトの少ないキーから割り当て
+- key_rpm を設定するとキーごとにも RPM バケットを持つ（LRU で max_keys 個まで）。
+  上限に当たったキーだけ待たせ、他のキーは追い越して進む
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+class QueueTimeout(Exception):
+    """deadline までに予算を確保できなかった"""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """per_minute <= 0 なら無制限"""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _need(self, n: float, reserve: float) -> float:
+        # 容量より大きい要求は満タンになれば通す（永久に待たせない）
+        return min(n + reserve * self.capacity, self.capacity)
+
+    def can_take(self, n: float, reserve: float = 0.0) -> bool:
+        if self.unlimited:
+            return True
+        self._refill()
+        return self.level >= self._need(n, reserve)
+
+    def wait_time(self, n: float, reserve: float = 0.0) -> float:
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        return max(0.0, (self._need(n, reserve) - self.level) / self.rate)
+
+    def take(self, n: float) -> None:
+        if not self.unlimited:
+            self._refill()
+            self.level -= n
+
+    def give(self, n: float) -> None:
+        if not self.unlimited:
+            self._refill()
+            self.level = min(self.capacity, self.level + n)
+
+
+@dataclass
+class _Waiter:
+    priority: int
+    seq: int
+    key: str
+    tokens: int
+    future: asyncio.Future = field(repr=False)
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class Lease:
+    """acquire() の戻り値。settle() で実トークン数を精算し、release() で枠を返す"""
+
+    def __init__(self, limiter: "RateLimiter", key: str, tokens: int, waited: float) -> None:
+        self._limiter = limiter
+        self.key = key
+        self.tokens = tokens
+        self.waited = waited
+        self._released = False
+
+    def settle(self, actual_tokens: Optional[int]) -> None:
+        if actual_tokens is None or self._released:
+            return
+        self._limiter._reconcile(self.tokens, actual_tokens)
+        self.tokens = actual_tokens
+
+    def refund(self) -> None:
+        """呼び出しが失敗した時。トークンは返す（リクエスト数は返さない）"""
+        self.settle(0)
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter._release(self.key)
+
+    async def __aenter__(self) -> "Lease":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None and exc_type is not asyncio.CancelledError:
+            self.refund()
+        self.release()
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rpm: float = 0,
+        tpm: float = 0,
+        key_max_inflight: int = 0,
+        reserve: float = 0.0,
+        key_rpm: float = 0,
+        max_keys: int = 10000,
+    ) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.key_max_inflight = key_max_inflight  # 0 = 無制限
+        self.reserve = reserve  # 優先度 > 0 が残しておく割合
+        self.key_rpm = key_rpm  # 0 = キーごとの RPM なし
+        self.max_keys = max_keys
+        self._key_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._waiters: list[_Waiter] = []
+        self._inflight: dict[str, int] = {}
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.granted = 0
+        self.timeouts = 0
+
+    async def acquire(self, tokens: int, *, priority: int = 0, key: str = "", timeout: Optional[float] = None) -> Lease:
+        loop = asyncio.get_running_loop()
+        w = _Waiter(priority, next(self._seq), key, max(0, int(tokens)), loop.create_future())
+        self._waiters.append(w)
+        self._dispatch()
+
+        if not w.future.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(w.future), timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                self._abandon(w)
+                raise
+            if not w.future.done():
+                self._abandon(w)
+                self.timeouts += 1
+                raise QueueTimeout(self._retry_after(w))
+        return Lease(self, key, w.tokens, time.monotonic() - w.enqueued_at)
+
+    def _abandon(self, w: _Waiter) -> None:
+        if w.future.done() and not w.future.cancelled():
+            # 割り当て直後にキャンセルされた → 確保分を返す
+            self.tokens.give(w.tokens)
+            self._release(w.key)
+            return
+        w.future.cancel()
+        if w in self._waiters:
+            self._waiters.remove(w)
+        self._dispatch()
+
+    def _retry_after(self, w: _Waiter) -> float:
+        reserve = self.reserve if w.priority > 0 else 0.0
+        kb = self._key_buckets.get(w.key)
+        key_wait = kb.wait_time(1) if kb is not None else 0.0
+        return max(1.0, key_wait, self.requests.wait_time(1, reserve), self.tokens.wait_time(w.tokens, reserve))
+
+    def _key_full(self, key: str) -> bool:
+        return bool(self.key_max_inflight) and self._inflight.get(key, 0) >= self.key_max_inflight
+
+    def _key_bucket(self, key: str) -> Optional[TokenBucket]:
+        if self.key_rpm <= 0:
+            return None
+        bucket = self._key_buckets.get(key)
+        if bucket is None:
+            bucket = self._key_buckets[key] = TokenBucket(self.key_rpm)
+            while len(self._key_buckets) > self.max_keys:
+                self._key_buckets.popitem(last=False)
+        self._key_buckets.move_to_end(key)
+        return bucket
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        key_wait: Optional[float] = None  # キー単位の RPM で待たせた中で一番早く空く時間
+        # 優先度 → インフライトの少ないキー → 到着順
+        order = sorted(self._waiters, key=lambda w: (w.priority, self._inflight.get(w.key, 0), w.seq))
+        for w in order:
+            if self._key_full(w.key):
+                continue  # このキーだけ待たせて、他のキーは進める
+            kb = self._key_bucket(w.key)
+            if kb is not None and not kb.can_take(1):
+                wait = kb.wait_time(1)
+                key_wait = wait if key_wait is None else min(key_wait, wait)
+                continue
+            reserve = self.reserve if w.priority > 0 else 0.0
+            if self.requests.can_take(1, reserve) and self.tokens.can_take(w.tokens, reserve):
+                self.requests.take(1)
+                self.tokens.take(w.tokens)
+                if kb is not None:
+                    kb.take(1)
+                self._inflight[w.key] = self._inflight.get(w.key, 0) + 1
+                self._waiters.remove(w)
+                self.granted += 1
+                w.future.set_result(None)
+                continue
+            # 予算待ち。後ろの（低優先度の）要求に追い越させない
+            delay = max(self.requests.wait_time(1, reserve), self.tokens.wait_time(w.tokens, reserve))
+            if key_wait is not None:
+                delay = min(delay, key_wait)
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.01), self._dispatch)
+            return
+        if key_wait is not None:
+            self._timer = asyncio.get_running_loop().call_later(max(key_wait, 0.01), self._dispatch)
+
+    def _reconcile(self, estimated: int, actual: int) -> None:
+        if actual < estimated:
+            self.tokens.give(estimated - actual)
+        elif actual > estimated:
+            self.tokens.take(actual - estimated)
+        self._dispatch()
+
+    def _release(self, key: str) -> None:
+        n = self._inflight.get(key, 0) - 1
+        if n > 0:
+            self._inflight[key] = n
+        else:
+            self._inflight.pop(key, None)
+        if self._waiters:
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._waiters),
+            "inflight": sum(self._inflight.values()),
+            "granted": self.granted,
+            "timeouts": self.timeouts,
+            "keys": len(self._key_buckets),
+            "rpm_available": None if self.requests.unlimited else round(self.requests.level, 1),
+            "tpm_available": None if self.tokens.unlimited else round(self.tokens.level),
+        }
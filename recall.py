@@ -0,0 +1,418 @@
+# recall.py
+"""
+memory_log の意味検索（過去の会話の想起）。
+
+- Embedder: 埋め込みはバッチで取得し、(model, 本文) のハッシュで SQLite にキャッシュ（再インデックスが安い）
+- IVFIndex: NumPy の IVF（k-means の粗い量子化）。ベクトルはディスク上の float32 ファイルを memmap で読む
+- Recall: created_at のウォーターマークで差分だけ取り込むバックグラウンド indexer と、
+  /chat から呼ぶ search()（latency budget を超えたら空で返す = 返答は止めない）。
+  budget はローカルの索引検索だけに掛け、クエリの埋め込み（API の往復）は別の上限で待つ
+
+ディスク上のファイル（RECALL_INDEX_DIR）:
+  vectors.f32  N×dim の float32（追記のみ）
+  lists.i32    各ベクトルのクラスタ番号（未学習の間は -1）
+  centroids.npy, meta.jsonl（本文など）, state.json（ウォーターマーク等）, embeddings.sqlite3
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger("recall")
+
+RECALL_SEARCH = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_recall_searches_total", "Recall lookups from /chat", ("result",),
+))
+RECALL_INDEXED = metrics.REGISTRY.register(metrics.Gauge(
+    "jarvis_recall_indexed_rows", "Rows in the local recall index", (),
+))
+
+
+# -----------------------------
+# Embeddings
+# -----------------------------
+def text_hash(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """hash -> float32 ベクトル。indexer と検索の両方から使うのでスレッドセーフに"""
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+        self._db.commit()
+
+    def get_many(self, hashes: list[str]) -> dict[str, np.ndarray]:
+        out: dict[str, np.ndarray] = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for h, blob in self._db.execute(f"SELECT hash, vec FROM embeddings WHERE hash IN ({marks})", chunk):
+                    out[h] = np.frombuffer(blob, dtype=np.float32)
+        return out
+
+    def put_many(self, items: dict[str, np.ndarray]) -> None:
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+                [(h, v.astype(np.float32).tobytes()) for h, v in items.items()],
+            )
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def _normalize(m: np.ndarray) -> np.ndarray:
+    m = np.asarray(m, dtype=np.float32)
+    norms = np.linalg.norm(m, axis=-1, keepdims=True)
+    return m / np.maximum(norms, 1e-12)
+
+
+class Embedder:
+    def __init__(self, client, model: str, cache: EmbeddingCache, batch_size: int = 64) -> None:
+        self.client = client
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        """正規化済みの (len(texts), dim)。キャッシュに無い分だけ batch_size ずつ API へ"""
+        hashes = [text_hash(self.model, t) for t in texts]
+        found = await asyncio.to_thread(self.cache.get_many, list(dict.fromkeys(hashes)))
+
+        missing: dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h not in found:
+                missing.setdefault(h, t)
+        items = list(missing.items())
+        for i in range(0, len(items), self.batch_size):
+            batch = items[i:i + self.batch_size]
+            with metrics.stage("openai_embedding"):
+                res = await self.client.embeddings.create(model=self.model, input=[t for _, t in batch])
+            vecs = _normalize(np.array([d.embedding for d in sorted(res.data, key=lambda d: d.index)]))
+            new = {h: v for (h, _), v in zip(batch, vecs)}
+            await asyncio.to_thread(self.cache.put_many, new)
+            found.update(new)
+
+        return np.stack([found[h] for h in hashes]) if hashes else np.zeros((0, 0), dtype=np.float32)
+
+
+# -----------------------------
+# Index
+# -----------------------------
+def _kmeans(data: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """球面 k-means（内積で割り当て、重心は正規化）"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        for c in range(k):
+            members = data[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+            else:
+                centroids[c] = data[rng.integers(len(data))]
+        centroids = _normalize(centroids)
+    return centroids
+
+
+class IVFIndex:
+    """
+    学習前（件数が nlist * train_factor 未満）は全件の内積、学習後は nprobe 個のクラスタだけ見る。
+    件数が学習時の retrain_growth 倍になったら学習し直す。
+    """
+
+    def __init__(self, path: str, dim: int, nlist: int = 64, nprobe: int = 8, train_factor: int = 8, retrain_growth: float = 4.0) -> None:
+        self.path = path
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_factor = train_factor
+        self.retrain_growth = retrain_growth
+        os.makedirs(path, exist_ok=True)
+        self._vec_path = os.path.join(path, "vectors.f32")
+        self._list_path = os.path.join(path, "lists.i32")
+        self._centroid_path = os.path.join(path, "centroids.npy")
+        self._meta_path = os.path.join(path, "meta.jsonl")
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    def _load(self) -> None:
+        self.meta: list[dict] = []
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as f:
+                self.meta = [json.loads(line) for line in f if line.strip()]
+        # 書き込み途中で落ちた時は 3 ファイルの短い方に揃える
+        n = min(len(self.meta), self._rows_in(self._vec_path, self.dim * 4), self._rows_in(self._list_path, 4))
+        self._truncate(n, rewrite_meta=n != len(self.meta))
+        self.meta = self.meta[:n]
+        self.centroids: Optional[np.ndarray] = np.load(self._centroid_path) if os.path.exists(self._centroid_path) else None
+        self.trained_at = n if self.centroids is not None else 0
+        self._remap()
+
+    @staticmethod
+    def _rows_in(path: str, row_bytes: int) -> int:
+        return os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+
+    def _truncate(self, n: int, rewrite_meta: bool) -> None:
+        for path, row_bytes in ((self._vec_path, self.dim * 4), (self._list_path, 4)):
+            if os.path.exists(path) and os.path.getsize(path) != n * row_bytes:
+                with open(path, "r+b") as f:
+                    f.truncate(n * row_bytes)
+        if rewrite_meta:
+            with open(self._meta_path, "w", encoding="utf-8") as f:
+                for m in self.meta[:n]:
+                    f.write(json.dumps(m, ensure_ascii=False) + "\n")
+
+    def _remap(self) -> None:
+        n = len(self.meta)
+        if n:
+            self.vectors = np.memmap(self._vec_path, dtype=np.float32, mode="r", shape=(n, self.dim))
+            lists = np.fromfile(self._list_path, dtype=np.int32, count=n)
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            lists = np.zeros(0, dtype=np.int32)
+        self.lists = lists
+        self._members = (
+            [np.flatnonzero(lists == c) for c in range(len(self.centroids))]
+            if self.centroids is not None else None
+        )
+        RECALL_INDEXED.set(n)
+
+    def add(self, vectors: np.ndarray, metas: list[dict]) -> None:
+        if not len(metas):
+            return
+        vectors = _normalize(vectors).reshape(len(metas), self.dim)
+        with self._lock:
+            if self.centroids is not None:
+                assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+            else:
+                assign = np.full(len(metas), -1, dtype=np.int32)
+            with open(self._vec_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._list_path, "ab") as f:
+                f.write(assign.tobytes())
+            with open(self._meta_path, "a", encoding="utf-8") as f:
+                for m in metas:
+                    f.write(json.dumps(m, ensure_ascii=False) + "\n")
+            self.meta.extend(metas)
+            n = len(self.meta)
+            if n >= self.nlist * self.train_factor and (self.centroids is None or n >= self.trained_at * self.retrain_growth):
+                self._train(n)
+            self._remap()
+
+    def _train(self, n: int) -> None:
+        data = np.asarray(np.memmap(self._vec_path, dtype=np.float32, mode="r", shape=(n, self.dim)))
+        centroids = _kmeans(data, self.nlist)
+        assign = np.argmax(data @ centroids.T, axis=1).astype(np.int32)
+        np.save(self._centroid_path, centroids)
+        assign.tofile(self._list_path)
+        self.centroids = centroids
+        self.trained_at = n
+        logger.info("recall index trained: %d vectors, %d lists", n, self.nlist)
+
+    def search(self, query: np.ndarray, k: int) -> list[tuple[float, dict]]:
+        with self._lock:
+            vectors, members, centroids, meta = self.vectors, self._members, self.centroids, self.meta
+        if not len(meta):
+            return []
+        q = _normalize(query).reshape(self.dim)
+        if centroids is None:
+            candidates = np.arange(len(meta))
+        else:
+            probes = np.argsort(-(centroids @ q))[: self.nprobe]
+            # 学習後に追加された分もクラスタに振ってあるので members だけで足りる
+            candidates = np.concatenate([members[c] for c in probes])
+            if not len(candidates):
+                return []
+        scores = np.asarray(vectors[candidates]) @ q
+        top = min(k, len(candidates))
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), meta[int(candidates[i])]) for i in best]
+
+
+# -----------------------------
+# Indexer + retrieval
+# -----------------------------
+class Recall:
+    """
+    fetch_page(after_created_at, limit) -> 行のリスト（created_at 昇順、after 以上）。
+    app.py 側で Supabase のクエリを渡す（memory_writer と同じく、ここは DB を知らない）。
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        index: IVFIndex,
+        fetch_page: Callable[[Optional[str], int], Awaitable[list[dict]]],
+        page_size: int = 500,
+        interval_sec: float = 30.0,
+        min_score: float = 0.3,
+    ) -> None:
+        self.embedder = embedder
+        self.index = index
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.interval_sec = interval_sec
+        self.min_score = min_score
+        self._state_path = os.path.join(index.path, "state.json")
+        self._task: Optional[asyncio.Task] = None
+        self._load_state()
+
+    def _load_state(self) -> None:
+        self.watermark: Optional[str] = None
+        self._seen_at_watermark: set[str] = set()
+        if os.path.exists(self._state_path):
+            with open(self._state_path, encoding="utf-8") as f:
+                st = json.load(f)
+            if st.get("model") == self.embedder.model and st.get("count") == len(self.index):
+                self.watermark = st.get("watermark")
+                self._seen_at_watermark = set(st.get("seen_at_watermark", []))
+
+    def _save_state(self) -> None:
+        tmp = self._state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "model": self.embedder.model,
+                "count": len(self.index),
+                "watermark": self.watermark,
+                "seen_at_watermark": sorted(self._seen_at_watermark),
+            }, f, ensure_ascii=False)
+        os.replace(tmp, self._state_path)
+
+    @staticmethod
+    def _row_id(row: dict) -> str:
+        return hashlib.sha1(f"{row.get('created_at')}\n{row.get('speaker')}\n{row.get('message')}".encode("utf-8")).hexdigest()
+
+    async def index_once(self) -> int:
+        """ウォーターマーク以降を全部取り込む。戻り値は追加した行数"""
+        added = 0
+        while True:
+            rows = await self.fetch_page(self.watermark, self.page_size)
+            # 同じ created_at の行はページ境界をまたぐことがあるので、gte で取って既読を除く
+            fresh = [r for r in rows if not (r.get("created_at") == self.watermark and self._row_id(r) in self._seen_at_watermark)]
+            usable = [r for r in fresh if (r.get("message") or "").strip() and not r.get("report_key")]
+            if usable:
+                vecs = await self.embedder.embed([r["message"].strip() for r in usable])
+                metas = [
+                    {
+                        "created_at": r.get("created_at"),
+                        "conversation_id": r.get("conversation_id"),
+                        "speaker": r.get("speaker"),
+                        "message": r["message"].strip(),
+                    }
+                    for r in usable
+                ]
+                await asyncio.to_thread(self.index.add, vecs, metas)
+                added += len(usable)
+            for r in fresh:
+                ts = r.get("created_at")
+                if ts != self.watermark:
+                    self.watermark = ts
+                    self._seen_at_watermark = set()
+                self._seen_at_watermark.add(self._row_id(r))
+            if fresh:
+                self._save_state()
+            if len(rows) < self.page_size or not fresh:
+                return added
+
+    async def search(
+        self,
+        text: str,
+        k: int,
+        budget_sec: float,
+        exclude: Optional[set[str]] = None,
+        *,
+        embed_timeout_sec: float = 2.0,
+    ) -> list[dict]:
+        """
+        クエリの埋め込みは embed_timeout_sec まで、索引の検索は budget_sec まで待つ。超えたら []（/chat の応答を遅らせない）。
+        埋め込みは待つのをやめても止めない。キャッシュに入るので、同じ発言を後で索引に入れる時に API を呼ばずに済む。
+        """
+        text = text.strip()
+        if not len(self.index) or not text:
+            return []
+
+        embedding = asyncio.ensure_future(self.embedder.embed([text]))
+        embedding.add_done_callback(lambda t: t.cancelled() or t.exception())  # 置き去りにした時の例外を拾う
+        try:
+            with metrics.stage("recall_embed"):
+                q = await asyncio.wait_for(asyncio.shield(embedding), embed_timeout_sec)
+        except asyncio.TimeoutError:
+            RECALL_SEARCH.inc(result="embed_timeout")
+            return []
+        except Exception as e:
+            logger.warning("recall embedding failed: %r", e)
+            RECALL_SEARCH.inc(result="error")
+            return []
+
+        try:
+            with metrics.stage("recall"):
+                hits = await asyncio.wait_for(
+                    asyncio.to_thread(self.index.search, q[0], k + len(exclude or ())), budget_sec,
+                )
+        except asyncio.TimeoutError:
+            RECALL_SEARCH.inc(result="timeout")
+            return []
+        except Exception as e:
+            logger.warning("recall search failed: %r", e)
+            RECALL_SEARCH.inc(result="error")
+            return []
+        out = [m for score, m in hits if score >= self.min_score and m["message"] not in (exclude or ())][:k]
+        RECALL_SEARCH.inc(result="hit" if out else "empty")
+        return out
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                n = await self.index_once()
+                if n:
+                    logger.info("recall indexed %d rows (watermark %s)", n, self.watermark)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("recall indexing failed, will retry: %r", e)
+            await asyncio.sleep(self.interval_sec)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.embedder.cache.close()
+
+
+def format_memories(memories: list[dict]) -> str:
+    """プロンプトに差し込む形（古い順）"""
+    lines = ["参考: 過去の会話から関連しそうな発言（必要な時だけ踏まえる）"]
+    for m in sorted(memories, key=lambda m: m.get("created_at") or ""):
+        who = "あなた" if m.get("speaker") == "bot" else "ユーザー"
+        day = (m.get("created_at") or "")[:10]
+        lines.append(f"- [{day}] {who}: {m['message']}")
+    return "\n".join(lines)
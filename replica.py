@@ -0,0 +1,281 @@
+# replica.py
+"""
+memory_log のローカル読み取りレプリカ（SQLite 1 ファイル）。app.py から使う。
+
+- 書き込み: 自分の書き込み（write-behind に積んだ行・要約の upsert）は apply() で即時に反映、
+  他プロセスの分は (created_at, id) のウォーターマークから定期的に差分を取り込む
+- 取り込みは毎回 overlap_sec だけ巻き戻して読み直す（クライアント側で created_at を付ける
+  write-behind の行は少し遅れて Supabase に届くため）。同じ行は ident で 1 行にまとまる
+- 読み出し: (user_id, conversation_id, created_at) のインデックスで日単位・直近 N 件を引く
+- fresh(): 最後の取り込み成功が max_staleness_sec 以内 かつ 初回の追いつきが済んでいる時だけ True。
+  False の間や、保持範囲（since_days）より古い日は呼び出し側が Supabase を読む
+- 取り込み後の更新（既存行の message を後から書き換える upsert）は、overlap より古いと拾えない。
+  会話行は追記だけなので、日次ログと履歴の読み出しには影響しない
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+import metrics
+from summarizer import utc_iso  # 並び順がそのまま文字列比較で済むよう UTC・マイクロ秒まで揃える
+
+logger = logging.getLogger("replica")
+
+COLUMNS = ("user_id", "conversation_id", "created_at", "speaker", "message", "sender_type", "persona", "report_key")
+
+# (after_cursor, since_iso, limit) -> 古い順の行（id / created_at を含む）
+FetchPage = Callable[[Optional[dict], Optional[str], int], Awaitable[list[dict]]]
+
+REPLICA_READS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_replica_reads_total", "memory_log reads by source", ("query", "source"),
+))
+REPLICA_LAG = metrics.REGISTRY.register(metrics.Gauge(
+    "jarvis_replica_lag_seconds", "Seconds since the last successful replica pull", (),
+))
+REPLICA_ROWS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_replica_rows_total", "Rows written to the local replica", ("source",),
+))
+
+
+def _ident(row: dict, created_at: str) -> str:
+    # report_key 付き（日報・要約）は upsert なのでキーで 1 行。会話行は memory_writer.row_identity と同じ考え方
+    if row.get("report_key"):
+        return "rk:" + row["report_key"]
+    raw = json.dumps(
+        [row.get("user_id"), row.get("conversation_id"), created_at, row.get("speaker"), row.get("message")],
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class Replica:
+    """apply / upsert_report / day_rows / recent_rows は同期の SQLite。イベントループからは asyncio.to_thread 経由で呼ぶ"""
+
+    def __init__(
+        self,
+        path: str,
+        fetch_page: FetchPage,
+        *,
+        page_size: int = 1000,
+        interval_sec: float = 5.0,
+        max_staleness_sec: float = 30.0,
+        overlap_sec: float = 120.0,
+        since_days: Optional[float] = 35,
+    ) -> None:
+        self.path = path
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.interval_sec = interval_sec
+        self.max_staleness_sec = max_staleness_sec
+        self.overlap_sec = overlap_sec
+        self.since_days = since_days
+
+        # 書き込み用（取り込みスレッド・イベントループの両方から）と読み出し用。読みも to_thread の各スレッドから
+        # 同時に来るので、1 本の接続を _rlock で直列化する。WAL なので読みが書き込みに待たされることはない
+        self._wlock = threading.Lock()
+        self._w = sqlite3.connect(path, check_same_thread=False)
+        self._w.execute("PRAGMA journal_mode=WAL")
+        self._w.execute("PRAGMA synchronous=NORMAL")
+        self._w.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS memory_log (
+                ident TEXT PRIMARY KEY,
+                user_id TEXT,
+                conversation_id TEXT,
+                created_at TEXT NOT NULL,
+                speaker TEXT,
+                message TEXT,
+                sender_type TEXT,
+                persona TEXT,
+                report_key TEXT
+            );
+            CREATE INDEX IF NOT EXISTS memory_log_uct ON memory_log (user_id, conversation_id, created_at);
+            CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT NOT NULL);
+            """
+        )
+        self._w.commit()
+        self._rlock = threading.Lock()
+        self._r = sqlite3.connect(path, check_same_thread=False)
+        self._r.row_factory = sqlite3.Row
+
+        meta = dict(self._w.execute("SELECT k, v FROM meta").fetchall())
+        self.cursor: Optional[dict] = json.loads(meta["cursor"]) if "cursor" in meta else None
+        self.covered_from: Optional[str] = meta.get("covered_from")  # これより前は取り込んでいない
+        self.caught_up = False  # このプロセスで 1 度は末尾まで読んだか
+        self.last_pull_ok: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    # -----------------------------
+    # Writes
+    # -----------------------------
+    def apply(self, rows: list[dict], source: str = "local") -> None:
+        """自分の書き込みをそのまま反映（created_at はクライアントで付けたもの）"""
+        values = []
+        for r in rows:
+            if not r.get("created_at"):
+                continue
+            ts = utc_iso(r["created_at"])
+            values.append((_ident(r, ts), *(ts if c == "created_at" else r.get(c) for c in COLUMNS)))
+        if not values:
+            return
+        with self._wlock:
+            self._w.executemany(
+                f"INSERT OR REPLACE INTO memory_log (ident, {', '.join(COLUMNS)}) VALUES ({', '.join('?' * (len(COLUMNS) + 1))})",
+                values,
+            )
+            self._w.commit()
+        REPLICA_ROWS.inc(len(values), source=source)
+
+    def upsert_report(self, row: dict) -> None:
+        """要約・日報の upsert。created_at は既存行のものを残す（無ければ今）"""
+        with self._wlock:
+            old = self._w.execute(
+                "SELECT created_at FROM memory_log WHERE ident = ?", ("rk:" + row["report_key"],),
+            ).fetchone()
+        created_at = old[0] if old else datetime.now(timezone.utc).isoformat()
+        self.apply([{**row, "created_at": row.get("created_at") or created_at}])
+
+    def _save_meta(self, **items: str) -> None:
+        self._w.executemany("INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)", list(items.items()))
+
+    def _apply_page(self, rows: list[dict], cursor: dict, covered_from: Optional[str]) -> None:
+        self.apply(rows, source="pull")
+        with self._wlock:
+            meta = {"cursor": json.dumps(cursor)}
+            if covered_from is not None:
+                meta["covered_from"] = covered_from
+            self._save_meta(**meta)
+            self._w.commit()
+
+    # -----------------------------
+    # Pull
+    # -----------------------------
+    async def pull_once(self) -> int:
+        """ウォーターマーク（から overlap 戻した所）以降を末尾まで取り込む。取り込んだ行数を返す"""
+        since: Optional[str] = None
+        covered_from: Optional[str] = None
+        if self.cursor is None:
+            if self.since_days is not None:
+                since = (datetime.now(timezone.utc) - timedelta(days=self.since_days)).isoformat()
+            covered_from = since or ""
+            cursor = None
+        else:
+            # 遅れて届く行のために少し巻き戻す（id は 0 から = その時刻以降を全部）
+            back = datetime.fromisoformat(self.cursor["created_at"]) - timedelta(seconds=self.overlap_sec)
+            cursor = {"created_at": back.isoformat(), "id": 0}
+
+        total = 0
+        while True:
+            with metrics.stage("replica_pull"):
+                rows = await self.fetch_page(cursor, since, self.page_size)
+            if rows:
+                last = rows[-1]
+                cursor = {"created_at": utc_iso(last["created_at"]), "id": last["id"]}
+                if self.cursor is None or cursor["created_at"] >= self.cursor["created_at"]:
+                    new_cursor = cursor
+                else:
+                    new_cursor = self.cursor  # overlap 読み直しの途中。ウォーターマークは戻さない
+                await asyncio.to_thread(self._apply_page, rows, new_cursor, covered_from)
+                self.cursor = new_cursor
+                if covered_from is not None:
+                    self.covered_from = covered_from
+                    covered_from = None
+                total += len(rows)
+            if len(rows) < self.page_size:
+                break
+
+        if self.cursor is None:
+            # 空のテーブル。次回からは overlap 読み直しで
+            self.cursor = {"created_at": datetime.now(timezone.utc).isoformat(), "id": 0}
+            self.covered_from = self.covered_from if self.covered_from is not None else (since or "")
+            await asyncio.to_thread(self._apply_page, [], self.cursor, self.covered_from)
+        self.caught_up = True
+        self.last_pull_ok = time.monotonic()
+        REPLICA_LAG.set(0.0)
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                n = await self.pull_once()
+                if n:
+                    logger.debug("replica pulled %d rows", n)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("replica pull failed: %r", e)
+            await asyncio.sleep(self.interval_sec)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="replica-pull")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        with self._wlock:
+            self._w.close()
+        with self._rlock:
+            self._r.close()
+
+    # -----------------------------
+    # Reads
+    # -----------------------------
+    def lag(self) -> Optional[float]:
+        if self.last_pull_ok is None:
+            return None
+        lag = time.monotonic() - self.last_pull_ok
+        REPLICA_LAG.set(lag)
+        return lag
+
+    def fresh(self) -> bool:
+        lag = self.lag()
+        return self.caught_up and lag is not None and lag <= self.max_staleness_sec
+
+    def covers(self, start: Optional[datetime]) -> bool:
+        """start 以降（None = 最初から）の行をすべて持っているか。保持範囲の外なら Supabase へ"""
+        if self.covered_from is None:
+            return False
+        if self.covered_from == "":
+            return True
+        return start is not None and utc_iso(start.isoformat()) >= utc_iso(self.covered_from)
+
+    def day_rows(
+        self, user_id: str, conversation_id: str, start: datetime, end: datetime, limit: Optional[int] = None,
+    ) -> list[dict]:
+        sql = (
+            "SELECT created_at, speaker, message, sender_type, persona, report_key FROM memory_log"
+            " WHERE user_id = ? AND conversation_id = ? AND created_at >= ? AND created_at < ?"
+            " ORDER BY created_at, rowid"
+        )
+        args: list = [user_id, conversation_id, utc_iso(start.isoformat()), utc_iso(end.isoformat())]
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with metrics.stage("replica_select"), self._rlock:
+            return [dict(r) for r in self._r.execute(sql, args)]
+
+    def recent_rows(self, user_id: str, conversation_id: str, limit: int) -> list[dict]:
+        """新しい順に limit 件取って時系列に戻す"""
+        with metrics.stage("replica_select"), self._rlock:
+            rows = self._r.execute(
+                "SELECT created_at, speaker, message, report_key FROM memory_log"
+                " WHERE user_id = ? AND conversation_id = ? ORDER BY created_at DESC, rowid DESC LIMIT ?",
+                (user_id, conversation_id, limit),
+            ).fetchall()
+        return [dict(r) for r in reversed(rows)]
+
+    def stats(self) -> dict:
+        with self._rlock:
+            n = self._r.execute("SELECT COUNT(*) FROM memory_log").fetchone()[0]
+        return {"rows": n, "caught_up": self.caught_up, "lag_sec": self.lag(), "covered_from": self.covered_from}
@@ -0,0 +1,218 @@
+# router.py
+"""
+ルート・モード・入力の長さからモデルと max_tokens を選ぶ（app.py / mushroom_app.py / worker.py / post.py 共用）。
+
+- 規則: ROUTE_RULES の上から最初に合ったもの（route, mode, 入力トークン数の下限）
+  既定は従来どおり（雑談・要約・きのこは gpt-4o-mini、jarvis_post は gpt-4、max_tokens は呼び出し側が決めたものだけ）
+- ROUTER_ESCALATE=1 で #work や長い入力を重いモデル（ROUTER_STRONG_MODEL）へ。料金が上がるので明示した時だけ
+- ROUTER_CAPS=1 で規則ごとの max_tokens 上限（雑談 400・#waiting 200・要約 600 など）を付ける。返答が途中で切れうる
+- ルートごとに遅延の SLO（ROUTER_SLO_*_SEC）。第一候補のモデルの直近 p95 が SLO を超えている間は
+  ROUTER_FALLBACK_MODEL（速いモデル）に逃がす
+- 遅延は llm.complete（とストリーミング）が observe() で渡す。(route, model) ごとに直近 ROUTER_WINDOW_SEC 秒、
+  ROUTER_MIN_SAMPLES 件以上ある時だけ判定する。逃がしている間は第一候補の計測が止まるので、
+  窓から古い計測が抜けると第一候補に戻る（＝ 窓の長さごとに 1 回試し直す）
+- 決定は jarvis_router_decisions_total{route, model, reason} に記録（reason: rule / slo_fallback / override）
+"""
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+from history_cache import estimate_tokens
+
+# -----------------------------
+# Settings
+# -----------------------------
+FAST_MODEL = os.getenv("ROUTER_FAST_MODEL", "gpt-4o-mini")
+STRONG_MODEL = os.getenv("ROUTER_STRONG_MODEL", "gpt-4o")
+POST_MODEL = os.getenv("ROUTER_POST_MODEL", "gpt-4")  # jarvis_post（post.py / worker.py）の従来のモデル
+FALLBACK_MODEL = os.getenv("ROUTER_FALLBACK_MODEL", FAST_MODEL)
+ROUTER_ESCALATE = os.getenv("ROUTER_ESCALATE", "0") == "1"  # escalate=True の規則を使う
+ROUTER_CAPS = os.getenv("ROUTER_CAPS", "0") == "1"  # 規則の max_tokens を使う（呼び出し側の上限は常に使う）
+LONG_INPUT_TOKENS = int(os.getenv("ROUTER_LONG_INPUT_TOKENS", "400"))  # これ以上は「長い入力」
+
+ROUTER_WINDOW_SEC = float(os.getenv("ROUTER_WINDOW_SEC", "300"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "20"))
+ROUTER_MAX_SAMPLES = int(os.getenv("ROUTER_MAX_SAMPLES", "500"))
+
+# p95 の上限（秒）。0 = SLO なし（フォールバックしない）
+ROUTE_SLOS: dict[str, float] = {
+    "chat": float(os.getenv("ROUTER_SLO_CHAT_SEC", "6")),
+    "mushroom": float(os.getenv("ROUTER_SLO_MUSHROOM_SEC", "10")),
+    "daily_summary": float(os.getenv("ROUTER_SLO_DAILY_SUMMARY_SEC", "30")),
+    "jarvis_post": float(os.getenv("ROUTER_SLO_JARVIS_POST_SEC", "30")),
+}
+
+
+@dataclass(frozen=True)
+class Rule:
+    route: str
+    model: str
+    max_tokens: Optional[int]
+    mode: Optional[str] = "*"  # "*" = どのモードでも / None = タグなし
+    min_input_tokens: int = 0
+    escalate: bool = False  # ROUTER_ESCALATE=1 の時だけ使う
+
+
+# 上から順に見る。route ごとに最後の行が既定（従来のモデル）。max_tokens は ROUTER_CAPS=1 の時だけ効く
+ROUTE_RULES: tuple[Rule, ...] = (
+    Rule("chat", FAST_MODEL, 200, mode="waiting"),
+    Rule("chat", STRONG_MODEL, 800, mode="work", escalate=True),
+    Rule("chat", STRONG_MODEL, 1200, mode="edit", min_input_tokens=LONG_INPUT_TOKENS, escalate=True),
+    Rule("chat", FAST_MODEL, 800, mode="edit"),
+    Rule("chat", FAST_MODEL, 600, mode="note"),
+    Rule("chat", STRONG_MODEL, 600, min_input_tokens=LONG_INPUT_TOKENS, escalate=True),
+    Rule("chat", FAST_MODEL, 400),
+    Rule("mushroom", FAST_MODEL, None),
+    Rule("daily_summary", FAST_MODEL, 600),
+    Rule("jarvis_post", STRONG_MODEL, None, escalate=True),
+    Rule("jarvis_post", POST_MODEL, None),
+)
+
+ROUTER_DECISIONS = metrics.REGISTRY.register(metrics.Counter(
+    "jarvis_router_decisions_total", "Model routing decisions", ("route", "model", "reason"),
+))
+ROUTER_P95 = metrics.REGISTRY.register(metrics.Gauge(
+    "jarvis_router_p95_seconds", "Rolling p95 completion latency used for routing", ("route", "model"),
+))
+
+
+@dataclass(frozen=True)
+class Decision:
+    model: str
+    max_tokens: Optional[int]
+    reason: str  # rule | slo_fallback | override
+    preferred: str
+
+    def params(self) -> dict:
+        """chat.completions.create にそのまま足す引数"""
+        out = {"model": self.model}
+        if self.max_tokens:
+            out["max_tokens"] = self.max_tokens
+        return out
+
+
+class _Window:
+    """直近 window 秒の所要時間。p95 は追加・期限切れの時だけ計算し直す"""
+
+    def __init__(self, window_sec: float, max_samples: int) -> None:
+        self.window_sec = window_sec
+        self.samples: deque[tuple[float, float]] = deque(maxlen=max_samples)
+        self._p95: Optional[float] = None
+        self._dirty = False
+
+    def add(self, now: float, seconds: float) -> None:
+        self.samples.append((now, seconds))
+        self._dirty = True
+
+    def p95(self, now: float, min_samples: int) -> Optional[float]:
+        while self.samples and now - self.samples[0][0] > self.window_sec:
+            self.samples.popleft()
+            self._dirty = True
+        if self._dirty:
+            self._dirty = False
+            if len(self.samples) < min_samples:
+                self._p95 = None
+            else:
+                ordered = sorted(s for _, s in self.samples)
+                self._p95 = ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+        return self._p95
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        rules: tuple[Rule, ...] = ROUTE_RULES,
+        slos: Optional[dict[str, float]] = None,
+        *,
+        fallback_model: str = FALLBACK_MODEL,
+        escalate: bool = ROUTER_ESCALATE,
+        caps: bool = ROUTER_CAPS,
+        window_sec: float = ROUTER_WINDOW_SEC,
+        min_samples: int = ROUTER_MIN_SAMPLES,
+        max_samples: int = ROUTER_MAX_SAMPLES,
+    ) -> None:
+        self.rules = rules
+        self.slos = ROUTE_SLOS if slos is None else slos
+        self.fallback_model = fallback_model
+        self.escalate = escalate
+        self.caps = caps
+        self.window_sec = window_sec
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self._windows: dict[tuple[str, str], _Window] = {}
+        self._lock = threading.Lock()  # post.py（同期）や to_thread からも呼ばれる
+
+    def _rule(self, route: str, mode: Optional[str], input_tokens: int) -> Optional[Rule]:
+        for rule in self.rules:
+            if rule.route != route or input_tokens < rule.min_input_tokens:
+                continue
+            if rule.escalate and not self.escalate:
+                continue
+            if rule.mode == "*" or rule.mode == mode:
+                return rule
+        return None
+
+    def p95(self, route: str, model: str) -> Optional[float]:
+        with self._lock:
+            w = self._windows.get((route, model))
+            return w.p95(time.monotonic(), self.min_samples) if w else None
+
+    def choose(
+        self,
+        route: str,
+        *,
+        mode: Optional[str] = None,
+        text: str = "",
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+    ) -> Decision:
+        """
+        mode: ゲートウェイのモード（#waiting 等、タグなしは None）。text: 入力の長さを見る本文
+        max_tokens: 呼び出し側の上限（規則より優先、ROUTER_CAPS に関係なく使う）。model: 固定したい時（記録だけして従う）
+        """
+        if model:
+            decision = Decision(model, max_tokens, "override", model)
+        else:
+            rule = self._rule(route, mode, estimate_tokens(text) if text else 0)
+            preferred = rule.model if rule else self.fallback_model
+            limit = max_tokens if max_tokens is not None else (rule.max_tokens if rule and self.caps else None)
+            decision = Decision(preferred, limit, "rule", preferred)
+            slo = self.slos.get(route, 0)
+            if slo and preferred != self.fallback_model:
+                p95 = self.p95(route, preferred)
+                if p95 is not None and p95 > slo:
+                    decision = Decision(self.fallback_model, limit, "slo_fallback", preferred)
+        ROUTER_DECISIONS.inc(route=route, model=decision.model, reason=decision.reason)
+        return decision
+
+    def observe(self, route: str, model: str, seconds: float) -> None:
+        """キャッシュに当たらず実際に呼んだ時の所要時間（待ち行列の時間は含めない）"""
+        now = time.monotonic()
+        with self._lock:
+            w = self._windows.get((route, model))
+            if w is None:
+                w = self._windows[(route, model)] = _Window(self.window_sec, self.max_samples)
+            w.add(now, seconds)
+            p95 = w.p95(now, self.min_samples)
+        if p95 is not None:
+            ROUTER_P95.set(p95, route=route, model=model)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                f"{route}/{model}": {"samples": len(w.samples), "p95": w.p95(now, self.min_samples)}
+                for (route, model), w in self._windows.items()
+            }
+
+
+router = ModelRouter()
+choose = router.choose
+observe = router.observe
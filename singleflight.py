@@ -0,0 +1,73 @@
+# singleflight.py
+"""
+同じキーの同時リクエストを 1 回の計算にまとめる（single-flight / request coalescing）。
+
+- 最初の呼び出しだけが fn() を実行し、同じキーで待っている呼び出しは同じ結果を受け取る
+- linger_sec > 0 なら、完了後もその秒数は結果を返し続ける（二重送信の吸収用）
+- 例外は共有するが linger はしない（次の呼び出しで再試行される）
+- 待っている側がキャンセルされても、計算自体は他の待ち手のために続く
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self, linger_sec: float = 0.0, max_lingering: int = 1024) -> None:
+        self.linger_sec = linger_sec
+        self.max_lingering = max_lingering
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self._done: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()  # 実行中タスクへの強参照
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        self.calls += 1
+
+        hit = self._done.get(key)
+        if hit is not None:
+            expires_at, value = hit
+            if time.monotonic() < expires_at:
+                self.shared += 1
+                return value
+            del self._done[key]
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.shared += 1
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        # 誰も結果を見ないまま例外で終わった時の "never retrieved" 警告を防ぐ
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = fut
+        task = asyncio.create_task(self._run(key, fn, fut))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return await asyncio.shield(fut)
+
+    async def _run(self, key: Hashable, fn: Callable[[], Awaitable[Any]], fut: asyncio.Future) -> None:
+        try:
+            value = await fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+        else:
+            fut.set_result(value)
+            if self.linger_sec > 0:
+                self._done[key] = (time.monotonic() + self.linger_sec, value)
+                while len(self._done) > self.max_lingering:
+                    self._done.popitem(last=False)
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared, "inflight": len(self._inflight)}
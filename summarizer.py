@@ -0,0 +1,214 @@
+# summarizer.py
+"""
+日次サマリーの部品（プロンプト・整形・チャンク分割）と、memory_log を読み書きする側の共通処理
+（時刻の解釈・or=(...) の値の引用・(created_at, id) の keyset ページング・サマリー行）。
+LLM 呼び出しはしない。app.py / worker.py / replica.py とバッチ系スクリプト（backfill.py・batch_summarize.py）から使う。
+
+階層サマリー:
+  1日のログを CHUNK_SIZE 件ごとのチャンクに切る
+  → 埋まったチャンクは部分要約して `summary-YYYYMMDD-cNNN` で保存（以後再利用）
+    部分要約の行の content にはチャンクの指紋（chunk_fingerprint）を入れ、
+    行の挿入・削除でチャンクの中身がずれていたら番号が同じでも作り直す
+  → 末尾の埋まっていないチャンクだけ毎回要約し直す
+  → 部分要約をまとめて 1 日のサマリーにする
+再実行時のトークン消費は「新しく増えた行」にだけ比例する。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+JST = timezone(timedelta(hours=9))
+
+EMPTY_DAY_SUMMARY = "本日の記録はまだありません。"
+
+DAILY_SUMMARY_PROMPT = (
+    "あなたは「Jarvisたん」です。以下は1日の会話ログです。\n"
+    "・事実を歪めず\n"
+    "・感情と出来事の流れが分かるように\n"
+    "・3〜6文で\n"
+    "・日記として自然な日本語で\n"
+    "・箇条書きは禁止\n"
+    "最後に一言、Jarvisとして短い所感を添えてください。"
+)
+
+CHUNK_SUMMARY_PROMPT = (
+    "あなたは「Jarvisたん」です。以下は1日の会話ログの一部（時間順の一区間）です。\n"
+    "・事実を歪めず、出来事と感情の動きを落とさない\n"
+    "・2〜4文で\n"
+    "・後で他の区間とまとめるので、所感や締めの言葉は不要"
+)
+
+MERGE_SUMMARY_PROMPT = (
+    "あなたは「Jarvisたん」です。以下は1日の会話を時間順に区切って要約したものです。\n"
+    "これらを1日の日記としてまとめ直してください。\n"
+    "・事実を歪めず\n"
+    "・感情と出来事の流れが分かるように\n"
+    "・3〜6文で\n"
+    "・日記として自然な日本語で\n"
+    "・箇条書きは禁止\n"
+    "最後に一言、Jarvisとして短い所感を添えてください。"
+)
+
+SUMMARY_SENDER_TYPE = "summary"
+SUMMARY_PART_SENDER_TYPE = "summary-part"
+SUMMARY_PERSONA = "jarvis-daily-summary"
+
+
+def report_key_for(day, user_id: Optional[str] = None, conversation_id: Optional[str] = None) -> str:
+    """
+    1日1行にするキー（JST の日付）。同日再実行は上書き。
+    user_id を省略すると既定テナントの既定会話（従来形式 summary-YYYYMMDD）。
+    それ以外はユーザー・会話ごとに summary-{(user_id, conversation_id) のハッシュ 24 桁}-YYYYMMDD。
+    id をそのままつなぐと、"-" を含む id（UUID 等）で別のユーザー・会話と同じキーになり得る
+    （report_key の upsert は全ユーザー共通なので他人のサマリーを上書きする）。
+    """
+    if user_id is None:
+        return day.strftime("summary-%Y%m%d")
+    scope = json.dumps([user_id, conversation_id], ensure_ascii=False)
+    return f"summary-{hashlib.sha256(scope.encode('utf-8')).hexdigest()[:24]}-{day:%Y%m%d}"
+
+
+def build_transcript(rows) -> str:
+    # できるだけ「読みやすい会話ログ」に整形
+    lines = []
+    for r in rows:
+        sp = r.get("speaker") or r.get("sender_type") or "?"
+        msg = (r.get("message") or "").strip()
+        if not msg:
+            continue
+        label = "あなた" if sp == "user" else "Jarvis"
+        lines.append(f"{label}: {msg}")
+    return "\n".join(lines)
+
+
+def conversation_rows(rows) -> list:
+    """日報・要約など report_key 付きの行を除いた、会話だけの行"""
+    return [r for r in rows if not r.get("report_key")]
+
+
+def chunk_rows(rows: list, chunk_size: int) -> tuple[list[list], list]:
+    """
+    Returns: (埋まったチャンクのリスト, 末尾の端数チャンク)
+    チャンク番号は時系列の通し番号なので、追記だけのログなら再実行しても安定する。
+    """
+    n_full = len(rows) // chunk_size
+    full = [rows[i * chunk_size : (i + 1) * chunk_size] for i in range(n_full)]
+    tail = rows[n_full * chunk_size :]
+    return full, tail
+
+
+def part_key(report_key: str, index: int) -> str:
+    return f"{report_key}-c{index:03d}"
+
+
+def chunk_fingerprint(rows: list) -> str:
+    """チャンクの行（created_at・speaker・message）の指紋。部分要約の行の content に保存する"""
+    ident = [[utc_iso(r["created_at"]) if r.get("created_at") else "", r.get("speaker"), r.get("message")] for r in rows]
+    digest = hashlib.sha256(json.dumps(ident, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"chunk:{len(rows)}:{digest[:32]}"
+
+
+def merge_input(part_summaries: list[str]) -> str:
+    return "\n\n".join(f"[{i + 1}] {s}" for i, s in enumerate(part_summaries))
+
+
+# -----------------------------
+# memory_log helpers
+# -----------------------------
+def need(name: str) -> str:
+    v = os.getenv(name)
+    if not v:
+        print(f"[FATAL] Missing env: {name}", file=sys.stderr)
+        sys.exit(2)
+    return v
+
+
+def parse_ts(value: str) -> datetime:
+    """Supabase / クライアントの ISO 文字列。タイムゾーン無しは UTC とみなす"""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def utc_iso(value: str) -> str:
+    """Supabase・キュー・レプリカで表記が違っても同じ時刻なら同じ文字列に（UTC・マイクロ秒まで）"""
+    return parse_ts(value).astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def pg_quote(value) -> str:
+    # or=(...) の中の値。タイムスタンプの + や : をそのまま渡すため "..." で囲む
+    return '"' + str(value).replace('"', '\\"') + '"'
+
+
+def day_bound(value: Optional[str]) -> Optional[str]:
+    """CLI の --since / --until（YYYY-MM-DD, JST の 0 時）"""
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=JST).isoformat()
+
+
+def summary_row(
+    user_id: str, conversation_id: str, report_key: str, text: str, sender_type: str, content: Optional[str] = None,
+) -> dict:
+    """要約・部分要約の行（report_key で upsert）。部分要約は content にチャンクの指紋"""
+    return {
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "speaker": "bot",
+        "message": text,
+        "content": text if content is None else content,
+        "sender_type": sender_type,
+        "persona": SUMMARY_PERSONA,
+        "report_key": report_key,
+    }
+
+
+async def keyset_rows(query: Callable, page_size: int, max_rows: Optional[int] = None) -> list[dict]:
+    """
+    (created_at, id) の keyset ページングで全部読む。offset だと同時刻の行がページ境界で重複・欠落する。
+    query() はページごとに新しい select を返すこと（select に id と created_at を含める）。
+    """
+    rows: list[dict] = []
+    while max_rows is None or len(rows) < max_rows:
+        page = page_size if max_rows is None else min(page_size, max_rows - len(rows))
+        q = query()
+        if rows:
+            ts, rid = pg_quote(rows[-1]["created_at"]), rows[-1]["id"]
+            q = q.or_(f"created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{rid})")
+        res = await q.order("created_at", desc=False).order("id", desc=False).limit(page).execute()
+        batch = res.data or []
+        rows.extend(batch)
+        if len(batch) < page:
+            break
+    return rows
+
+
+async def fetch_day_rows(
+    sb,
+    user_id: str,
+    conversation_id: str,
+    start: datetime,
+    end: datetime,
+    *,
+    columns: str = "created_at,speaker,message,sender_type,persona,report_key",
+    page_size: int = 1000,
+    max_rows: Optional[int] = None,
+) -> list[dict]:
+    """その会話の [start, end) の行を古い順に（sb は supabase の AsyncClient）"""
+    select = ",".join(dict.fromkeys(["id", "created_at", *columns.split(",")]))
+    return await keyset_rows(
+        lambda: (
+            sb.table("memory_log")
+            .select(select)
+            .eq("user_id", user_id)
+            .eq("conversation_id", conversation_id)
+            .gte("created_at", start.isoformat())
+            .lt("created_at", end.isoformat())
+        ),
+        page_size,
+        max_rows,
+    )
@@ -0,0 +1,137 @@
+# tenants.py
+"""
+リクエストがどのユーザー（テナント）のものかを決める。app.py から使う。
+
+- X-API-KEY: JARVIS_API_KEY は従来どおり SUPABASE_USER_ID（既定テナント）。
+  追加のキーは JARVIS_TENANTS（JSON）か JARVIS_TENANTS_FILE で渡す:
+      {"alice": {"api_key": "...", "user_id": "<uuid>", "conversation_id": "live-chat"}}
+- Authorization: Bearer <JWT>（HS256, JARVIS_JWT_SECRET で検証）。sub をそのまま user_id に使う
+  （Supabase Auth のアクセストークンがそのまま通る）
+- キーは SHA-256 で引く（平文は持たない）。JWT の署名比較は hmac.compare_digest。外部ライブラリは使わない
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+DEFAULT_CONVERSATION_ID = "live-chat"
+
+
+class AuthError(Exception):
+    """キー・トークンが無い / 合わない（app 側で 401 にする）"""
+
+
+@dataclass(frozen=True)
+class Tenant:
+    id: str  # レート制限・キャッシュのスコープ（キーそのものは持たない）
+    user_id: str
+    conversation_id: str = DEFAULT_CONVERSATION_ID  # conversation_id 省略時
+    is_default: bool = False  # 単一ユーザー時代からの利用者（report_key などを従来形式のまま使う）
+
+
+def _key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _b64decode(part: str) -> bytes:
+    return base64.urlsafe_b64decode(part + "=" * (-len(part) % 4))
+
+
+def verify_jwt(token: str, secret: str, *, audience: Optional[str] = None, leeway_sec: float = 30) -> dict:
+    """HS256 のみ。署名・exp・nbf・aud を確かめて claims を返す"""
+    # 形の崩れたトークンはどれも 401（500 にしない）
+    try:
+        head, body, sig = token.split(".")
+        signed = f"{head}.{body}".encode("ascii")  # 非 ASCII は UnicodeEncodeError（ValueError の一種）
+        header = json.loads(_b64decode(head))
+        claims = json.loads(_b64decode(body))
+        signature = _b64decode(sig)
+    except (ValueError, TypeError) as e:
+        raise AuthError("malformed token") from e
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise AuthError("malformed token")
+    if header.get("alg") != "HS256":
+        raise AuthError("unsupported token algorithm")
+
+    expected = hmac.new(secret.encode("utf-8"), signed, hashlib.sha256).digest()
+    if not hmac.compare_digest(expected, signature):
+        raise AuthError("invalid token signature")
+
+    try:
+        exp = float(claims["exp"]) if "exp" in claims else None
+        nbf = float(claims["nbf"]) if "nbf" in claims else None
+    except (ValueError, TypeError) as e:
+        raise AuthError("malformed token time claims") from e
+    now = time.time()
+    if exp is not None and not now <= exp + leeway_sec:  # NaN も期限切れ扱い
+        raise AuthError("token expired")
+    if nbf is not None and not now >= nbf - leeway_sec:
+        raise AuthError("token not yet valid")
+    if audience:
+        aud = claims.get("aud")
+        if audience not in (aud if isinstance(aud, list) else [aud]):
+            raise AuthError("invalid token audience")
+    return claims
+
+
+class TenantResolver:
+    def __init__(
+        self,
+        default: Tenant,
+        default_api_key: str,
+        tenants: Optional[dict[str, dict]] = None,
+        *,
+        jwt_secret: Optional[str] = None,
+        jwt_audience: Optional[str] = None,
+    ) -> None:
+        self.default = default
+        self.jwt_secret = jwt_secret
+        self.jwt_audience = jwt_audience
+        self._by_key: dict[str, Tenant] = {_key_hash(default_api_key): default}
+        for name, cfg in (tenants or {}).items():
+            user_id = cfg["user_id"]
+            self._by_key[_key_hash(cfg["api_key"])] = Tenant(
+                id=f"key:{name}",
+                user_id=user_id,
+                conversation_id=cfg.get("conversation_id") or DEFAULT_CONVERSATION_ID,
+                is_default=user_id == default.user_id,
+            )
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def resolve(self, x_api_key: Optional[str], authorization: Optional[str] = None) -> Tenant:
+        if authorization and authorization[:7].lower() == "bearer ":
+            if not self.jwt_secret:
+                raise AuthError("bearer tokens are not enabled")
+            claims = verify_jwt(authorization[7:].strip(), self.jwt_secret, audience=self.jwt_audience)
+            sub = str(claims.get("sub") or "")
+            if not sub:
+                raise AuthError("token has no sub")
+            if sub == self.default.user_id:
+                return self.default
+            return Tenant(id=f"jwt:{sub}", user_id=sub)
+
+        if not x_api_key:
+            raise AuthError("missing api key")
+        # SHA-256 で引くので、キーの先頭一致から時間差で当てられることはない
+        tenant = self._by_key.get(_key_hash(x_api_key))
+        if tenant is None:
+            raise AuthError("invalid api key")
+        return tenant
+
+
+def load_tenants() -> dict[str, dict]:
+    """JARVIS_TENANTS_FILE（JSON ファイル）→ JARVIS_TENANTS（JSON 文字列）の順に読む"""
+    path = os.getenv("JARVIS_TENANTS_FILE")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    raw = os.getenv("JARVIS_TENANTS")
+    return json.loads(raw) if raw else {}
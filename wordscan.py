@@ -0,0 +1,137 @@
+# wordscan.py
+"""
+Aho–Corasick による複数辞書の一括スキャン。
+
+- 全辞書（カテゴリ付き）から 1 つのオートマトンを作り、本文を 1 パスで走査する
+- ヒットごとに (カテゴリ, 単語, 開始位置, 終了位置) を返す（位置は str のインデックス、終了は排他）
+- HotDictionary: JSON ファイルの更新を検知して作り直す（再起動不要）
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger("wordscan")
+
+
+class Match(NamedTuple):
+    category: str
+    word: str
+    start: int
+    end: int
+
+
+class Automaton:
+    def __init__(self, dictionaries: dict[str, list[str]]) -> None:
+        self.dictionaries = {cat: list(words) for cat, words in dictionaries.items()}
+        # ノード i: 遷移 _goto[i], 失敗リンク _fail[i], 出力 _out[i] = [(category, word), ...]
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[list[tuple[str, str]]] = [[]]
+
+        for cat, words in self.dictionaries.items():
+            for w in words:
+                if w:
+                    self._add(w, cat)
+        self._link()
+
+    def _add(self, word: str, category: str) -> None:
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][ch] = nxt
+            node = nxt
+        if (category, word) not in self._out[node]:
+            self._out[node].append((category, word))
+
+    def _link(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                # 失敗先の出力もまとめておく（走査時に辿らなくて済む）
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def finditer(self, text: str) -> list[Match]:
+        goto, fail, out = self._goto, self._fail, self._out
+        matches: list[Match] = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for cat, word in out[node]:
+                matches.append(Match(cat, word, i + 1 - len(word), i + 1))
+        return matches
+
+
+class HotDictionary:
+    """
+    defaults を初期値にし、path の JSON（{"stop": [...], "ng": [...], ...}）があれば
+    そのカテゴリを置き換える。ファイルの mtime を check_interval_sec ごとに確認して作り直す。
+    """
+
+    def __init__(self, defaults: dict[str, list[str]], path: Optional[str] = None, check_interval_sec: float = 2.0) -> None:
+        self.defaults = defaults
+        self.path = path
+        self.check_interval_sec = check_interval_sec
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._automaton = self._build()
+
+    @property
+    def automaton(self) -> Automaton:
+        now = time.monotonic()
+        if self.path and now - self._checked_at >= self.check_interval_sec:
+            with self._lock:
+                if now - self._checked_at >= self.check_interval_sec:
+                    self._checked_at = now
+                    self._maybe_reload()
+        return self._automaton
+
+    def _maybe_reload(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        try:
+            self._automaton = self._build()
+            logger.info("dictionary reloaded from %s", self.path)
+        except (OSError, ValueError) as e:
+            # 壊れたファイルを書いた瞬間などは前の辞書のまま
+            logger.warning("dictionary reload failed, keeping previous: %r", e)
+
+    def _build(self) -> Automaton:
+        dictionaries = dict(self.defaults)
+        if self.path and os.path.exists(self.path):
+            self._mtime = os.stat(self.path).st_mtime
+            with open(self.path, encoding="utf-8") as f:
+                loaded = json.load(f)
+            if not isinstance(loaded, dict):
+                raise ValueError("dictionary file must be a JSON object")
+            for cat, words in loaded.items():
+                # 文字列をそのまま回すと 1 文字ずつの語になる
+                if not isinstance(words, list) or not all(isinstance(w, str) for w in words):
+                    raise ValueError(f"dictionary {cat!r} must be a JSON array of strings")
+                dictionaries[cat] = words
+        else:
+            self._mtime = None
+        return Automaton(dictionaries)
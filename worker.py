@@ -0,0 +1,360 @@
+# worker.py
+"""
+定期処理のワーカー（cron_job.py / post.py / /daily_summary をまとめて回す常駐プロセス）。
+
+    python worker.py            # スケジューラ + ワーカーを常駐
+    python worker.py once       # 期限の来た分（止まっていた間の分を含む）を処理して終了（cron から呼ぶ用）
+    python worker.py status     # 種類ごとの件数と直近の失敗
+    python worker.py requeue [--kind discord]   # dead を積み直す
+
+ジョブ（冪等キー = report_key と同じ日付キー）:
+  daily_report    09:00  cron_job.py の定期報告を memory_log に upsert → Discord へ
+  jarvis_post     09:05  post.py の曜日メッセージ + ジャービスたんの返答を保存 → Discord へ
+  summary_fanout  00:10  前日分の /daily_summary を会話ごとに daily_summary として積む
+  daily_summary          app の /daily_summary を呼ぶ（要約・キャッシュ・upsert は app 側のロジックのまま）
+  discord                Discord 投稿の outbox。専用ワーカー 1 本で DISCORD_RPM を守り、429 は Retry-After に従う
+
+時刻は JST。SCHEDULE_*_AT を空にするとそのジョブは積まない。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+import clients
+import cron_job
+import llm
+import post
+import router
+from jobs import (
+    Job,
+    JobQueue,
+    JobType,
+    PermanentError,
+    RetryLater,
+    RetryPolicy,
+    Schedule,
+    Scheduler,
+    Worker,
+    parse_at,
+)
+from ratelimit import RateLimiter
+from summarizer import keyset_rows, need
+
+JST = timezone(timedelta(hours=9))
+
+# -----------------------------
+# Settings
+# -----------------------------
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.sqlite3")
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", "2"))
+JOBS_POLL_SEC = float(os.getenv("JOBS_POLL_SEC", "5"))
+JOBS_CATCHUP_DAYS = int(os.getenv("JOBS_CATCHUP_DAYS", "3"))  # 止まっていた時に遡って積む日数（初回起動より前には遡らない）
+JOBS_RETENTION_DAYS = int(os.getenv("JOBS_RETENTION_DAYS", "30"))  # done を消すまで（冪等キーの記憶期間）
+SCHEDULER_INTERVAL_SEC = float(os.getenv("SCHEDULER_INTERVAL_SEC", "60"))
+
+SCHEDULE_DAILY_REPORT_AT = os.getenv("SCHEDULE_DAILY_REPORT_AT", "09:00")
+SCHEDULE_POST_AT = os.getenv("SCHEDULE_POST_AT", "09:05")
+SCHEDULE_SUMMARY_AT = os.getenv("SCHEDULE_SUMMARY_AT", "00:10")  # 前日分を要約する
+# 要約する会話（カンマ区切り）。"*" でその日の memory_log から見つけた会話すべて
+# （report_key は会話ごとに別なので、複数会話を要約しても上書きし合わない）
+SCHEDULE_SUMMARY_CONVERSATIONS = os.getenv("SCHEDULE_SUMMARY_CONVERSATIONS", "*")
+
+# /daily_summary を呼ぶ先（app.py）
+JARVIS_BASE_URL = os.getenv("JARVIS_BASE_URL", "http://127.0.0.1:8000").rstrip("/")
+JARVIS_TIMEOUT_SEC = float(os.getenv("JARVIS_TIMEOUT_SEC", "180"))
+
+# Discord outbox（Webhook は 1 本あたり 30 回/分程度で 429 になる）
+DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
+DISCORD_RPM = float(os.getenv("DISCORD_RPM", "20"))
+DISCORD_TIMEOUT_SEC = float(os.getenv("DISCORD_TIMEOUT_SEC", "10"))
+
+POST_CONV_ID = "post"
+POST_USER_PERSONA = "user-human"
+POST_BOT_PERSONA = "ai-jarvis"
+POST_SENDER_ID = "00000000-0000-0000-0000-000000000000"  # post.py と同じ仮の UUID
+
+logger = logging.getLogger("worker")
+
+
+def _day(payload: dict) -> date:
+    return datetime.strptime(payload["date"], "%Y-%m-%d").date()
+
+
+def _raise_for_http(res: httpx.Response, what: str) -> None:
+    """429 / 5xx は再試行、それ以外の 4xx は直らないので dead"""
+    if res.status_code == 429:
+        raise RetryLater(_retry_after(res), f"{what}: 429")
+    if res.status_code >= 500:
+        raise RuntimeError(f"{what}: {res.status_code} {res.text[:300]}")
+    if res.status_code >= 400:
+        raise PermanentError(f"{what}: {res.status_code} {res.text[:300]}")
+
+
+def _retry_after(res: httpx.Response) -> float:
+    # Discord は JSON の retry_after（秒）、それ以外は Retry-After ヘッダ
+    try:
+        return max(1.0, float(res.json().get("retry_after")))
+    except (ValueError, TypeError, AttributeError):
+        pass
+    try:
+        return max(1.0, float(res.headers.get("Retry-After", "")))
+    except ValueError:
+        return 30.0
+
+
+class JarvisJobs:
+    def __init__(self, queue: JobQueue, http: httpx.AsyncClient) -> None:
+        self.queue = queue
+        self.http = http
+        self.user_id = os.getenv("SUPABASE_USER_ID")
+        self.discord_limiter = RateLimiter(rpm=DISCORD_RPM)
+
+    # -----------------------------
+    # Handlers
+    # -----------------------------
+    async def daily_report(self, job: Job) -> dict:
+        fire = datetime.fromisoformat(job.payload["at"])
+        msg = cron_job.make_message(fire)
+        report_key = job.key
+        row = {
+            "user_id": self.user_id,
+            "conversation_id": cron_job.CONV_ID,
+            "speaker": "bot",
+            "message": msg,
+            "content": msg,
+            "sender_type": cron_job.SENDER_TYPE,
+            "persona": cron_job.PERSONA,
+            "report_key": report_key,
+        }
+        sb = await clients.supabase.get()
+        await sb.table("memory_log").upsert(row, on_conflict="report_key").execute()
+        self._to_discord(report_key, msg)
+        return {"report_key": report_key}
+
+    async def jarvis_post(self, job: Job) -> dict:
+        day = _day(job.payload)
+        user_message = post.get_today_message(datetime.combine(day, datetime.min.time()))
+        user_key, reply_key = f"{job.key}-user", f"{job.key}-reply"
+
+        sb = await clients.supabase.get()
+        await sb.table("memory_log").upsert(
+            self._post_row("user", POST_USER_PERSONA, user_message, user_key), on_conflict="report_key",
+        ).execute()
+
+        # 再試行時は保存済みの返答を使う（生成し直して別の文面を投稿しない）
+        res = await sb.table("memory_log").select("message").eq("report_key", reply_key).limit(1).execute()
+        reply = ((res.data or [{}])[0].get("message") or "").strip()
+        if not reply:
+            completion = await llm.complete(
+                await clients.openai.get(),
+                route="jarvis_post",
+                ttl=0,
+                priority=llm.PRIORITY_BATCH,
+                **router.choose("jarvis_post", text=user_message, max_tokens=300).params(),
+                messages=[
+                    {"role": "system", "content": post.JARVIS_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_message},
+                ],
+            )
+            reply = completion.text
+            if not reply:
+                raise RuntimeError("empty reply from OpenAI")
+            await sb.table("memory_log").upsert(
+                self._post_row("jarvis", POST_BOT_PERSONA, reply, reply_key), on_conflict="report_key",
+            ).execute()
+
+        self._to_discord(job.key, reply)
+        return {"reply_key": reply_key}
+
+    def _post_row(self, sender_type: str, persona: str, text: str, report_key: str) -> dict:
+        return {
+            "user_id": self.user_id,
+            "conversation_id": POST_CONV_ID,
+            "speaker": "bot" if sender_type == "jarvis" else "user",
+            "sender_type": sender_type,
+            "sender_id": POST_SENDER_ID,
+            "persona": persona,
+            "message": text,
+            "content": text,
+            "report_key": report_key,
+        }
+
+    async def summary_fanout(self, job: Job) -> dict:
+        day = _day(job.payload)
+        convs = await self._summary_conversations(day)
+        for conv in convs:
+            self.queue.enqueue(
+                "daily_summary",
+                {"date": day.isoformat(), "conversation_id": conv},
+                key=f"daily_summary:{conv}:{day:%Y%m%d}",
+            )
+        return {"conversations": convs}
+
+    async def _summary_conversations(self, day: date) -> list[str]:
+        configured = [c.strip() for c in SCHEDULE_SUMMARY_CONVERSATIONS.split(",") if c.strip()]
+        if configured != ["*"]:
+            return configured
+
+        # その日に会話ログ（要約・日報行以外）がある conversation_id を集める
+        # (created_at, id) の keyset で読む（offset だとページ境界の同時刻の行を取りこぼし得る）
+        start = datetime.combine(day, datetime.min.time(), JST)
+        sb = await clients.supabase.get()
+        rows = await keyset_rows(
+            lambda: (
+                sb.table("memory_log")
+                .select("id,created_at,conversation_id")
+                .eq("user_id", self.user_id)
+                .is_("report_key", "null")
+                .gte("created_at", start.isoformat())
+                .lt("created_at", (start + timedelta(days=1)).isoformat())
+            ),
+            1000,
+        )
+        return list(dict.fromkeys(r["conversation_id"] for r in rows if r.get("conversation_id")))
+
+    async def daily_summary(self, job: Job) -> dict:
+        res = await self.http.post(
+            JARVIS_BASE_URL + "/daily_summary",
+            json={"date": job.payload["date"], "conversation_id": job.payload["conversation_id"]},
+            headers={"X-API-KEY": os.getenv("JARVIS_API_KEY", "")},
+            timeout=JARVIS_TIMEOUT_SEC,
+        )
+        _raise_for_http(res, "daily_summary")
+        return {"date": res.json().get("date")}
+
+    def _to_discord(self, key: str, content: str) -> None:
+        if DISCORD_WEBHOOK_URL:
+            self.queue.enqueue("discord", {"content": content}, key=f"discord:{key}", max_attempts=8)
+
+    async def discord(self, job: Job) -> dict:
+        if not DISCORD_WEBHOOK_URL:
+            raise PermanentError("DISCORD_WEBHOOK_URL is not set")
+        async with await self.discord_limiter.acquire(0):
+            res = await self.http.post(
+                DISCORD_WEBHOOK_URL,
+                json={"content": job.payload["content"][:2000]},  # Discord の上限
+                timeout=DISCORD_TIMEOUT_SEC,
+            )
+        _raise_for_http(res, "discord")
+        return {"status": res.status_code}
+
+    # -----------------------------
+    # Wiring
+    # -----------------------------
+    def types(self) -> dict[str, JobType]:
+        return {
+            "daily_report": JobType(self.daily_report, RetryPolicy(max_attempts=5, base_sec=60), timeout_sec=60),
+            "jarvis_post": JobType(self.jarvis_post, RetryPolicy(max_attempts=5, base_sec=60), timeout_sec=180),
+            "summary_fanout": JobType(self.summary_fanout, RetryPolicy(max_attempts=5, base_sec=60), timeout_sec=120),
+            "daily_summary": JobType(
+                self.daily_summary, RetryPolicy(max_attempts=6, base_sec=120), timeout_sec=JARVIS_TIMEOUT_SEC + 10,
+            ),
+        }
+
+    def outbox_types(self) -> dict[str, JobType]:
+        return {"discord": JobType(self.discord, RetryPolicy(max_attempts=8, base_sec=10, max_sec=900), timeout_sec=30)}
+
+    def schedules(self) -> list[Schedule]:
+        out = []
+        at = parse_at(SCHEDULE_DAILY_REPORT_AT)
+        if at:
+            out.append(Schedule(
+                "daily_report", at,
+                lambda d, at=at: (f"daily-{d:%Y%m%d}", {"date": d.isoformat(), "at": datetime.combine(d, at, JST).isoformat()}),
+            ))
+        at = parse_at(SCHEDULE_POST_AT)
+        if at:
+            out.append(Schedule("jarvis_post", at, lambda d: (f"post-{d:%Y%m%d}", {"date": d.isoformat()})))
+        at = parse_at(SCHEDULE_SUMMARY_AT)
+        if at:
+            # d の 00:10 に d - 1 日分
+            out.append(Schedule(
+                "summary_fanout", at,
+                lambda d: (f"summary_fanout:{d - timedelta(days=1):%Y%m%d}", {"date": (d - timedelta(days=1)).isoformat()}),
+            ))
+        return out
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+async def _serve(queue: JobQueue, once: bool) -> None:
+    need("SUPABASE_URL")
+    os.getenv("SUPABASE_SERVICE_ROLE_KEY") or need("SUPABASE_KEY")
+    need("SUPABASE_USER_ID")
+
+    async with httpx.AsyncClient() as http:
+        jj = JarvisJobs(queue, http)
+        scheduler = Scheduler(queue, jj.schedules(), catchup_days=JOBS_CATCHUP_DAYS)
+        workers = [
+            Worker(queue, jj.types(), concurrency=JOBS_CONCURRENCY, poll_sec=JOBS_POLL_SEC, name="jobs"),
+            Worker(queue, jj.outbox_types(), concurrency=1, poll_sec=JOBS_POLL_SEC, name="discord"),
+        ]
+        purged = queue.purge(JOBS_RETENTION_DAYS * 86400)
+        if purged:
+            logger.info("purged %d finished jobs", purged)
+        try:
+            if once:
+                scheduler.tick()
+                # fan-out / discord は前段のジョブが積むので、何も積まれなくなるまで回す
+                while True:
+                    before = json.dumps(queue.stats(), sort_keys=True)
+                    for w in workers:
+                        await w.drain()
+                    if json.dumps(queue.stats(), sort_keys=True) == before:
+                        break
+                return
+
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(sig, stop.set)
+                except NotImplementedError:  # Windows
+                    pass
+            tasks = [asyncio.create_task(scheduler.run(SCHEDULER_INTERVAL_SEC, stop))]
+            tasks += [asyncio.create_task(w.run()) for w in workers]
+            await stop.wait()
+            for w in workers:
+                w.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await clients.aclose()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Durable scheduler/worker for Jarvis periodic jobs")
+    p.add_argument("command", nargs="?", default="run", choices=["run", "once", "status", "requeue"])
+    p.add_argument("--kind", help="requeue: only this job kind")
+    p.add_argument("--db", default=None, help=f"default: {JOBS_DB_PATH}")
+    args = p.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    queue = JobQueue(args.db or JOBS_DB_PATH)
+    try:
+        if args.command == "status":
+            print(json.dumps({"jobs": queue.stats(), "recent_failures": queue.failures()}, ensure_ascii=False, indent=2))
+            return 0
+        if args.command == "requeue":
+            print(f"[OK] requeued {queue.requeue_dead(args.kind)} jobs")
+            return 0
+        asyncio.run(_serve(queue, once=args.command == "once"))
+        return 0
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())